@@ -1,40 +1,113 @@
-from flask import Flask, render_template, request, redirect, url_for, make_response # import portions of flask needed for app
+from flask import Flask, render_template, stream_template, request, redirect, url_for, make_response, Response, jsonify, stream_with_context, current_app, flash, get_flashed_messages # import portions of flask needed for app
+from flask.cli import with_appcontext # commands run inside the app they were started for
 import sqlite3 # import sqlite, needed for creating, writing to, and pulling from the database
-from werkzeug.security import generate_password_hash, check_password_hash # hashes passwords & checks the hash against the security key
 from datetime import date # handles dates for task deadlines
+import io # wraps uploads for line by line reading
+import math # Retry-After is whole seconds
+import click # command line options for the flask cli commands
+import db # pooled, tuned sqlite connections
+import metrics # request, sql and hashing metrics
+import hashing # password hashing in a process pool - hashes passwords & checks the hash against the security key
+import taskstore # paginated task queries
+import pagecache # per user cache of the rendered homepage
+import transfer # streaming import/export
+import writequeue # group commit for task writes
+import weather # cached server side weather for the homepage card
+import assets # fingerprinted, pre-compressed static files
+import changefeed # per user change log - keeps open tabs in sync
+import storage # the task/user repository behind the routes (sqlite file, in-memory sqlite or plain python)
+import archive # moves old tasks out of the live table
+import shards # moves users between the sqlite shards
+import ratelimit # token buckets in front of login and register
+import backup # online snapshots of the databases
+import recurrence # recurring tasks, expanded for the dates a listing shows
 
-app = Flask(__name__) # create the actual application
-app.secret_key = 'password'  # used in hashing passwords - replace with secure 32b random string in production
 DATABASE = "tasks.db" # name of database
 
+# routes and commands are collected here and added to every app create_app() builds
+ROUTES = []
+COMMANDS = []
+
+def route(rule, **options):
+    def decorator(func):
+        ROUTES.append((rule, func, options))
+        return func
+    return decorator
+
+def command(name):
+    def decorator(func):
+        cmd = click.command(name)(with_appcontext(func))
+        COMMANDS.append(cmd)
+        return cmd
+    return decorator
+
+# builds the application - `config` is applied last, over the defaults below and the MOMENTUM_ environment,
+# e.g. create_app({'STORAGE': 'sqlite-memory'}) for an app with its own throwaway store (see storage.py)
+def create_app(config=None):
+    app = Flask(__name__) # create the actual application
+    app.secret_key = 'password'  # used in hashing passwords - replace with secure 32b random string in production
+    app.config['DATABASE'] = DATABASE
+    app.config['TASKS_PAGE_SIZE'] = 50 # tasks shown per page on the homepage
+    app.config['TASKS_MAX_PAGE_SIZE'] = 500 # upper limit for ?limit=
+    app.config['HOME_STREAMING'] = False # always stream the homepage instead of only on ?stream=1
+    app.config['API_MAX_BATCH'] = 1000 # most tasks (or ids) a single /api/tasks request can add or delete
+    app.config['IMPORT_CHUNK_SIZE'] = 5000 # tasks inserted per transaction by /import and import-tasks
+    app.config['STATS_DAYS'] = 14 # days ahead (from today) in the homepage summary and /api/stats
+    app.config['RECURRING_DAYS'] = 14 # days ahead recurring tasks are listed for when there is no ?to=
+    # any setting can be overridden from the environment with a MOMENTUM_ prefix, e.g. MOMENTUM_DATABASE=scratch.db
+    app.config.from_prefixed_env('MOMENTUM')
+    app.config.update(config or {})
+    db.init_app(app) # connection pool - pragmas and pool size can be changed with DB_PRAGMAS and DB_POOL_SIZE
+    storage.init_app(app) # task and user storage - see STORAGE in storage.py
+    pagecache.init_app(app) # homepage cache - see PAGE_CACHE_* settings in pagecache.py
+    metrics.init_app(app) # per route latency for /metrics
+    writequeue.init_app(app) # optional group commit - see WRITE_BATCH* settings in writequeue.py
+    assets.init_app(app) # asset_url() helper and /assets/ - run `flask --app app build-assets` when deploying
+    weather.init_app(app) # weather card - see WEATHER_* settings in weather.py
+    hashing.init_app(app) # password hashing - see PASSWORD_HASH_METHOD and HASH_* settings in hashing.py
+    changefeed.init_app(app) # change feed for open tabs - see CHANGES_* settings in changefeed.py
+    archive.init_app(app) # task archiving - see ARCHIVE_* settings in archive.py
+    shards.init_app(app) # moving users between shards - see SHARD_* settings in storage.py and shards.py
+    ratelimit.init_app(app) # login and register limits - see RATE_LIMIT* settings in ratelimit.py
+    backup.init_app(app) # snapshots - see BACKUP_* settings in backup.py
+    for rule, func, options in ROUTES:
+        app.add_url_rule(rule, view_func=func, **options)
+    for cmd in COMMANDS:
+        app.cli.add_command(cmd)
+    init_db(app) # create or upgrade the tables
+    return app
+
 # used throughout the application for a quick connection to the database - returns a connection to the db
+# the connection is pooled: every call during a request shares one connection, which goes back to the pool afterwards
+# (only for the sqlite storage backends - the routes themselves go through get_repository())
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE) # set conn as the connection to the database
-    conn.row_factory = sqlite3.Row # return the datbase as a dictionary like object
-    return conn
-
-def init_db(): # creates the tables in the database if they accidently clear - consider removing
-    with get_db_connection() as conn:
-        cursor = conn.cursor() # cursor acts as an sql query writer
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                task TEXT NOT NULL,
-                date TEXT NOT NULL,
-                user_id INTEGER,
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-        ''')
-        conn.commit() # commit all changes made to the database
-
-init_db() # run init_db when the application is ran, to handle database tables not being present
+    return db.get_connection(current_app)
+
+# the current app's task/user repository (see storage.py)
+def get_repository():
+    return storage.get_repository()
+
+# brings the storage schema up to date by applying any pending migrations (see migrations.py)
+# once the database is current this is a single PRAGMA read, so it is cheap to run on every worker start
+def init_db(app):
+    with app.app_context():
+        return storage.get_repository(app).migrate()
+
+# `flask --app app init-db` - apply migrations by hand (e.g. before starting the workers)
+@command('init-db')
+def init_db_command():
+    applied = get_repository().migrate()
+    print(f"Applied migrations: {applied}" if applied else "Database already up to date")
+
+# runs one of the repository's write methods (insert_tasks, delete_tasks, clear_tasks) for a user and returns its result
+# with WRITE_BATCHING on, sqlite writes go through the group commit queue and this waits for their batch to commit
+# either way errors are raised to the caller, and on success the user's cached homepage is invalidated
+# and the change streams in this process are woken (the change log itself is written by the repository)
+def write_tasks(func, user_id, *args):
+    result = func(user_id, *args)
+    pagecache.invalidate_user(user_id)
+    changefeed.notify()
+    return result
 
 # Helper functions to get user info from cookies
 def get_current_user_id():
@@ -43,9 +116,26 @@ def get_current_user_id():
 def get_current_username():
     return request.cookies.get('username')
 
+# number of tasks per page - ?limit= can ask for fewer/more, up to TASKS_MAX_PAGE_SIZE
+def get_page_size():
+    page_size = request.args.get('limit', current_app.config['TASKS_PAGE_SIZE'], type=int)
+    return max(1, min(page_size, current_app.config['TASKS_MAX_PAGE_SIZE']))
+
+# answer sent when the password hashing pool is full - cheap to produce, and tells the client when to retry
+def busy_response():
+    resp = make_response("Server busy, please try again.", 503)
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+# answer sent when a rate limit is hit - `wait` is the seconds until the client's next attempt would be let in
+def rate_limited_response(wait):
+    resp = make_response("Too many attempts, please try again later.", 429)
+    resp.headers['Retry-After'] = str(math.ceil(wait))
+    return resp
+
 # as login is our home route, send users to login when they visit the base route of our site
-@app.route("/", methods=['GET', 'POST'])
-@app.route("/login", methods=['GET', 'POST'])
+@route("/", methods=['GET', 'POST'])
+@route("/login", methods=['GET', 'POST'])
 def login():
     if request.method == 'POST': # occurs when users attempt to login
 
@@ -53,50 +143,68 @@ def login():
         username = request.form.get("username")
         password = request.form.get("password")
 
-        # use the database connection and set as connection(conn) variable
-        with get_db_connection() as conn:
-            # set user variable as username from the database
-            user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-
-            # if the user was found in the database, and the password enters matches that users password, continue
-            if user and check_password_hash(user['password'], password):
-                # create response with redirect
-                resp = make_response(redirect(url_for('home')))
-                # set cookies for user_id and username that expire in 30 days
-                resp.set_cookie('user_id', str(user['id']), max_age=60*60*24*30)
-                resp.set_cookie('username', user['username'], max_age=60*60*24*30)
-                return resp
-            return "Invalid username or password."
+        # refuse floods of attempts (from one address, or on one account) before touching the database or hashing
+        wait = ratelimit.check(('login_ip', ratelimit.client_address()), ('login_user', username))
+        if wait:
+            return rate_limited_response(wait)
+
+        # set user variable as username from the database
+        user = get_repository().get_user(username)
+
+        # if the user was found in the database, and the password enters matches that users password, continue
+        # (the hash check runs in the hashing pool - if that is overloaded the login is refused with a 503)
+        try:
+            valid = user is not None and hashing.check_password(user['password'], password)
+        except hashing.HashingOverloaded:
+            return busy_response()
+        if valid:
+            # upgrade hashes made with older parameters now that we have the plain password
+            if hashing.needs_rehash(user['password']):
+                try:
+                    get_repository().update_password(user['id'], hashing.hash_password(password))
+                except hashing.HashingOverloaded:
+                    pass # keep the old hash, it will be upgraded on a later login
+
+            # create response with redirect
+            resp = make_response(redirect(url_for('home')))
+            # set cookies for user_id and username that expire in 30 days
+            resp.set_cookie('user_id', str(user['id']), max_age=60*60*24*30)
+            resp.set_cookie('username', user['username'], max_age=60*60*24*30)
+            return resp
+        return "Invalid username or password."
     return render_template('login.html') # the get request (just visiting the / or /login route of the page)
 
 # shows registration page & handles new users registering
-@app.route("/register", methods=["GET", "POST"])
+@route("/register", methods=["GET", "POST"])
 def register():
 
     # take in user name & password for registration
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
-        # hash password super duper securely
-        hashed_password = generate_password_hash(password)
+        wait = ratelimit.check(('register_ip', ratelimit.client_address()))
+        if wait:
+            return rate_limited_response(wait)
+        # hash password super duper securely (in the hashing pool, see hashing.py)
+        try:
+            hashed_password = hashing.hash_password(password)
+        except hashing.HashingOverloaded:
+            return busy_response()
 
         try:
             # insert into the database the username & the hashed password
-            with get_db_connection() as conn:
-                # sql query to do said insertion
-                conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password))
-                conn.commit()
+            get_repository().create_user(username, hashed_password)
             # redirect to login so they can login via their username & password
             return redirect(url_for('login'))
         
-        # if there already is a username sql throws an error
+        # if there already is a username the repository throws an error
         # handle the error by returning "Username already exists"
-        except sqlite3.IntegrityError:
+        except storage.UserExists:
             return "Username already exists!"
     return render_template('register.html') # get request for register (just shows the register page when they visit that )
 
 # the mainpage of momentum - this is the display task functionality
-@app.route("/home", methods=["GET", "POST"])
+@route("/home", methods=["GET", "POST"])
 def home():
     # check for user_id cookie instead of session
     user_id = get_current_user_id()
@@ -112,71 +220,166 @@ def home():
         # get the date from the date form
         task_date = request.form.get('date') or date.today().isoformat()
 
+        # a repeating task is stored as one rule starting on the chosen date (see recurrence.py)
+        repeat = request.form.get('repeat')
+        if task and task.strip() and repeat in recurrence.FREQUENCIES and taskstore.parse_date(task_date):
+            until = taskstore.parse_date(request.form.get('until'))
+            # a rule that ends before it starts would never show up - say so instead of storing it
+            if request.form.get('until') and (not until or until < taskstore.parse_date(task_date)):
+                flash("The repeat end date can't be before the task's date.", 'error')
+            else:
+                write_tasks(get_repository().create_rule, user_id, task, repeat, 1, task_date, until)
+
         # if the task is not empty add the task to the users tasks, via the add task method
-        if task and task.strip():
+        elif task and task.strip():
             add_task(task, user_id, task_date)
 
         # once the task has been added to the database, redirect them back to the home page to revent
         # the refresh re-add task error
         return redirect(url_for('home'))
 
-    # get all tasks from the user's task list, and set them to a tasks variable
-    with get_db_connection() as conn:
-        tasks = conn.execute('SELECT id, task, date FROM tasks WHERE user_id = ?', 
-                             (user_id,)).fetchall()
-
-    # reformat the date to display properly on the homepage
-    # format date to MM/DD/YYYY
-    formatted_tasks = []
-
-    for task in tasks:
-        # convert the date to a new format
-        date_parts = task['date'].split('-')  # ['YYYY', 'MM', 'DD']
-        formatted_date = f"{date_parts[1]}/{date_parts[2]}/{date_parts[0]}"  # MM/DD/YYYY
-
-        # create a new dictionary with the formatted date
-        new_task = {
-            'id': task['id'],
-            'task': task['task'],
-            'date': formatted_date
-        }
-        # add the task to the formatted tasks list
-        formatted_tasks.append(new_task)
-
-    # returns the index.html homepage with all tasks
-    return render_template("index.html", tasks=formatted_tasks, username=get_current_username(),
-                           current_date=date.today().isoformat())
+    # optional date window (?from=YYYY-MM-DD&to=YYYY-MM-DD) and the cursor of the page to show (?after=)
+    date_from = taskstore.parse_date(request.args.get('from'))
+    date_to = taskstore.parse_date(request.args.get('to'))
+    after = recurrence.decode_cursor(request.args.get('after'))
+    page_size = get_page_size()
+
+    # the page only depends on the user's task version and the url, so it has a strong ETag that is known
+    # before the page is read - a browser that already has this version gets a 304
+    # the version is this process's counter plus the seq of the user's newest change log entry, one index
+    # lookup, so writes made by other processes (the archive-tasks and move-user commands) change it too
+    # the weather card comes from the in-memory weather cache - the age of the cached report is part of the ETag,
+    # so a refreshed report reaches the browser even when the tasks haven't changed; the provider is only
+    # asked (and waited for) once the page has to be rendered
+    weather_report = weather.get_report(request.cookies, wait=False)
+    streaming = current_app.config['HOME_STREAMING'] or request.args.get('stream') == '1'
+    version = get_repository().user_seq(user_id)
+
+    def make_etag(report):
+        return pagecache.make_etag(user_id, version, get_current_username(), date.today().isoformat(),
+                                   request.query_string.decode(), streaming, report and report['fetched_at'])
+
+    # a form error from the POST above is shown once - that page gets no ETag and isn't cached
+    errors = get_flashed_messages(category_filter=['error'])
+    etag = make_etag(weather_report) if not errors else None
+    if etag and request.if_none_match.contains(etag):
+        return home_response(etag, status=304)
+
+    # the same page rendered earlier for this version of the user's tasks
+    cached = pagecache.get_page(etag) if etag else None
+    if cached is not None:
+        return home_response(etag, cached)
+    if weather_report is None: # nothing cached for this location yet - the page is sent with the fetched report
+        weather_report = weather.get_report(request.cookies)
+        etag = make_etag(weather_report) if not errors else None
+
+    # get the total for the badge, and one page of tasks from the user's task list
+    # the page is read lazily while the template renders, with the MM/DD/YYYY date already formatted by sqlite
+    # the change log position is read first - the page's script replays anything after it (see changefeed.py)
+    # recurring tasks are merged in for the dates this page covers
+    repo = get_repository()
+    seq = repo.latest_seq(user_id)
+    stats = repo.get_stats(user_id, date.today().isoformat(), days=current_app.config['STATS_DAYS'])
+    occurrences, recurring = list_occurrences(repo, user_id, date_from, date_to, after)
+    total = repo.count_tasks(user_id, date_from=date_from, date_to=date_to) + recurring
+    tasks = recurrence.RecurringPage(repo.iter_tasks(user_id, after=recurrence.task_cursor(after), limit=page_size,
+                                                     date_from=date_from, date_to=date_to),
+                                     occurrences, page_size, after)
+
+    context = dict(tasks=tasks, username=get_current_username(), current_date=date.today().isoformat(),
+                   total=total, is_first_page=after is None, date_from=date_from, date_to=date_to,
+                   weather=weather_report, seq=seq, stats=stats, errors=errors)
+
+    # streaming mode (HOME_STREAMING or ?stream=1) sends the page while the task list is still being read,
+    # so the first byte and memory use don't depend on how many tasks are on the page (it isn't cached)
+    if streaming:
+        return home_response(etag, buffered(stream_template("index.html", **context)))
+
+    # returns the index.html homepage with this page of tasks, and keeps a copy for next time
+    body = render_template("index.html", **context).encode()
+    if etag:
+        pagecache.set_page(etag, body)
+    return home_response(etag, body)
+
+# the occurrences of the user's recurring tasks for a listing page (lazily), and how many the whole window has
+# one query for the rules - nothing is read per occurrence
+def list_occurrences(repo, user_id, date_from, date_to, after=None):
+    today, days = date.today(), current_app.config['RECURRING_DAYS']
+    lo, hi = recurrence.window(today, days, date_from, date_to)
+    if hi < lo:
+        return iter(()), 0
+    rules = repo.list_rules(user_id, lo.isoformat(), hi.isoformat())
+    occurrences = recurrence.expand(rules, *recurrence.window(today, days, date_from, date_to, after))
+    return occurrences, recurrence.count(rules, lo, hi)
+
+# homepage response - browsers keep the page but must revalidate it with the ETag every time
+def home_response(etag, body=None, status=200):
+    resp = Response(body, status=status, mimetype='text/html')
+    if etag:
+        resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+# join the many small pieces jinja streams into chunks of about `size` characters before they are sent
+def buffered(chunks, size=8192):
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
 
 # add task's user has entered
 def add_task(task, user_id, task_date):
     try:
-        # get database connection and pass in that specific task to the task table with the user_id and the date selected for the task
-        with get_db_connection() as conn:
-            conn.execute('INSERT INTO tasks (task, date, user_id) VALUES (?, ?, ?)', 
-                         (task, task_date, user_id))
-            conn.commit()
+        # pass in that specific task to the task table with the user_id and the date selected for the task
+        write_tasks(get_repository().insert_tasks, user_id, [(task, task_date)])
         return True
-    # error handling for sqlite
-    except sqlite3.Error:
+    # error handling for sqlite (or a batched write that didn't commit in time, or a task the memory store refused)
+    except (sqlite3.Error, TimeoutError, ValueError):
         return False
 
 # delete task based on task_id - makes sure a user cannot delete another users task
-@app.route("/delete_task/<int:task_id>", methods=["POST"])
+@route("/delete_task/<int:task_id>", methods=["POST"])
 def delete_task(task_id):
     # check for user_id cookie instead of session
     user_id = get_current_user_id()
     if not user_id:
         return redirect(url_for('login'))
     
-    # get a database connection & deletes task based on task_id and the user_id
-    with get_db_connection() as conn:
-        conn.execute('DELETE FROM tasks WHERE id = ? AND user_id = ?', (task_id, user_id))
-        conn.commit()
+    # deletes task based on task_id and the user_id
+    write_tasks(get_repository().delete_tasks, user_id, [task_id])
     # one task is deleted they are stay in the home route
     return redirect(url_for('home'))
 
+# delete one occurrence of a recurring task from the homepage
+@route("/delete_occurrence/<int:rule_id>/<occurrence_date>", methods=["POST"])
+def delete_occurrence(rule_id, occurrence_date):
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for('login'))
+
+    if taskstore.parse_date(occurrence_date):
+        write_tasks(get_repository().skip_occurrence, user_id, rule_id, occurrence_date)
+    return redirect(url_for('home'))
+
+# stop a recurring task - the rule and every occurrence go
+@route("/delete_rule/<int:rule_id>", methods=["POST"])
+def delete_rule(rule_id):
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for('login'))
+
+    write_tasks(get_repository().delete_rule, user_id, rule_id)
+    return redirect(url_for('home'))
+
 # clears all tasks the user has in the task list (procrastinate)
-@app.route("/clear", methods=["POST"])
+@route("/clear", methods=["POST"])
 def clear_database():
     # check for user_id cookie instead of session
     user_id = get_current_user_id()
@@ -184,14 +387,12 @@ def clear_database():
         return redirect(url_for('login'))
     
     # deletes all tasks of a certain user_id
-    with get_db_connection() as conn:
-        conn.execute('DELETE FROM tasks WHERE user_id = ?', (user_id,))
-        conn.commit()
+    write_tasks(get_repository().clear_tasks, user_id)
     # they stay at the homepage once all tasks are deleted
     return redirect(url_for('home'))
 
 # clears cookies for the user, logging them out of momentum
-@app.route("/logout")
+@route("/logout")
 def logout():
     resp = make_response(redirect(url_for('login')))
     # Delete the authentication cookies
@@ -199,6 +400,355 @@ def logout():
     resp.delete_cookie('username')
     return resp
 
-# runs the app.py file via port 80
+# JSON api for the task list - lets scripts (and the page) list, add and delete many tasks in one request
+# every endpoint uses the same user_id cookie as the pages, and answers 401 instead of redirecting to login
+
+# json error response
+def api_error(message, status):
+    return jsonify(error=message), status
+
+# lists one page of tasks - same ?after=, ?limit=, ?from= and ?to= parameters as the homepage
+@route("/api/tasks", methods=["GET"])
+def api_list_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    date_from = taskstore.parse_date(request.args.get('from'))
+    date_to = taskstore.parse_date(request.args.get('to'))
+    after = recurrence.decode_cursor(request.args.get('after'))
+    page_size = get_page_size()
+    repo = get_repository()
+    occurrences, recurring = list_occurrences(repo, user_id, date_from, date_to, after)
+    total = repo.count_tasks(user_id, date_from=date_from, date_to=date_to) + recurring
+    page = recurrence.RecurringPage(repo.iter_tasks(user_id, after=recurrence.task_cursor(after), limit=page_size,
+                                                    date_from=date_from, date_to=date_to),
+                                    occurrences, page_size, after)
+
+    # occurrences of recurring tasks have the id of their rule in 'rule' instead of an 'id'
+    items = [{'rule': item['rule'], 'task': item['task'], 'date': item['date']} if item['id'] is None
+             else {'id': item['id'], 'task': item['task'], 'date': item['date']} for item in page]
+    return jsonify(tasks=items, next=page.next_cursor, total=total)
+
+# adds many tasks at once - body is {"tasks": [{"task": "...", "date": "YYYY-MM-DD"}, ...]}
+# the date is optional (defaults to today) and the whole batch is inserted in one transaction
+@route("/api/tasks", methods=["POST"])
+def api_create_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    items = (request.get_json(silent=True) or {}).get('tasks')
+    if not isinstance(items, list) or not items:
+        return api_error("Expected a non-empty 'tasks' list", 400)
+    if len(items) > current_app.config['API_MAX_BATCH']:
+        return api_error(f"At most {current_app.config['API_MAX_BATCH']} tasks per request", 400)
+
+    # validate everything before writing anything, so a bad item doesn't leave half a batch behind
+    today = date.today().isoformat()
+    tasks = []
+    for item in items:
+        task = item.get('task') if isinstance(item, dict) else None
+        if not isinstance(task, str) or not task.strip():
+            return api_error("Every task needs a non-empty 'task' string", 400)
+        task_date = taskstore.parse_date(item.get('date')) if item.get('date') else today
+        if not task_date:
+            return api_error(f"Invalid date {item.get('date')!r}, expected YYYY-MM-DD", 400)
+        tasks.append((task, task_date))
+
+    created = write_tasks(get_repository().insert_tasks, user_id, tasks)
+    return jsonify(created=created), 201
+
+# deletes many tasks by id - body is {"ids": [1, 2, 3]} - ids belonging to other users are ignored
+@route("/api/tasks", methods=["DELETE"])
+def api_delete_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    # type() rather than isinstance(), which lets json true/false through as 1/0
+    if not isinstance(ids, list) or not all(type(task_id) is int for task_id in ids):
+        return api_error("Expected an 'ids' list of task ids", 400)
+    if len(ids) > current_app.config['API_MAX_BATCH']:
+        return api_error(f"At most {current_app.config['API_MAX_BATCH']} ids per request", 400)
+
+    deleted = write_tasks(get_repository().delete_tasks, user_id, ids)
+    return jsonify(deleted=deleted)
+
+# deletes all of the user's tasks
+@route("/api/tasks/clear", methods=["POST"])
+def api_clear_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    deleted = write_tasks(get_repository().clear_tasks, user_id)
+    return jsonify(deleted=deleted)
+
+# recurring tasks - one rule each, listed with their occurrences by /api/tasks and the homepage (see recurrence.py)
+
+# the user's rules
+@route("/api/rules", methods=["GET"])
+def api_list_rules():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    return jsonify(rules=get_repository().list_rules(user_id))
+
+# adds a rule - body is {"task": "...", "freq": "daily" | "weekly" | "monthly", "every": 1, "start": "YYYY-MM-DD",
+# "until": "YYYY-MM-DD"} - every, start (today) and until (never) are optional
+@route("/api/rules", methods=["POST"])
+def api_create_rule():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    item = request.get_json(silent=True)
+    item = item if isinstance(item, dict) else {}
+    task, freq, every = item.get('task'), item.get('freq'), item.get('every', 1)
+    if not isinstance(task, str) or not task.strip():
+        return api_error("A rule needs a non-empty 'task' string", 400)
+    if freq not in recurrence.FREQUENCIES:
+        return api_error(f"'freq' must be one of {', '.join(recurrence.FREQUENCIES)}", 400)
+    if not isinstance(every, int) or isinstance(every, bool) or not 1 <= every <= 366:
+        return api_error("'every' must be a whole number from 1 to 366", 400)
+    start = taskstore.parse_date(item.get('start')) if item.get('start') else date.today().isoformat()
+    until = taskstore.parse_date(item.get('until')) if item.get('until') else None
+    if not start or (item.get('until') and not until):
+        return api_error("Dates must be YYYY-MM-DD", 400)
+    if until and until < start:
+        return api_error("'until' is before 'start'", 400)
+
+    rule_id = write_tasks(get_repository().create_rule, user_id, task, freq, every, start, until)
+    return jsonify(id=rule_id), 201
+
+# deletes a rule and all its occurrences
+@route("/api/rules/<int:rule_id>", methods=["DELETE"])
+def api_delete_rule(rule_id):
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    return jsonify(deleted=write_tasks(get_repository().delete_rule, user_id, rule_id))
+
+# deletes (completes) one occurrence of a rule - recorded on the rule, the other occurrences stay
+@route("/api/rules/<int:rule_id>/occurrences/<occurrence_date>", methods=["DELETE"])
+def api_delete_occurrence(rule_id, occurrence_date):
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+    if not taskstore.parse_date(occurrence_date):
+        return api_error("Dates must be YYYY-MM-DD", 400)
+
+    return jsonify(deleted=write_tasks(get_repository().skip_occurrence, user_id, rule_id, occurrence_date))
+
+# task counts for the summary card - total, due today, overdue and one count per day from today on
+@route("/api/stats")
+def api_stats():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    stats = get_repository().get_stats(user_id, date.today().isoformat(), days=current_app.config['STATS_DAYS'])
+    return jsonify(stats)
+
+# the user's task changes after ?since=<seq>, oldest first - the page uses this to catch up after being offline
+# "reset" means changes the client missed have been pruned and it should reload the list instead
+@route("/api/tasks/changes")
+def api_task_changes():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    since = request.args.get('since', 0, type=int)
+    changes, reset = get_repository().get_changes(user_id, since, limit=current_app.config['TASKS_MAX_PAGE_SIZE'])
+    return jsonify(changes=changes, seq=changes[-1]['seq'] if changes else since, reset=reset)
+
+# the same changes as server sent events, pushed as they happen - starts after ?since= or the Last-Event-ID
+# the browser sends when it reconnects
+@route("/api/tasks/events")
+def api_task_events():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    # streams don't count against the server's request threads (serve.py passes momentum.release_slot), only
+    # against their own CHANGES_MAX_STREAMS - past it the page falls back to polling /api/tasks/changes
+    slots = changefeed.get_stream_slots()
+    if not slots.acquire(blocking=False):
+        resp = make_response(jsonify(error="Too many open streams, poll /api/tasks/changes instead"), 503)
+        resp.headers['Retry-After'] = str(math.ceil(current_app.config['CHANGES_POLL_SECONDS']))
+        return resp
+    release_slot = request.environ.get('momentum.release_slot')
+    if release_slot:
+        release_slot()
+
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+    resp = Response(changefeed.stream_for(user_id, since), mimetype='text/event-stream')
+    resp.call_on_close(slots.release)
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no' # don't let a proxy hold the events back
+    return resp
+
+# the search text and page number from the query string (?q=...&page=N)
+def get_search_args():
+    return request.args.get('q', '').strip(), max(1, request.args.get('page', 1, type=int))
+
+# full text search over the user's tasks, best match first
+@route("/search")
+def search():
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for('login'))
+
+    query, page = get_search_args()
+    tasks, has_more = get_repository().search_tasks(user_id, query, page=page, limit=get_page_size())
+    return render_template("search.html", tasks=tasks, query=query, page=page, has_more=has_more)
+
+# same search as json
+@route("/api/search")
+def api_search():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    query, page = get_search_args()
+    tasks, has_more = get_repository().search_tasks(user_id, query, page=page, limit=get_page_size())
+    return jsonify(tasks=[{'id': task['id'], 'task': task['task'], 'date': task['date']} for task in tasks],
+                   page=page, has_more=has_more)
+
+# archived tasks (oldest first, paged with the same ?after= cursor as the homepage) and the user's retention setting
+# POST sets the retention: days after a task's date before it is archived (blank for the default, 0 for never)
+@route("/archive", methods=["GET", "POST"])
+def archived_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for('login'))
+
+    if request.method == "POST":
+        days = request.form.get('days', '').strip()
+        get_repository().set_retention(user_id, int(days) if days.isdigit() else None)
+        return redirect(url_for('archived_tasks'))
+
+    after = taskstore.decode_cursor(request.args.get('after'))
+    repo = get_repository()
+    retention = repo.get_retention(user_id)
+    total = repo.count_tasks(user_id, archived=True)
+    tasks = repo.iter_tasks(user_id, after=after, limit=get_page_size(), archived=True)
+    return render_template("archive.html", tasks=tasks, total=total, is_first_page=after is None,
+                           retention=retention, default_retention=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+# streams all of the user's tasks as a download - ?format=ndjson (default) or ?format=csv
+@route("/export")
+def export_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for('login'))
+
+    fmt = transfer.detect_format(request.args.get('format'))
+    rows = get_repository().iter_user_tasks(user_id)
+    resp = Response(stream_with_context(transfer.export_rows(rows, fmt)), mimetype=transfer.FORMATS[fmt])
+    resp.headers['Content-Disposition'] = f'attachment; filename=tasks.{fmt}'
+    return resp
+
+# adds tasks from an NDJSON or CSV upload (a "file" form field, or the raw request body)
+# the upload is parsed line by line and inserted in chunks, so its size doesn't matter
+@route("/import", methods=["POST"])
+def import_tasks():
+    user_id = get_current_user_id()
+    if not user_id:
+        return api_error("Not logged in", 401)
+
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    fmt = transfer.detect_format(request.args.get('format') or request.form.get('format'),
+                                 upload.filename if upload else None)
+    lines = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    try:
+        imported, skipped = get_repository().import_rows(user_id, transfer.parse_rows(lines, fmt),
+                                                         chunk_size=current_app.config['IMPORT_CHUNK_SIZE'])
+    except UnicodeDecodeError:
+        # the chunks before the bad bytes are already stored
+        pagecache.invalidate_user(user_id)
+        changefeed.notify()
+        return api_error("The upload isn't UTF-8 text", 400)
+    pagecache.invalidate_user(user_id)
+    changefeed.notify()
+    return jsonify(imported=imported, skipped=skipped)
+
+# looks up a user's id for the command line tools
+def get_user_id_by_username(username):
+    user = get_repository().get_user(username)
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}")
+    return user['id']
+
+# `flask --app app export-tasks USERNAME [--format csv] [--output FILE]` - writes to stdout without --output
+@command('export-tasks')
+@click.argument('username')
+@click.option('--format', 'fmt', type=click.Choice(list(transfer.FORMATS)), default='ndjson')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-')
+def export_tasks_command(username, fmt, output):
+    user_id = get_user_id_by_username(username)
+    for chunk in transfer.export_rows(get_repository().iter_user_tasks(user_id), fmt):
+        output.write(chunk)
+
+# `flask --app app import-tasks USERNAME FILE [--format csv]` - the format defaults to the file extension
+@command('import-tasks')
+@click.argument('username')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(list(transfer.FORMATS)), default=None)
+def import_tasks_command(username, file, fmt):
+    user_id = get_user_id_by_username(username)
+    fmt = transfer.detect_format(fmt, file.name)
+    try:
+        imported, skipped = get_repository().import_rows(user_id, transfer.parse_rows(file, fmt),
+                                                         chunk_size=current_app.config['IMPORT_CHUNK_SIZE'])
+    except UnicodeDecodeError:
+        pagecache.invalidate_user(user_id)
+        raise click.ClickException(f"{file.name} isn't UTF-8 text (the rows before the bad bytes were imported)")
+    pagecache.invalidate_user(user_id)
+    print(f"Imported {imported} tasks ({skipped} invalid rows skipped)")
+
+# `flask --app app rebuild-stats` - recount the summary card numbers from the tasks table
+@command('rebuild-stats')
+def rebuild_stats_command():
+    users = get_repository().rebuild_stats()
+    print(f"Recounted tasks for {users} users")
+
+# prometheus metrics for this worker - request latency per route, sql statement counts/timings,
+# password hashing and the connection pool (sqlite storage only)
+@route("/metrics")
+def metrics_endpoint():
+    pool = current_app.extensions.get('db_pool')
+    gauges = {f'momentum_db_pool_{name}': (f'Connection pool {name.replace("_", " ")}', value)
+              for name, value in (pool.stats() if pool else {}).items()}
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# liveness check - the worker is up and answering; storage isn't touched, so a slow database doesn't get
+# healthy workers restarted
+@route("/healthz")
+def healthz():
+    return jsonify(status="ok")
+
+# readiness check - storage answers with a current schema and the worker isn't shutting down (see serve.py),
+# so a load balancer only sends traffic while this is 200
+@route("/readyz")
+def readyz():
+    if current_app.extensions.get('draining'):
+        return jsonify(status="draining"), 503
+    try:
+        ready = get_repository().ping()
+    except sqlite3.Error:
+        ready = False
+    return (jsonify(status="ok"), 200) if ready else (jsonify(status="unavailable"), 503)
+
+# there is no module level app, so importing this file doesn't touch tasks.db - `flask --app app` finds
+# create_app() by itself, and wsgi servers take the factory (e.g. 'app:create_app()')
+
+# runs the app.py file via port 80 with the development server - use `python serve.py` in production
 if __name__ == '__main__':
-    app.run(debug=True, port=80, host='0.0.0.0')
\ No newline at end of file
+    create_app().run(debug=True, port=80, host='0.0.0.0')
\ No newline at end of file
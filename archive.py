@@ -0,0 +1,109 @@
+import os # an archiver thread belongs to the process that started it
+import sqlite3 # errors a background pass shrugs off
+import threading # the optional background archiver
+import time # pause between chunks
+from datetime import date, timedelta
+from flask import current_app
+import storage # the archive lives in the task repository
+import pagecache # archived tasks leave the user's cached homepage
+import changefeed # ... and their open tabs
+
+# hot/cold split for tasks - tasks dated more than a user's retention age in the past move out of the live
+# tasks into the archive (for sqlite `tasks_archive`, same ids), so the homepage queries and their indexes
+# only cover live tasks
+# for sqlite the archive is a table in the same file rather than an attached database: a transaction that spans two
+# WAL databases isn't atomic if the process dies mid-commit, and a task must never end up in both or neither
+# tasks move in chunks of ARCHIVE_CHUNK_SIZE, each in its own short write transaction with a pause between
+# them, so other writers are never locked out for long
+# the delete triggers on `tasks` keep search, the change log and the summary counts in step with the move
+#   flask --app app archive-tasks              one pass over every user
+#   ARCHIVE_INTERVAL = N                       or a background pass every N seconds in each worker
+
+# the date before which a user's tasks are archived
+def cutoff_for(days, today=None):
+    return ((today or date.today()) - timedelta(days=days)).isoformat()
+
+# archive all of one user's tasks dated before `cutoff` - returns how many moved
+def archive_user(repo, user_id, cutoff, chunk_size=1000, pause=0.0):
+    moved = 0
+    while True:
+        count, done = repo.archive_chunk(user_id, cutoff, chunk_size)
+        moved += count
+        if done:
+            return moved
+        time.sleep(pause) # let waiting writers in between chunks
+
+# one pass over every user with their own retention (0 turns archiving off for that user)
+# returns {user_id: moved} for the users that had tasks to move
+def archive_all(repo, default_days, chunk_size=1000, pause=0.0, today=None):
+    moved = {}
+    for user_id, days in repo.list_retention(default_days):
+        if days and days > 0:
+            count = archive_user(repo, user_id, cutoff_for(days, today), chunk_size, pause)
+            if count:
+                moved[user_id] = count
+    return moved
+
+# run one archiving pass for the app, and drop the moved users' cached pages - in this process; a running server
+# sees the moves through the change log seq in its homepage ETag (see home() in app.py)
+def run(app=None):
+    app = app or current_app._get_current_object()
+    with app.app_context():
+        moved = archive_all(storage.get_repository(app), app.config['ARCHIVE_AFTER_DAYS'],
+                            chunk_size=app.config['ARCHIVE_CHUNK_SIZE'], pause=app.config['ARCHIVE_PAUSE'])
+        for user_id in moved:
+            pagecache.invalidate_user(user_id)
+    if moved:
+        changefeed.notify()
+    return moved
+
+# background pass every `interval` seconds - errors are dropped, the next pass tries again
+class Archiver:
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.pid = os.getpid()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='momentum-archiver', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                run(self.app)
+            except sqlite3.Error:
+                pass
+
+_start_lock = threading.Lock()
+
+# start the background archiver for this process if ARCHIVE_INTERVAL asks for one (checked before requests)
+def ensure_started(app=None):
+    app = app or current_app
+    if not app.config['ARCHIVE_INTERVAL']:
+        return None
+    with _start_lock:
+        archiver = app.extensions.get('archiver')
+        if archiver is None or archiver.pid != os.getpid():
+            archiver = app.extensions['archiver'] = Archiver(app, app.config['ARCHIVE_INTERVAL'])
+    return archiver
+
+# wire archive settings, the background archiver and the archive command into an app
+def init_app(app):
+    app.config.setdefault('ARCHIVE_AFTER_DAYS', 90) # tasks dated longer ago than this are archived (0 = never)
+    app.config.setdefault('ARCHIVE_CHUNK_SIZE', 1000) # tasks moved per write transaction
+    app.config.setdefault('ARCHIVE_PAUSE', 0.05) # seconds between chunks, so other writes get the lock
+    app.config.setdefault('ARCHIVE_INTERVAL', 0) # seconds between background passes in each worker (0 = off)
+
+    @app.before_request
+    def start_archiver():
+        ensure_started(app)
+
+    # `flask --app app archive-tasks` - run it from cron when the background archiver is off
+    @app.cli.command('archive-tasks')
+    def archive_tasks_command():
+        moved = run(app)
+        print(f"Archived {sum(moved.values())} tasks for {len(moved)} users")
@@ -0,0 +1,190 @@
+import gzip # pre-compressed copies of every asset
+import hashlib # content hash in the file names
+import json # the manifest
+import mimetypes # content type of the original file when a compressed copy is sent
+import os
+import re # rewrites url(...) references and finds the icons the templates use
+import urllib.request # downloads the vendored files
+import click # build-assets errors
+from flask import current_app, request, send_from_directory, url_for, abort
+
+try:
+    import brotli # optional - without it only gzip copies are built
+except ImportError:
+    brotli = None
+
+# self hosted static assets
+#   flask --app app vendor-assets   downloads bootstrap and font awesome into static/vendor (commit the result)
+#   flask --app app build-assets    copies static/src + static/vendor into static/dist with content hashed names,
+#                                   writes .gz (and .br) copies next to them and a manifest.json
+# templates use asset_url('name') - it resolves to the hashed file served from /assets/ with a one year
+# immutable cache header, or to the unbuilt file under static/ when the assets haven't been built
+# build-assets refuses to run without the vendored files; until they are vendored, pages load them from the CDNs
+# (ASSETS_CDN_FALLBACK, on by default) and the fallback is logged once per asset
+
+VENDOR = {
+    'bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+    'fontawesome.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'fa-solid-900.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.woff2',
+}
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+URL_REFERENCE = re.compile(r'url\(\s*[\'"]?(?:[^\'")]*/)?([^/\'")?#]+)([?#][^\'")]*)?[\'"]?\s*\)')
+
+# the icon names (fa-trash, fa-sun, ...) used in the given files
+def used_icons(paths):
+    icons = set()
+    for path in paths:
+        with open(path, encoding='utf-8') as source:
+            icons.update(re.findall(r'\bfa-[a-z0-9-]+', source.read()))
+    return icons
+
+# drop the font awesome rules for icons nobody uses - the icon rules are the bulk of the file
+# (a rule is kept unless every one of its selectors is an unused .fa-<icon>:before)
+def subset_fontawesome(css, icons):
+    def keep(match):
+        selectors = [selector.strip() for selector in match.group(1).split(',')]
+        unused = [selector for selector in selectors
+                  if re.fullmatch(r'\.(fa-[a-z0-9-]+)::?before', selector)
+                  and re.fullmatch(r'\.(fa-[a-z0-9-]+)::?before', selector).group(1) not in icons]
+        return '' if len(unused) == len(selectors) else match.group(0)
+    return re.sub(r'([^{}]+)\{[^{}]*\}', keep, css)
+
+# download the vendored files into `directory`
+def vendor(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, url in VENDOR.items():
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        with open(os.path.join(directory, name), 'wb') as output:
+            output.write(data)
+        print(f"{name}: {len(data)} bytes")
+
+def _write(path, data):
+    with open(path, 'wb') as output:
+        output.write(data)
+
+# the VENDOR files that aren't in any of the source directories
+def missing_vendor(sources):
+    return [name for name in VENDOR
+            if not any(os.path.isfile(os.path.join(directory, name)) for directory in sources)]
+
+# write name.<hash>.ext (plus compressed copies) to dist - returns the hashed name
+def _emit(dist, name, data):
+    stem, ext = os.path.splitext(name)
+    hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+    _write(os.path.join(dist, hashed), data)
+    if ext in COMPRESSIBLE:
+        _write(os.path.join(dist, hashed + '.gz'), gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(os.path.join(dist, hashed + '.br'), brotli.compress(data, quality=11))
+    return hashed
+
+# fingerprint and pre-compress every file from the source directories into dist and write the manifest
+# fonts and images go first, so the css url(...) references to them can be rewritten to their hashed names
+def build(sources, dist, icons=()):
+    os.makedirs(dist, exist_ok=True)
+    files = {}
+    for directory in sources:
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                files[name] = os.path.join(directory, name)
+
+    manifest = {}
+    for name in sorted(files, key=lambda name: name.endswith('.css')):
+        with open(files[name], 'rb') as source:
+            data = source.read()
+        if name.endswith('.css'):
+            css = data.decode('utf-8')
+            if name == 'fontawesome.min.css':
+                css = subset_fontawesome(css, set(icons))
+            # point url(...) at the hashed files in the same directory (references to files we don't ship are left alone)
+            css = URL_REFERENCE.sub(lambda match: f'url({manifest[match.group(1)]})' if match.group(1) in manifest
+                                    else match.group(0), css)
+            data = css.encode('utf-8')
+        manifest[name] = _emit(dist, name, data)
+
+    _write(os.path.join(dist, 'manifest.json'), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+# logical name -> hashed name, read once per process (empty when the assets haven't been built)
+def get_manifest():
+    manifest = current_app.extensions.get('assets_manifest')
+    if manifest is None:
+        try:
+            with open(os.path.join(current_app.config['ASSETS_DIST'], 'manifest.json')) as source:
+                manifest = json.load(source)
+        except (OSError, ValueError):
+            manifest = {}
+        current_app.extensions['assets_manifest'] = manifest
+    return manifest
+
+# template helper - the url for a logical asset name
+def asset_url(name):
+    hashed = get_manifest().get(name)
+    if hashed:
+        return url_for('asset', filename=hashed)
+    # not built yet - the source file itself, when it is under static/
+    static = current_app.static_folder
+    for directory in current_app.config['ASSETS_SOURCES']:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.path.commonpath([static, path]) == static:
+            return url_for('static', filename=os.path.relpath(path, static).replace(os.sep, '/'))
+    missing = current_app.extensions.setdefault('assets_missing', set())
+    if name not in missing:
+        missing.add(name)
+        current_app.logger.warning("asset %s isn't built or vendored - run `flask --app app vendor-assets` "
+                                   "and `flask --app app build-assets`", name)
+    if name in VENDOR and current_app.config['ASSETS_CDN_FALLBACK']:
+        return VENDOR[name]
+    return url_for('static', filename=f'src/{name}')
+
+# serves hashed files, picking a pre-compressed copy the browser accepts
+def serve(filename):
+    dist = current_app.config['ASSETS_DIST']
+    if filename.endswith(('.gz', '.br')) or not os.path.isfile(os.path.join(dist, filename)):
+        abort(404)
+
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.isfile(os.path.join(dist, filename + suffix)):
+            resp = send_from_directory(dist, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+            resp.headers['Content-Encoding'] = encoding
+            break
+    else:
+        resp = send_from_directory(dist, filename)
+    # the name changes whenever the content does, so browsers never need to ask again
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+# wire the asset helper, route and commands into an app
+def init_app(app):
+    static = os.path.join(app.root_path, 'static')
+    app.config.setdefault('ASSETS_SOURCES', [os.path.join(static, 'src'), os.path.join(static, 'vendor')])
+    app.config.setdefault('ASSETS_DIST', os.path.join(static, 'dist'))
+    app.config.setdefault('ASSETS_CDN_FALLBACK', True) # load unvendored bootstrap/font awesome from their CDNs
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.add_url_rule('/assets/<path:filename>', 'asset', serve)
+
+    # `flask --app app vendor-assets`
+    @app.cli.command('vendor-assets')
+    def vendor_assets_command():
+        vendor(app.config['ASSETS_SOURCES'][-1])
+
+    # `flask --app app build-assets`
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        missing = missing_vendor(app.config['ASSETS_SOURCES'])
+        if missing:
+            raise click.ClickException(f"missing vendored files: {', '.join(missing)} - "
+                                       f"run `flask --app app vendor-assets` and commit static/vendor")
+        # icons can appear in the templates and in the app's own modules (e.g. the weather icons)
+        templates = os.path.join(app.root_path, app.template_folder)
+        paths = [os.path.join(templates, name) for name in os.listdir(templates) if name.endswith('.html')]
+        paths += [os.path.join(app.root_path, name) for name in os.listdir(app.root_path) if name.endswith('.py')]
+        icons = used_icons(paths)
+        manifest = build(app.config['ASSETS_SOURCES'], app.config['ASSETS_DIST'], icons)
+        for name, hashed in manifest.items():
+            print(f"{name} -> {hashed}")
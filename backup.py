@@ -0,0 +1,281 @@
+import gzip # snapshot files are compressed
+import hashlib # ... and checksummed
+import json # the snapshot manifest
+import os
+import shutil # removing snapshots past their retention
+import sqlite3
+import tempfile # snapshots are unpacked next to the backups before they are used
+import time # pauses between copy steps, and the age of abandoned partial snapshots
+from datetime import datetime, timezone
+import click # command line options
+from flask import current_app
+import storage # which database files to copy
+import migrations # schema version in the manifest, and migrating a restored database
+import taskstore # the change log starts over after a restore
+import transfer # exporting one user from a snapshot
+
+# online snapshots of the sqlite databases (every shard file with 'sqlite-sharded'), taken with sqlite's
+# backup api while the app keeps serving
+#   flask --app app backup                         take a snapshot and drop the ones past BACKUP_KEEP - run it from cron
+#   flask --app app list-backups
+#   flask --app app restore-backup NAME            put a snapshot back
+#   flask --app app export-backup NAME USERNAME    one user's tasks from a snapshot, without restoring it
+# the copy runs inside a read transaction on every file, started together, so it is one consistent snapshot
+# and the backup never restarts when a write lands between its steps - in WAL mode a reader blocks no writer
+# (the WAL just can't be checkpointed past it until the copy is done), so requests don't notice it
+# it copies BACKUP_PAGES pages per step with BACKUP_PAUSE seconds between steps, to leave the disk to the app
+# a snapshot is a directory in BACKUP_DIR named after its UTC time, holding each database gzipped and a
+# manifest with their sha256; it is written as NAME.partial and renamed once complete
+
+MANIFEST = 'manifest.json'
+
+class CorruptBackup(Exception):
+    pass
+
+def _connect(database):
+    return sqlite3.connect(database, uri=True, isolation_level=None)
+
+# copy one open database to `path`, BACKUP_PAGES pages at a time with a `pause` after every step but the last
+# (backup()'s own sleep= only applies when a step finds the database busy, so the pause is taken in progress)
+def _copy(source, path, pages, pause):
+    def progress(status, remaining, total):
+        if remaining and pause:
+            time.sleep(pause)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target, pages=pages, progress=progress)
+        target.execute('PRAGMA journal_mode=DELETE') # a self-contained file, without a -wal next to it
+    finally:
+        target.close()
+
+# check a copy and gzip it - returns its manifest entry
+def _pack(path, compresslevel):
+    target = sqlite3.connect(path)
+    try:
+        if target.execute('PRAGMA quick_check').fetchone()[0] != 'ok':
+            raise CorruptBackup(f"the copy of {os.path.basename(path)} failed its integrity check")
+    finally:
+        target.close()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as raw, gzip.open(path + '.gz', 'wb', compresslevel=compresslevel) as packed:
+        for block in iter(lambda: raw.read(1 << 20), b''):
+            digest.update(block)
+            packed.write(block)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return {'file': os.path.basename(path) + '.gz', 'sha256': digest.hexdigest(), 'bytes': size}
+
+# take a snapshot of the app's databases into `directory` - returns its name
+def snapshot(app, directory, pages=1024, pause=0.01, compresslevel=6, now=None):
+    now = now or datetime.now(timezone.utc)
+    with app.app_context():
+        repo = storage.get_repository(app)
+        databases = repo.databases()
+        shards = getattr(repo, 'shards', [])
+    if not databases:
+        raise ValueError(f"STORAGE = {app.config['STORAGE']!r} has no database files to back up")
+    name = now.strftime('%Y%m%dT%H%M%SZ')
+    work = os.path.join(directory, name + '.partial')
+    os.makedirs(work)
+    try:
+        sources = [_connect(database) for database in databases]
+        try:
+            for source in sources: # the read snapshot starts with the first read, so read from every file
+                source.execute('BEGIN')
+                source.execute('SELECT 1 FROM sqlite_master LIMIT 1')
+            version = migrations.get_version(sources[0])
+            for n, source in enumerate(sources):
+                _copy(source, os.path.join(work, f'{n}.db'), pages, pause)
+            # the WAL couldn't be checkpointed past the snapshot while it was open - catch up here, rather
+            # than in whichever request commits next
+            for source in sources:
+                source.execute('COMMIT')
+                source.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        finally:
+            for source in sources:
+                source.close()
+        files = []
+        for n, database in enumerate(databases):
+            entry = _pack(os.path.join(work, f'{n}.db'), compresslevel)
+            entry['database'] = database
+            entry['shard'] = shards.index(database) if database in shards else None
+            files.append(entry)
+        manifest = {'name': name, 'created': now.isoformat(), 'storage': app.config['STORAGE'],
+                    'schema_version': version, 'files': files}
+        with open(os.path.join(work, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(work, os.path.join(directory, name))
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    return name
+
+def read_manifest(directory, name):
+    try:
+        with open(os.path.join(directory, name, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"No snapshot named {name!r} in {directory}")
+
+# the complete snapshots in `directory`, oldest first
+def list_snapshots(directory):
+    if not os.path.isdir(directory):
+        return []
+    return [read_manifest(directory, name) for name in sorted(os.listdir(directory))
+            if os.path.isfile(os.path.join(directory, name, MANIFEST))]
+
+# the snapshots to keep - `created` is {name: datetime}, `keep` is how many of the newest to keep outright
+# ('last') and for how many days, weeks and months to keep the newest snapshot of each
+def plan_retention(created, keep):
+    newest_first = sorted(created, key=created.get, reverse=True)
+    kept = set(newest_first[:keep.get('last', 0)])
+    periods = {
+        'daily': lambda when: when.date(),
+        'weekly': lambda when: when.isocalendar()[:2],
+        'monthly': lambda when: (when.year, when.month),
+    }
+    for period, key in periods.items():
+        seen = set()
+        for name in newest_first:
+            if len(seen) >= keep.get(period, 0):
+                break
+            if key(created[name]) not in seen:
+                seen.add(key(created[name]))
+                kept.add(name)
+    return kept
+
+# delete the snapshots past their retention, and partial ones a crashed backup left over a day ago
+# returns the names removed
+def prune(directory, keep):
+    created = {manifest['name']: datetime.fromisoformat(manifest['created'])
+               for manifest in list_snapshots(directory)}
+    kept = plan_retention(created, keep)
+    removed = sorted(set(created) - kept)
+    for name in removed:
+        shutil.rmtree(os.path.join(directory, name))
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.partial') and time.time() - os.path.getmtime(path) > 86400:
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+# unpack one file of a snapshot into `work`, checking it against the manifest - returns its path
+def _unpack(directory, name, entry, work):
+    path = os.path.join(work, entry['file'][:-len('.gz')])
+    digest = hashlib.sha256()
+    try:
+        with gzip.open(os.path.join(directory, name, entry['file']), 'rb') as packed, open(path, 'wb') as raw:
+            for block in iter(lambda: packed.read(1 << 20), b''):
+                digest.update(block)
+                raw.write(block)
+    except (OSError, EOFError) as e:
+        raise CorruptBackup(f"{entry['file']} in {name} can't be read: {e}")
+    if digest.hexdigest() != entry['sha256']:
+        raise CorruptBackup(f"{entry['file']} in {name} doesn't match its checksum")
+    return path
+
+# put a snapshot back over the app's databases - every file is unpacked and checked before any is written,
+# each is then replaced in one write transaction (readers keep their old view until it commits), migrated
+# up to the current schema, and its change log started over
+# other workers' in-memory page caches still hold pages from before, so reload the server afterwards
+def restore(app, directory, name):
+    manifest = read_manifest(directory, name)
+    with app.app_context():
+        databases = storage.get_repository(app).databases()
+    if len(manifest['files']) != len(databases):
+        raise ValueError(f"{name} has {len(manifest['files'])} database files, the app has {len(databases)}")
+    with tempfile.TemporaryDirectory(dir=directory) as work:
+        copies = [_unpack(directory, name, entry, work) for entry in manifest['files']]
+        for copy, database in zip(copies, databases):
+            source, target = sqlite3.connect(copy), _connect(database)
+            try:
+                last_seq = taskstore.get_sequence(target, 'task_changes') if migrations.get_version(target) else 0
+                source.backup(target)
+                migrations.migrate(target)
+                with target:
+                    target.execute('BEGIN IMMEDIATE')
+                    taskstore.restart_changes(target, last_seq)
+            finally:
+                source.close()
+                target.close()
+    return manifest
+
+# one user's live tasks from a snapshot, as export chunks (see transfer.py) - the snapshot is only unpacked
+# into a temporary directory
+def export_user(directory, name, username, fmt='ndjson'):
+    manifest = read_manifest(directory, name)
+    with tempfile.TemporaryDirectory(dir=directory) as work:
+        conn = sqlite3.connect(_unpack(directory, name, manifest['files'][0], work))
+        conn.row_factory = sqlite3.Row
+        try:
+            user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+            if user is None:
+                raise ValueError(f"No user named {username!r} in {name}")
+            entry = manifest['files'][0]
+            if manifest['storage'] == 'sqlite-sharded':
+                shard = taskstore.get_shard(conn, user['id']) or 0
+                entry = next(entry for entry in manifest['files'] if entry['shard'] == shard)
+                if entry is not manifest['files'][0]:
+                    conn.close()
+                    conn = sqlite3.connect(_unpack(directory, name, entry, work))
+                    conn.row_factory = sqlite3.Row
+            yield from transfer.export_rows(transfer.iter_user_tasks(conn, user['id']), fmt)
+        finally:
+            conn.close()
+
+# take a snapshot with the app's settings, then prune - returns (name, removed)
+def run(app=None):
+    app = app or current_app._get_current_object()
+    directory = app.config['BACKUP_DIR']
+    os.makedirs(directory, exist_ok=True)
+    name = snapshot(app, directory, pages=app.config['BACKUP_PAGES'], pause=app.config['BACKUP_PAUSE'],
+                    compresslevel=app.config['BACKUP_COMPRESSLEVEL'])
+    return name, prune(directory, app.config['BACKUP_KEEP'])
+
+# wire backup settings and commands into an app
+def init_app(app):
+    app.config.setdefault('BACKUP_DIR', 'backups')
+    app.config.setdefault('BACKUP_PAGES', 1024) # pages copied per step
+    app.config.setdefault('BACKUP_PAUSE', 0.01) # seconds between steps
+    app.config.setdefault('BACKUP_COMPRESSLEVEL', 6) # gzip level, 1 (fast) to 9 (small)
+    app.config.setdefault('BACKUP_KEEP', {'last': 4, 'daily': 7, 'weekly': 4, 'monthly': 12})
+
+    # `flask --app app backup` - run it from cron
+    @app.cli.command('backup')
+    def backup_command():
+        try:
+            name, removed = run(app)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        print(f"wrote {os.path.join(app.config['BACKUP_DIR'], name)}, removed {len(removed)} old snapshots")
+
+    # `flask --app app list-backups`
+    @app.cli.command('list-backups')
+    def list_backups_command():
+        for manifest in list_snapshots(app.config['BACKUP_DIR']):
+            size = sum(entry['bytes'] for entry in manifest['files'])
+            print(f"{manifest['name']}  {manifest['storage']}  {len(manifest['files'])} files  {size} bytes")
+
+    # `flask --app app restore-backup NAME`
+    @app.cli.command('restore-backup')
+    @click.argument('name')
+    @click.confirmation_option(prompt="This replaces the live databases - continue?")
+    def restore_backup_command(name):
+        try:
+            restore(app, app.config['BACKUP_DIR'], name)
+        except (ValueError, CorruptBackup) as e:
+            raise click.ClickException(str(e))
+        print(f"restored {name} - reload the server (kill -HUP) so every worker drops its cached pages")
+
+    # `flask --app app export-backup NAME USERNAME [--format csv] [--output FILE]`
+    @app.cli.command('export-backup')
+    @click.argument('name')
+    @click.argument('username')
+    @click.option('--format', 'fmt', type=click.Choice(list(transfer.FORMATS)), default='ndjson')
+    @click.option('--output', type=click.File('w', encoding='utf-8'), default='-')
+    def export_backup_command(name, username, fmt, output):
+        try:
+            for chunk in export_user(app.config['BACKUP_DIR'], name, username, fmt):
+                output.write(chunk)
+        except (ValueError, CorruptBackup) as e:
+            raise click.ClickException(str(e))
@@ -0,0 +1,261 @@
+import argparse # command line options
+import http.client # keep-alive http client for the server mode
+import json # request bodies and the results file
+import os # environment for the app under test
+import platform # recorded with the results
+import socket # finds a free port for the server
+import sqlite3 # version recorded with the results
+import statistics # percentiles
+import subprocess # starts the local server
+import sys
+import tempfile # scratch database location
+import threading # one client per worker thread
+import time # latency measurement
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.cookies import SimpleCookie # cookie header for the server mode
+from urllib.parse import urlencode
+from werkzeug.security import generate_password_hash
+from app import create_app
+import storage # seeds the store through the task repository
+
+# load test and benchmark harness for momentum's request paths
+# seeds a scratch store, runs each scenario in-process (flask test client) and/or against a locally
+# started server with concurrent clients, and writes p50/p95/p99 latency and requests per second to json
+#
+#   python benchmark.py --users 50 --tasks 200 --list-sizes 10 1000 10000 --output bench.json
+#   python benchmark.py --mode server --concurrency 16 --requests 2000
+#   python benchmark.py --mode inprocess --storage memory     storage layer cost vs. the sqlite backends
+
+BENCH_PASSWORD = 'benchpassword'
+CHURN_DATE = '2099-12-31' # churn tasks are dated after everything else, so they are easy to find again
+
+# fill the app's store: `users` regular users with `tasks` tasks each, one user per list size for the home
+# scenarios, and one churn/clear user per worker so concurrent workers don't trip over each other's tasks
+def seed(flask_app, users, tasks, list_sizes, workers):
+    password = generate_password_hash(BENCH_PASSWORD) # one hash shared by everyone - seeding stays fast
+    start = date(2025, 1, 1)
+
+    with flask_app.app_context():
+        repo = storage.get_repository(flask_app)
+
+        def add_user(username, task_count):
+            user_id = repo.create_user(username, password)
+            repo.insert_tasks(user_id, [(f'Task {n}', (start + timedelta(days=n % 365)).isoformat())
+                                        for n in range(task_count)])
+            return {'id': user_id, 'username': username}
+
+        return {
+            'users': [add_user(f'bench_user_{n}', tasks) for n in range(users)],
+            'lists': {size: add_user(f'bench_list_{size}', size) for size in list_sizes},
+            'workers': [add_user(f'bench_worker_{n}', 0) for n in range(workers)],
+        }
+
+# the two ways of talking to the app - both return (status, body) and send the login cookies of `user`
+class InProcessClient:
+    def __init__(self, flask_app):
+        self._client = flask_app.test_client()
+
+    def request(self, method, path, user=None, data=None):
+        if user:
+            self._client.set_cookie('user_id', str(user['id']))
+            self._client.set_cookie('username', user['username'])
+        response = self._client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+class HttpClient:
+    def __init__(self, port):
+        self._conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+    def request(self, method, path, user=None, data=None):
+        headers = {}
+        body = None
+        if user:
+            cookie = SimpleCookie({'user_id': str(user['id']), 'username': user['username']})
+            headers['Cookie'] = '; '.join(f'{key}={morsel.coded_value}' for key, morsel in cookie.items())
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self._conn.request(method, path, body=body, headers=headers)
+        response = self._conn.getresponse()
+        return response.status, response.read()
+
+def expect(result, *statuses):
+    if result[0] not in statuses:
+        raise RuntimeError(f"unexpected status {result[0]}")
+    return result
+
+# scenarios - each call performs one timed operation; `setup` (if given) runs untimed before it
+def login_storm(client, dataset, worker, n):
+    user = dataset['users'][n % len(dataset['users'])]
+    expect(client.request('POST', '/login', data={'username': user['username'], 'password': BENCH_PASSWORD}), 302)
+
+def home_listing(size):
+    def scenario(client, dataset, worker, n):
+        expect(client.request('GET', '/home', user=dataset['lists'][size]), 200)
+    return scenario
+
+# add a task through the form, find it through the api and delete it through the form
+def churn(client, dataset, worker, n):
+    user = dataset['workers'][worker]
+    expect(client.request('POST', '/home', user=user, data={'task': f'Churn {n}', 'date': CHURN_DATE}), 302)
+    _, body = expect(client.request('GET', f'/api/tasks?from={CHURN_DATE}&limit=1', user=user), 200)
+    task_id = json.loads(body)['tasks'][0]['id']
+    expect(client.request('POST', f'/delete_task/{task_id}', user=user), 302)
+
+def clear_setup(flask_app, size):
+    def setup(dataset, worker):
+        with flask_app.app_context():
+            storage.get_repository(flask_app).insert_tasks(
+                dataset['workers'][worker]['id'], [(f'Clear {n}', '2025-01-01') for n in range(size)])
+    return setup
+
+def clear(client, dataset, worker, n):
+    expect(client.request('POST', '/clear', user=dataset['workers'][worker]), 302)
+
+# latency summary in milliseconds
+def summarize(latencies, errors, wall):
+    latencies = sorted(latencies)
+    result = {'requests': len(latencies), 'errors': errors, 'seconds': round(wall, 3),
+              'rps': round(len(latencies) / wall, 1) if wall else 0.0}
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+        result.update(p50=cuts[49], p95=cuts[94], p99=cuts[98], mean=statistics.fmean(latencies))
+    elif latencies:
+        result.update(p50=latencies[0], p95=latencies[0], p99=latencies[0], mean=latencies[0])
+    return {key: round(value * 1000, 3) if key in ('p50', 'p95', 'p99', 'mean') else value
+            for key, value in result.items()}
+
+# run `requests` operations of a scenario spread over `concurrency` worker threads, each with its own client
+def run_scenario(scenario, setup, make_client, dataset, requests, concurrency):
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = 0
+
+    def worker(index):
+        nonlocal errors
+        client = make_client()
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                break
+            if setup:
+                setup(dataset, index)
+            start = time.perf_counter()
+            try:
+                scenario(client, dataset, index, n)
+                mine.append(time.perf_counter() - start)
+            except Exception:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors += failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# start the app as a separate process on a free port and wait until it answers
+def start_server(env):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port),
+                               '--with-threads', '--no-debugger', '--no-reload'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            HttpClient(port).request('GET', '/login')
+            return server, port
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark momentum's request paths")
+    parser.add_argument('--users', type=int, default=20, help="regular users to seed (login storm)")
+    parser.add_argument('--tasks', type=int, default=100, help="tasks per regular user")
+    parser.add_argument('--list-sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help="task list sizes for the home listing scenarios")
+    parser.add_argument('--clear-size', type=int, default=100, help="tasks deleted by each clear")
+    parser.add_argument('--requests', type=int, default=200, help="operations per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients in server mode")
+    parser.add_argument('--mode', choices=['inprocess', 'server', 'both'], default='both')
+    parser.add_argument('--scenarios', nargs='+', help="only run these scenarios")
+    parser.add_argument('--page-cache', action='store_true', help="leave the homepage cache on")
+    parser.add_argument('--storage', choices=sorted(storage.BACKENDS), default='sqlite',
+                        help="storage backend (the in-memory ones only work in-process)")
+    parser.add_argument('--database', help="scratch database path (default: a temporary file)")
+    parser.add_argument('--output', default='bench_output.json', help="where to write the json results")
+    args = parser.parse_args(argv)
+
+    if args.storage in ('sqlite-memory', 'memory') and args.mode != 'inprocess':
+        parser.error("--storage sqlite-memory/memory only works with --mode inprocess")
+
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix='momentum-bench-'), 'bench.db')
+    # rate limits are off - login_storm would otherwise mostly measure 429s
+    env = dict(os.environ, MOMENTUM_DATABASE=database, MOMENTUM_WEATHER_PROVIDER='fake', MOMENTUM_STORAGE=args.storage,
+               MOMENTUM_PAGE_CACHE_ENABLED='true' if args.page_cache else 'false', MOMENTUM_RATE_LIMIT_ENABLED='false')
+    flask_app = create_app({'DATABASE': database, 'WEATHER_PROVIDER': 'fake', 'PAGE_CACHE_ENABLED': args.page_cache,
+                            'STORAGE': args.storage, 'RATE_LIMIT_ENABLED': False})
+    workers = max(args.concurrency, 1)
+    dataset = seed(flask_app, args.users, args.tasks, args.list_sizes, workers)
+
+    scenarios = {'login_storm': (login_storm, None)}
+    for size in args.list_sizes:
+        scenarios[f'home_{size}'] = (home_listing(size), None)
+    scenarios['add_delete_churn'] = (churn, None)
+    scenarios['clear'] = (clear, clear_setup(flask_app, args.clear_size))
+    if args.scenarios:
+        scenarios = {name: scenarios[name] for name in args.scenarios}
+
+    results = {}
+    if args.mode in ('inprocess', 'both'):
+        results['inprocess'] = {name: run_scenario(scenario, setup, lambda: InProcessClient(flask_app), dataset,
+                                                   args.requests, 1)
+                                for name, (scenario, setup) in scenarios.items()}
+    if args.mode in ('server', 'both'):
+        server, port = start_server(env)
+        try:
+            results['server'] = {name: run_scenario(scenario, setup, lambda: HttpClient(port), dataset,
+                                                    args.requests, args.concurrency)
+                                 for name, (scenario, setup) in scenarios.items()}
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': git_revision(),
+                 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                 'machine': platform.machine(), 'cpus': os.cpu_count(), 'args': vars(args)},
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    for mode, scenario_results in results.items():
+        print(f"\n{mode}")
+        print(f"{'scenario':<20}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for name, result in scenario_results.items():
+            print(f"{name:<20}{result['rps']:>10}{result.get('p50', '-'):>10}{result.get('p95', '-'):>10}"
+                  f"{result.get('p99', '-'):>10}{result['errors']:>8}")
+    print(f"\nresults written to {args.output}")
+
+if __name__ == '__main__':
+    main()
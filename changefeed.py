@@ -0,0 +1,83 @@
+import json # event payloads
+import threading # wakes the event streams when this process writes
+import time # stream lifetime and keep-alives
+from flask import current_app
+import storage # the change log lives in the task repository
+
+# per user change feed so every open tab stays in sync without reloading
+# the repository's change log (for sqlite the task_changes table, migration 5) gets an entry with a global,
+# increasing `seq` for every task added or deleted and one per clear; a client remembers the last seq it has seen and asks for what came after it,
+# either with /api/tasks/changes?since=<seq> or by keeping /api/tasks/events (server sent events) open
+# streams in this process are woken straight away by notify(); writes from other processes are picked up by
+# polling every CHANGES_POLL_SECONDS
+
+_changed = threading.Condition()
+_generation = 0 # bumped by notify() so waiters can tell they were woken
+
+# tell the streams in this process that something was written
+def notify():
+    global _generation
+    with _changed:
+        _generation += 1
+        _changed.notify_all()
+
+def _wait(generation, timeout):
+    with _changed:
+        _changed.wait_for(lambda: _generation != generation, timeout)
+        return _generation
+
+def _event(change):
+    return f"id: {change['seq']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+
+# server sent events for one user, starting after `since`
+# each poll runs in its own app context, so the stream only holds a pooled connection while it reads, and it
+# ends after `lifetime` seconds (the browser reconnects on its own, sending Last-Event-ID), so a tab left open
+# doesn't hold a worker thread forever
+def event_stream(app, user_id, since, poll=2.0, lifetime=300.0):
+    deadline = time.monotonic() + lifetime
+    generation = _generation
+    yield 'retry: 2000\n\n'
+    while True:
+        with app.app_context():
+            changes, reset = storage.get_repository(app).get_changes(user_id, since)
+        if reset:
+            yield 'event: reset\ndata: {}\n\n'
+            return
+        for change in changes:
+            yield _event(change)
+            since = change['seq']
+        if not changes:
+            yield ': keep-alive\n\n'
+        if time.monotonic() >= deadline:
+            return
+        generation = _wait(generation, min(poll, max(deadline - time.monotonic(), 0)))
+
+# the streams one process keeps open - every stream holds a thread until it ends, so streams have their own budget
+# of CHANGES_MAX_STREAMS instead of taking the threads requests are answered on (see serve.py); a stream that
+# doesn't fit is refused and the page polls /api/tasks/changes instead
+def get_stream_slots(app=None):
+    app = app or current_app
+    slots = app.extensions.get('change_streams')
+    if slots is None:
+        slots = threading.BoundedSemaphore(app.config['CHANGES_MAX_STREAMS'])
+        app.extensions['change_streams'] = slots
+    return slots
+
+# the settings a stream needs, read while the request's app context is still around
+def stream_for(user_id, since, app=None):
+    app = app or current_app._get_current_object()
+    return event_stream(app, user_id, since, poll=app.config['CHANGES_POLL_SECONDS'],
+                        lifetime=app.config['CHANGES_STREAM_SECONDS'])
+
+# wire change feed settings and the prune command into an app
+def init_app(app):
+    app.config.setdefault('CHANGES_POLL_SECONDS', 2.0) # how often a stream checks for writes from other processes
+    app.config.setdefault('CHANGES_STREAM_SECONDS', 300.0) # an event stream ends (and the browser reconnects) after this
+    app.config.setdefault('CHANGES_MAX_STREAMS', 64) # event streams open at once in one process
+    app.config.setdefault('CHANGES_RETENTION_DAYS', 7) # `flask prune-changes` drops entries older than this
+
+    # `flask --app app prune-changes` - run it from cron
+    @app.cli.command('prune-changes')
+    def prune_changes_command():
+        removed = storage.get_repository(app).prune_changes(app.config['CHANGES_RETENTION_DAYS'])
+        print(f"removed {removed} change log entries")
@@ -1,28 +1,11 @@
 import sqlite3
+from migrations import migrate
 
 # Connect to SQLite database (or create it if it doesn't exist)
 conn = sqlite3.connect("tasks.db")
-cursor = conn.cursor()
 
-# Users table (as expected in app.py)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL
-);
-''')
+# Create the tables and indexes (the schema lives in migrations.py, shared with app.py)
+applied = migrate(conn)
+print(f"Applied migrations: {applied}" if applied else "Database already up to date")
 
-# Tasks table (with optional date)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS tasks (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    task TEXT NOT NULL,
-    date TEXT NOT NULL,
-    user_id INTEGER,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-);
-''')
-
-conn.commit()
 conn.close()
@@ -0,0 +1,210 @@
+import logging # slow query log
+import random # statement timing is sampled
+import sqlite3 # sqlite connections handed out by the pool
+import threading # guards the pool when several threads share one worker
+import time # statement timing
+from flask import g, current_app, has_app_context # per-request storage for the connection
+import metrics # statement counts and timings for /metrics
+
+# pragmas applied to every new connection - override any of these with the DB_PRAGMAS config key
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL', # readers don't block the writer and the writer doesn't block readers
+    'synchronous': 'NORMAL', # safe with WAL and skips an fsync on every commit
+    'busy_timeout': 5000, # wait up to 5 seconds for the write lock instead of raising "database is locked"
+    'cache_size': -16000, # negative means KiB, so roughly 16MB of page cache per connection
+    'mmap_size': 134217728, # memory map the first 128MB of the database file
+    'temp_store': 'MEMORY', # keep temp tables and sort spills out of the filesystem
+}
+
+SQL_STATEMENTS = metrics.Counter('momentum_sql_statements_total', 'SQL statements executed',
+                                 labelnames=('statement',))
+SQL_SECONDS = metrics.Histogram('momentum_sql_statement_seconds', 'Time to execute SQL statements (sampled)',
+                                labelnames=('statement',))
+slow_query_log = logging.getLogger('momentum.sql')
+
+# statement label - the leading keyword, so the number of label values stays small
+STATEMENT_KINDS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'PRAGMA', 'BEGIN', 'CREATE', 'DROP', 'WITH'}
+
+def _statement_kind(sql):
+    keyword = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    return keyword if keyword in STATEMENT_KINDS else 'OTHER'
+
+# count every statement, and time a sample of them (slow ones are also logged)
+# only the execute step is timed - rows read later from a lazy cursor aren't included
+def _timed(conn, sql, run):
+    kind = _statement_kind(sql)
+    SQL_STATEMENTS.inc(statement=kind)
+    if conn.sample_rate < 1 and random.random() >= conn.sample_rate:
+        return run()
+    start = time.perf_counter()
+    try:
+        return run()
+    finally:
+        elapsed = time.perf_counter() - start
+        SQL_SECONDS.observe(elapsed, statement=kind)
+        if elapsed >= conn.slow_query_seconds:
+            slow_query_log.warning("slow query (%.1f ms): %s", elapsed * 1000, ' '.join(sql.split()))
+
+# cursor (and connection) that report every statement to the metrics above
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return _timed(self.connection, sql, lambda: sqlite3.Cursor.execute(self, sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        return _timed(self.connection, sql, lambda: sqlite3.Cursor.executemany(self, sql, seq_of_parameters))
+
+class InstrumentedConnection(sqlite3.Connection):
+    sample_rate = 1.0 # fraction of statements that are timed
+    slow_query_seconds = 0.1 # statements slower than this are logged
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # the built in shortcuts don't go through cursor(), so route them through an instrumented cursor
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# keeps a small stack of open, already tuned connections so requests don't pay connect + pragma cost
+class ConnectionPool:
+    def __init__(self, database, pragmas=None, max_idle=8, sample_rate=1.0, slow_query_seconds=0.1):
+        self.database = database
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.max_idle = max_idle
+        self.sample_rate = sample_rate
+        self.slow_query_seconds = slow_query_seconds
+        self._idle = [] # used as a stack so the most recently used (warmest) connection goes out first
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'released': 0, 'discarded': 0, 'in_use': 0}
+
+    # open a brand new connection and apply the configured pragmas to it
+    def _connect(self):
+        # check_same_thread is off because a connection can be reused by a different thread of the
+        # same worker - the pool makes sure only one thread holds it at a time
+        # file: names are uris (e.g. the private in-memory databases in storage.py)
+        conn = sqlite3.connect(self.database, check_same_thread=False, factory=InstrumentedConnection,
+                               uri=self.database.startswith('file:'))
+        conn.row_factory = sqlite3.Row # return rows as dictionary like objects
+        conn.sample_rate = self.sample_rate
+        conn.slow_query_seconds = self.slow_query_seconds
+        for name, value in self.pragmas.items():
+            if value is not None:
+                conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    # hand out an idle connection, or open a new one when the pool is empty
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self._stats['in_use'] += 1
+            self._stats['reused' if conn else 'created'] += 1
+        if conn is None:
+            try:
+                conn = self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self._stats['in_use'] -= 1
+                raise
+        return conn
+
+    # give a connection back - anything left uncommitted is rolled back so the next user starts clean
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._stats['in_use'] -= 1
+            self._stats['released'] += 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._stats['discarded'] += 1
+        conn.close()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats['in_use'] -= 1
+            self._stats['discarded'] += 1
+        conn.close()
+
+    # close every idle connection (used on shutdown and after a worker forks)
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    # snapshot of the pool counters
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), max_idle=self.max_idle)
+
+# returns the pool for an app, creating it on first use from the app config
+# `database` picks another database file with its own pool (the shards in storage.py) - DATABASE by default
+def get_pool(app, database=None):
+    if database is None or database == app.config['DATABASE']:
+        pools, key = app.extensions, 'db_pool'
+    else:
+        pools, key = app.extensions.setdefault('db_shard_pools', {}), database
+    pool = pools.get(key)
+    if pool is None:
+        pool = ConnectionPool(database or app.config['DATABASE'],
+                              pragmas=app.config.get('DB_PRAGMAS'),
+                              max_idle=app.config.get('DB_POOL_SIZE', 8),
+                              sample_rate=app.config.get('SQL_SAMPLE_RATE', 1.0),
+                              slow_query_seconds=app.config.get('SLOW_QUERY_SECONDS', 0.1))
+        pools[key] = pool
+    return pool
+
+# every pool the app has opened so far
+def get_pools(app):
+    pools = list(app.extensions.get('db_shard_pools', {}).values())
+    if 'db_pool' in app.extensions:
+        pools.insert(0, app.extensions['db_pool'])
+    return pools
+
+# connections used outside of a request (scripts, the flask shell, tests) - one per thread and database
+_thread_local = threading.local()
+
+# returns the connection for the current request, or a per thread connection outside of a request
+# (to `database` when given, see get_pool)
+def get_connection(app, database=None):
+    if has_app_context():
+        # one connection per request (app context) and database - every call during the request shares it
+        if database is None or database == current_app.config['DATABASE']:
+            if 'db_conn' not in g:
+                g.db_conn = get_pool(current_app).acquire()
+            return g.db_conn
+        conns = g.setdefault('db_shard_conns', {})
+        if database not in conns:
+            conns[database] = get_pool(current_app, database).acquire()
+        return conns[database]
+
+    conns = getattr(_thread_local, 'conns', None)
+    if conns is None:
+        conns = _thread_local.conns = {}
+    key = database or app.config['DATABASE']
+    if key not in conns:
+        conns[key] = get_pool(app, database).acquire()
+    return conns[key]
+
+# hands the request's connections back to their pools once the app context ends
+def release_connection(exception=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool(current_app).release(conn)
+    for database, conn in g.pop('db_shard_conns', {}).items():
+        get_pool(current_app, database).release(conn)
+
+# wire the pool into an app
+def init_app(app):
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_PRAGMAS', {})
+    app.config.setdefault('SQL_SAMPLE_RATE', 1.0) # fraction of statements timed for /metrics
+    app.config.setdefault('SLOW_QUERY_SECONDS', 0.1) # statements slower than this are logged to momentum.sql
+    app.teardown_appcontext(release_connection)
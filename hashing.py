@@ -0,0 +1,105 @@
+import multiprocessing # spawn context for the hashing processes
+import os # cpu count for the default pool size
+import threading # bounds the number of queued hashes
+import time # hash latency
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+import metrics # hash latency and load shedding counters
+
+# password hashing that runs in a small process pool instead of on the request thread
+# a KDF like scrypt is deliberately slow and holds the GIL, so hashing inline lets a burst of logins
+# stall every other request in the worker - in the pool it only costs the request waiting for it
+
+HASH_SECONDS = metrics.Histogram('momentum_password_hash_seconds',
+                                 'Time spent hashing or checking passwords, including time queued',
+                                 labelnames=('operation',))
+HASH_REJECTED = metrics.Counter('momentum_password_hash_rejected_total',
+                                'Password hashes refused because the hashing queue was full',
+                                labelnames=('operation',))
+
+# raised when too many hashes are already queued - the caller should answer 503 and let the client retry
+class HashingOverloaded(Exception):
+    pass
+
+# runs hash/check calls in a process pool, refusing new work once queue_limit calls are in flight (0 = no limit)
+# workers=0 hashes inline on the calling thread (still with the queue limit and metrics)
+class Hasher:
+    def __init__(self, method, workers=2, queue_limit=8, timeout=30):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_limit) if queue_limit > 0 else None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # the process pool is started on first use, so importing the app (or forking workers) stays cheap
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn instead of fork - the parent has threads and open sqlite connections
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _run(self, operation, func, *args):
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            HASH_REJECTED.inc(operation=operation)
+            raise HashingOverloaded(f"password {operation} queue is full")
+        start = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return func(*args)
+            return self._pool().submit(func, *args).result(timeout=self.timeout)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+            HASH_SECONDS.observe(time.perf_counter() - start, operation=operation)
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def check(self, stored_hash, password):
+        return self._run('check', check_password_hash, stored_hash, password)
+
+    # true when a stored hash was made with different parameters than the configured method
+    # (werkzeug stores the method and its cost before the first '$', e.g. "scrypt:32768:8:1$salt$hash")
+    def needs_rehash(self, stored_hash):
+        return stored_hash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+# returns the hasher for the current app, creating it from the config on first use
+def get_hasher(app=None):
+    app = app or current_app
+    hasher = app.extensions.get('hasher')
+    if hasher is None:
+        hasher = Hasher(app.config['PASSWORD_HASH_METHOD'],
+                        workers=app.config['HASH_POOL_WORKERS'],
+                        queue_limit=app.config['HASH_QUEUE_LIMIT'],
+                        timeout=app.config['HASH_TIMEOUT'])
+        app.extensions['hasher'] = hasher
+    return hasher
+
+# module level shortcuts used by the routes
+def hash_password(password):
+    return get_hasher().hash(password)
+
+def check_password(stored_hash, password):
+    return get_hasher().check(stored_hash, password)
+
+def needs_rehash(stored_hash):
+    return get_hasher().needs_rehash(stored_hash)
+
+# wire hashing into an app
+def init_app(app):
+    workers = min(4, os.cpu_count() or 1)
+    # method and cost written into new hashes - always give the full parameters (e.g. "pbkdf2:sha256:600000"),
+    # stored hashes whose prefix differs are rehashed on the next successful login
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config.setdefault('HASH_POOL_WORKERS', workers) # 0 hashes on the request thread
+    app.config.setdefault('HASH_QUEUE_LIMIT', workers * 4) # hashes in flight before logins get a 503
+    app.config.setdefault('HASH_TIMEOUT', 30) # seconds to wait for a hash before giving up
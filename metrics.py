@@ -0,0 +1,109 @@
+import bisect # finds the histogram bucket for an observation
+import threading # metrics are updated from every request thread
+import time # request latency
+from flask import g, request # request timing hooks
+
+# small in-process metrics registry - counters and histograms with optional labels
+# every metric registers itself in REGISTRY when it is created
+
+REGISTRY = []
+
+# latency buckets in seconds, from 1ms to 10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# a value that only goes up, per combination of label values
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {} # label values -> count
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    # {label values: count}
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+# counts observations into buckets (plus their sum), per combination of label values
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    # {label values: (per bucket counts, sum, count)} - bucket counts are not cumulative
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+# label set in prometheus syntax, e.g. {method="GET",status="200"}
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+# every registered metric (plus any extra gauges) in the prometheus text exposition format
+# gauges is {name: (help, value)} for values that are read at scrape time, like pool sizes
+def render(gauges=None):
+    lines = []
+    for metric in REGISTRY:
+        if isinstance(metric, Counter):
+            lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} counter']
+            for key, value in sorted(metric.snapshot().items()):
+                lines.append(f'{metric.name}{_labels(metric.labelnames, key)} {value}')
+        else:
+            lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} histogram']
+            for key, (counts, total, count) in sorted(metric.snapshot().items()):
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric.name}_bucket{_labels(metric.labelnames, key, [("le", le)])} {cumulative}')
+                lines.append(f'{metric.name}_sum{_labels(metric.labelnames, key)} {total}')
+                lines.append(f'{metric.name}_count{_labels(metric.labelnames, key)} {count}')
+    for name, (help, value) in sorted((gauges or {}).items()):
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+REQUEST_SECONDS = Histogram('momentum_request_seconds', 'Time to handle a request, per route',
+                            labelnames=('endpoint', 'method', 'status'))
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+
+def _observe_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        # streamed responses are only timed up to the point the body starts being sent
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=request.endpoint or 'unknown',
+                                method=request.method, status=response.status_code)
+    return response
+
+# time every request of an app
+def init_app(app):
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
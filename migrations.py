@@ -0,0 +1,198 @@
+import sqlite3 # migrations run against a plain sqlite connection
+
+# numbered schema migrations - the database remembers the last one applied in PRAGMA user_version
+# never edit a migration that has shipped, add a new one to the end of the list instead
+MIGRATIONS = [
+    # 1 - base tables (IF NOT EXISTS so databases created before migrations existed are picked up as-is)
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT NOT NULL,
+            date TEXT NOT NULL,
+            user_id INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+    ]),
+    # 2 - per user lookups (home listing, clear) no longer scan the whole tasks table
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_tasks_user_date ON tasks(user_id, date, id)',
+    ]),
+    # 3 - covering index for the home listing so it never touches the table itself;
+    # it has the same leading columns as idx_tasks_user_date, which becomes redundant
+    (3, [
+        'CREATE INDEX IF NOT EXISTS idx_tasks_user_listing ON tasks(user_id, date, id, task)',
+        'DROP INDEX IF EXISTS idx_tasks_user_date',
+    ]),
+    # 4 - full text search over task text, kept in sync with tasks by triggers (external content table,
+    # so the text isn't stored twice); user_id is indexed too so a search only walks that user's matches
+    (4, [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+            task, user_id, content='tasks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+            INSERT INTO tasks_fts (rowid, task, user_id) VALUES (new.id, new.task, new.user_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+            INSERT INTO tasks_fts (tasks_fts, rowid, task, user_id) VALUES ('delete', old.id, old.task, old.user_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE ON tasks BEGIN
+            INSERT INTO tasks_fts (tasks_fts, rowid, task, user_id) VALUES ('delete', old.id, old.task, old.user_id);
+            INSERT INTO tasks_fts (rowid, task, user_id) VALUES (new.id, new.task, new.user_id);
+        END
+        ''',
+        # backfill the index from the tasks that already exist
+        "INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')",
+    ]),
+    # 5 - per user change log (see changefeed.py) - triggers record every added and deleted task in the same
+    # transaction as the change; taskstore.clear_tasks writes a single 'clear' entry first, and the delete
+    # trigger skips the rows removed right after a user's 'clear' instead of logging each one
+    (5, [
+        '''
+        CREATE TABLE IF NOT EXISTS task_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            task_id INTEGER,
+            task TEXT,
+            date TEXT,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_task_changes_user ON task_changes(user_id, seq)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS task_changes_insert AFTER INSERT ON tasks BEGIN
+            INSERT INTO task_changes (user_id, op, task_id, task, date) VALUES (new.user_id, 'add', new.id, new.task, new.date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS task_changes_delete AFTER DELETE ON tasks
+        WHEN (SELECT op FROM task_changes WHERE user_id = old.user_id ORDER BY seq DESC LIMIT 1) IS NOT 'clear'
+        BEGIN
+            INSERT INTO task_changes (user_id, op, task_id, date) VALUES (old.user_id, 'delete', old.id, old.date);
+        END
+        ''',
+    ]),
+    # 6 - per user task counts for the homepage summary (see taskstore.get_stats), kept up to date by triggers so
+    # reading them never touches the tasks themselves: task_totals has one row per user, task_stats one per user
+    # and day that has tasks (days whose count drops to zero are removed)
+    (6, [
+        '''
+        CREATE TABLE IF NOT EXISTS task_totals (
+            user_id INTEGER PRIMARY KEY,
+            tasks INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS task_stats (
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            tasks INTEGER NOT NULL,
+            PRIMARY KEY (user_id, date)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS task_stats_insert AFTER INSERT ON tasks WHEN new.user_id IS NOT NULL BEGIN
+            INSERT INTO task_totals (user_id, tasks) VALUES (new.user_id, 1)
+                ON CONFLICT (user_id) DO UPDATE SET tasks = tasks + 1;
+            INSERT INTO task_stats (user_id, date, tasks) VALUES (new.user_id, new.date, 1)
+                ON CONFLICT (user_id, date) DO UPDATE SET tasks = tasks + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS task_stats_delete AFTER DELETE ON tasks WHEN old.user_id IS NOT NULL BEGIN
+            UPDATE task_totals SET tasks = tasks - 1 WHERE user_id = old.user_id;
+            UPDATE task_stats SET tasks = tasks - 1 WHERE user_id = old.user_id AND date = old.date;
+            DELETE FROM task_stats WHERE user_id = old.user_id AND date = old.date AND tasks <= 0;
+        END
+        ''',
+        # backfill from the tasks that already exist (same statements as `flask --app app rebuild-stats`)
+        'INSERT INTO task_totals (user_id, tasks) SELECT user_id, COUNT(*) FROM tasks WHERE user_id IS NOT NULL GROUP BY user_id',
+        'INSERT INTO task_stats (user_id, date, tasks) SELECT user_id, date, COUNT(*) FROM tasks WHERE user_id IS NOT NULL GROUP BY user_id, date',
+    ]),
+    # 7 - cold storage for old tasks (see archive.py) - moved rows keep their ids, and the archive has its own
+    # covering index for the /archive listing; users.archive_after_days overrides the ARCHIVE_AFTER_DAYS default
+    (7, [
+        '''
+        CREATE TABLE IF NOT EXISTS tasks_archive (
+            id INTEGER PRIMARY KEY,
+            task TEXT NOT NULL,
+            date TEXT NOT NULL,
+            user_id INTEGER,
+            archived_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_tasks_archive_user_listing ON tasks_archive(user_id, date, id, task)',
+        'ALTER TABLE users ADD COLUMN archive_after_days INTEGER',
+    ]),
+    # 8 - sharding (see storage.ShardedSqliteRepository) - user_shards is the directory of which shard holds a
+    # user's tasks (only used in the main database), shard_fences lists the users a shard takes no more task
+    # writes for because they are being (or have been) moved to another shard
+    (8, [
+        'CREATE TABLE IF NOT EXISTS user_shards (user_id INTEGER PRIMARY KEY, shard INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS shard_fences (user_id INTEGER PRIMARY KEY)',
+    ]),
+    # 9 - recurring tasks (see recurrence.py) - one row per rule, with the dates of its deleted occurrences in
+    # `exdates` (a json list); occurrences are never stored, so they aren't in the change log, search or the counts
+    (9, [
+        '''
+        CREATE TABLE IF NOT EXISTS task_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            task TEXT NOT NULL,
+            freq TEXT NOT NULL CHECK (freq IN ('daily', 'weekly', 'monthly')),
+            every INTEGER NOT NULL DEFAULT 1 CHECK (every > 0),
+            start TEXT NOT NULL,
+            until TEXT,
+            exdates TEXT NOT NULL DEFAULT '[]'
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_task_rules_user ON task_rules(user_id, start)',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# the schema version stored in the database file
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+# apply any migrations the database hasn't seen yet - returns the list of versions applied
+# when the database is already current this is a single PRAGMA read
+def migrate(conn):
+    if get_version(conn) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    conn.commit() # make sure we aren't inside someone else's transaction
+    # take the write lock up front so two workers starting together don't both apply the same migration
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = get_version(conn) # re-read now that we hold the lock
+        for version, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            applied.append(version)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return applied
@@ -0,0 +1,113 @@
+import hashlib # builds the ETag from the cache key
+import os # per process random epoch for the in-memory version counters
+import threading # guards the in-memory cache
+import time # TTL bookkeeping
+from collections import OrderedDict # LRU ordering for the in-memory cache
+from flask import current_app
+
+# per user cache of the rendered homepage
+# every user has a version counter that add_task, delete_task and clear_database bump after they commit,
+# the version is part of the cache key and the ETag, so a write makes every cached page (and every
+# ETag a browser holds) for that user stale without having to find and delete them
+# the homepage also puts the seq of the user's newest change log entry in the key (see home() in app.py), so
+# writes from other processes, like the archive-tasks and move-user commands, make the pages stale as well
+
+# in-process backend - a bounded LRU with a TTL, only shared by the threads of one worker
+class MemoryBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._pages = OrderedDict() # key -> (expires_at, body)
+        self._versions = {} # user_id -> version counter
+        # counters restart at 0 with the process, the epoch keeps an old ETag from matching a new counter
+        self._epoch = os.urandom(4).hex()
+        self._lock = threading.Lock()
+
+    def get_version(self, user_id):
+        with self._lock:
+            return f"{self._epoch}.{self._versions.get(user_id, 0)}"
+
+    def bump_version(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._pages[key]
+                return None
+            self._pages.move_to_end(key) # mark as most recently used
+            return entry[1]
+
+    def set(self, key, body, ttl):
+        with self._lock:
+            self._pages[key] = (time.monotonic() + ttl, body)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False) # evict the least recently used page
+
+# shared backend - every worker sees the same versions and pages, so a write in one worker
+# invalidates the pages cached by the others (redis evicts with its own maxmemory-policy)
+class RedisBackend:
+    def __init__(self, url, prefix='momentum:'):
+        import redis # optional dependency, only needed when PAGE_CACHE_BACKEND is 'redis'
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get_version(self, user_id):
+        version = self._redis.get(f"{self._prefix}version:{user_id}")
+        return version.decode() if version else '0'
+
+    def bump_version(self, user_id):
+        self._redis.incr(f"{self._prefix}version:{user_id}")
+
+    def get(self, key):
+        return self._redis.get(f"{self._prefix}page:{key}")
+
+    def set(self, key, body, ttl):
+        self._redis.set(f"{self._prefix}page:{key}", body, ex=ttl)
+
+# returns the cache backend for the current app, creating it from the config on first use
+def get_backend(app=None):
+    app = app or current_app
+    backend = app.extensions.get('page_cache')
+    if backend is None:
+        if app.config['PAGE_CACHE_BACKEND'] == 'redis':
+            backend = RedisBackend(app.config['PAGE_CACHE_URL'])
+        else:
+            backend = MemoryBackend(app.config['PAGE_CACHE_MAX_ENTRIES'])
+        app.extensions['page_cache'] = backend
+    return backend
+
+# the strong ETag for one user's page - changes whenever the user's version or the page parameters change
+# None with the cache off: the version counters are only kept up to date for a cache that is in use (serve.py
+# turns the memory cache off when there are several workers, whose counters would disagree)
+def make_etag(user_id, *parts):
+    if not current_app.config['PAGE_CACHE_ENABLED']:
+        return None
+    key = '\0'.join([str(user_id), get_backend().get_version(str(user_id))] + [str(part) for part in parts])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+# cached body for an ETag, or None
+def get_page(etag):
+    if not current_app.config['PAGE_CACHE_ENABLED']:
+        return None
+    return get_backend().get(etag)
+
+def set_page(etag, body):
+    if current_app.config['PAGE_CACHE_ENABLED']:
+        get_backend().set(etag, body, current_app.config['PAGE_CACHE_TTL'])
+
+# call after a user's tasks change (and the change is committed) so their cached pages go stale
+def invalidate_user(user_id):
+    get_backend().bump_version(str(user_id))
+
+# wire the cache into an app
+def init_app(app):
+    app.config.setdefault('PAGE_CACHE_ENABLED', True)
+    app.config.setdefault('PAGE_CACHE_BACKEND', 'memory') # 'memory' (per worker) or 'redis' (shared)
+    app.config.setdefault('PAGE_CACHE_URL', 'redis://localhost:6379/0')
+    app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 1024)
+    app.config.setdefault('PAGE_CACHE_TTL', 300) # seconds
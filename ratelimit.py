@@ -0,0 +1,115 @@
+import threading # guards the in-memory buckets
+import time # refill bookkeeping
+from collections import OrderedDict # LRU ordering for the in-memory buckets
+from flask import current_app, request
+import metrics # rejected request counter
+
+# token bucket rate limits for the expensive form posts (login and register) - every limit in RATE_LIMITS is
+# [burst, seconds]: a bucket holds up to `burst` tokens and refills at burst/seconds tokens a second, and each
+# request takes one token from every bucket it is checked against (e.g. the client's address and the username)
+# the check happens before any database lookup or password hash, so a burst of bad logins is turned away for
+# the price of a dictionary lookup
+
+RATE_LIMITED = metrics.Counter('momentum_rate_limited_total', 'Requests refused by a rate limit',
+                               labelnames=('limit',))
+
+# in-process backend - a bounded LRU of buckets, only shared by the threads of one worker (so with N workers a
+# client gets up to N times the limit); an evicted bucket starts full again, so the bound only ever errs
+# towards letting a request in
+class MemoryBackend:
+    def __init__(self, max_keys=65536):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict() # key -> (tokens, monotonic time they were counted)
+        self._lock = threading.Lock()
+
+    # take a token - returns 0 when there was one, or the seconds until there will be
+    def take(self, key, burst, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, counted = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - counted) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now) # re-added as most recently used
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False) # evict the least recently used bucket
+        return wait
+
+# the same bucket arithmetic in redis, so every worker (and every server) shares one set of limits
+# the script runs atomically and uses the redis clock; buckets expire once they would be full again
+TAKE_SCRIPT = '''
+local burst, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'counted')
+local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'counted', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+'''
+
+class RedisBackend:
+    def __init__(self, url, prefix='momentum:ratelimit:'):
+        import redis # optional dependency, only needed when RATE_LIMIT_BACKEND is 'redis'
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(TAKE_SCRIPT)
+        self._errors = redis.RedisError
+        self._prefix = prefix
+
+    # when redis can't be reached requests are let through rather than locking everybody out
+    def take(self, key, burst, rate):
+        try:
+            return float(self._take(keys=[self._prefix + key], args=[burst, rate]))
+        except self._errors:
+            return 0.0
+
+# returns the rate limit backend for the current app, creating it from the config on first use
+def get_backend(app=None):
+    app = app or current_app
+    backend = app.extensions.get('rate_limiter')
+    if backend is None:
+        if app.config['RATE_LIMIT_BACKEND'] == 'redis':
+            backend = RedisBackend(app.config['RATE_LIMIT_URL'])
+        else:
+            backend = MemoryBackend(app.config['RATE_LIMIT_MAX_KEYS'])
+        app.extensions['rate_limiter'] = backend
+    return backend
+
+# the client's address - with RATE_LIMIT_PROXIES = N trusted proxies in front of the app (e.g. a load balancer),
+# the address the Nth proxy from the end of X-Forwarded-For saw, which a client can't forge
+def client_address():
+    proxies = current_app.config['RATE_LIMIT_PROXIES']
+    forwarded = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+    if proxies and len(forwarded) >= proxies:
+        return forwarded[-proxies]
+    return request.remote_addr or ''
+
+# take a token from each (limit name, key) bucket - returns 0 when the request may go ahead, otherwise the
+# seconds until it could (the longest wait of the buckets that are empty)
+def check(*buckets):
+    if not current_app.config['RATE_LIMIT_ENABLED']:
+        return 0.0
+    backend = get_backend()
+    wait = 0.0
+    for name, key in buckets:
+        burst, seconds = current_app.config['RATE_LIMITS'][name]
+        # keys are capped so a huge username can't take up much memory
+        limit_wait = backend.take(f'{name}:{str(key)[:256]}', burst, burst / seconds)
+        if limit_wait:
+            RATE_LIMITED.inc(limit=name)
+            wait = max(wait, limit_wait)
+    return wait
+
+# wire rate limiting into an app
+def init_app(app):
+    app.config.setdefault('RATE_LIMIT_ENABLED', True)
+    app.config.setdefault('RATE_LIMIT_BACKEND', 'memory') # 'memory' (per worker) or 'redis' (shared)
+    app.config.setdefault('RATE_LIMIT_URL', 'redis://localhost:6379/0')
+    app.config.setdefault('RATE_LIMIT_MAX_KEYS', 65536) # buckets kept by the memory backend
+    app.config.setdefault('RATE_LIMIT_PROXIES', 0) # trusted proxies that add X-Forwarded-For
+    app.config.setdefault('RATE_LIMITS', {
+        'login_ip': [30, 60], # login attempts from one address: 30 at once, then one every 2 seconds
+        'login_user': [10, 300], # login attempts on one username, from anywhere
+        'register_ip': [10, 3600], # new accounts from one address
+    })
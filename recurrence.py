@@ -0,0 +1,147 @@
+import heapq # merges the occurrences of several rules in date order
+from itertools import dropwhile # skips the occurrences before a cursor
+from datetime import date, timedelta
+
+# recurring tasks - a rule is one stored row ('daily', 'weekly' or 'monthly', every N of them, from `start` up to an
+# optional `until`) and its occurrences are worked out here when a listing needs them, only for the dates it
+# shows, so storage and listing cost grow with the number of rules rather than occurrences
+# deleting (completing) one occurrence adds its date to the rule's `exdates` instead of touching any task row
+# rules are dicts with the keys 'id', 'task', 'freq', 'every', 'start', 'until' and 'exdates' (a list of dates)
+# weekly rules repeat on the weekday of `start`, monthly ones on its day of the month - months that don't have
+# that day are skipped, like an RRULE with BYMONTHDAY
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+# the undeleted occurrence dates of a rule from `lo` to `hi` (dates, both included), in order
+def occurrence_dates(rule, lo, hi):
+    start = date.fromisoformat(rule['start'])
+    if rule['until']:
+        hi = min(hi, date.fromisoformat(rule['until']))
+    lo = max(lo, start)
+    skipped = set(rule['exdates'])
+    for day in _dates(rule['freq'], rule['every'], start, lo, hi):
+        if day.isoformat() not in skipped:
+            yield day
+
+# every date of the series from `lo` to `hi` - the first one is found with arithmetic rather than by stepping
+# through the series from its start
+def _dates(freq, every, start, lo, hi):
+    if freq == 'monthly':
+        first = start.year * 12 + start.month - 1
+        n = max(0, -(-(lo.year * 12 + lo.month - 1 - first) // every))
+        while True:
+            year, month = divmod(first + n * every, 12)
+            if date(year, month + 1, 1) > hi:
+                return
+            try:
+                day = date(year, month + 1, start.day)
+            except ValueError: # no such day this month
+                day = None
+            if day and lo <= day <= hi:
+                yield day
+            n += 1
+    step = every * (7 if freq == 'weekly' else 1)
+    day = start + timedelta(days=-(-(lo - start).days // step) * step)
+    while day <= hi:
+        yield day
+        day += timedelta(days=step)
+
+# true when `day` (YYYY-MM-DD) is an occurrence of the rule that hasn't been deleted
+def is_occurrence(rule, day):
+    day = date.fromisoformat(day)
+    return any(occurrence_dates(rule, day, day))
+
+# how many occurrences the rules have from `lo` to `hi`
+# daily and weekly series are counted with arithmetic, so a long window costs no more than a short one
+def count(rules, lo, hi):
+    total = 0
+    for rule in rules:
+        start = date.fromisoformat(rule['start'])
+        end = min(hi, date.fromisoformat(rule['until'])) if rule['until'] else hi
+        first = max(lo, start)
+        if end < first:
+            continue
+        if rule['freq'] == 'monthly':
+            total += sum(1 for _ in _dates('monthly', rule['every'], start, first, end))
+        else:
+            step = rule['every'] * (7 if rule['freq'] == 'weekly' else 1)
+            total += max(0, (end - start).days // step - -(-(first - start).days // step) + 1)
+        total -= sum(1 for day in rule['exdates'] if first.isoformat() <= day <= end.isoformat())
+    return total
+
+# the occurrences of all the rules from `lo` to `hi` as listing rows, in (date, rule) order - generated lazily
+def expand(rules, lo, hi):
+    def rows(rule):
+        for day in occurrence_dates(rule, lo, hi):
+            value = day.isoformat()
+            yield {'id': None, 'rule': rule['id'], 'freq': rule['freq'], 'task': rule['task'], 'date': value,
+                   'display_date': f'{value[5:7]}/{value[8:10]}/{value[:4]}'}
+    return heapq.merge(*(rows(rule) for rule in rules), key=lambda row: (row['date'], row['rule']))
+
+# listing cursors - a day's tasks come before its occurrences, so a row's position is (date, 0, task id) for a
+# task and (date, 1, rule id) for an occurrence; the cursor after a task is 'date:id' (the same as taskstore's)
+# and after an occurrence 'date:r<rule>'
+def encode_cursor(row):
+    return f"{row['date']}:{row['id']}" if row['id'] is not None else f"{row['date']}:r{row['rule']}"
+
+# inverse of encode_cursor - returns (date, kind, id) or None when the cursor is missing or malformed
+def decode_cursor(cursor):
+    day, _, key = (cursor or '').rpartition(':')
+    kind = 1 if key.startswith('r') else 0
+    try:
+        day = date.fromisoformat(day).isoformat()
+    except ValueError:
+        return None
+    if not key[kind:].isdigit():
+        return None
+    return day, kind, int(key[kind:])
+
+# the (date, id) cursor for the task query - after an occurrence, the next task is on a later day
+# (9223372036854775807 is the largest rowid)
+def task_cursor(after):
+    if after is None:
+        return None
+    return (after[0], after[2]) if after[1] == 0 else (after[0], 9223372036854775807)
+
+# the dates a listing shows occurrences for - ?from= (or today) to ?to= (or `days` ahead), and on later pages
+# none before the cursor's date
+def window(today, days, date_from=None, date_to=None, after=None):
+    lo = date.fromisoformat(date_from) if date_from else today
+    if after:
+        lo = max(lo, date.fromisoformat(after[0]))
+    hi = date.fromisoformat(date_to) if date_to else today + timedelta(days=days)
+    return lo, hi
+
+# one page of a listing - a lazily read TaskPage (see taskstore.py, asked for the same `limit`) merged with the
+# occurrences that come after the cursor, at most `limit` rows in all
+# once iteration finishes, next_cursor holds the cursor for the following page (None on the last page)
+class RecurringPage:
+    def __init__(self, page, occurrences, limit, after=None):
+        self._page = page
+        self._occurrences = occurrences
+        self._limit = limit
+        self._after = after
+        self.next_cursor = None
+
+    def __iter__(self):
+        tasks = iter(self._page)
+        occurrences = iter(self._occurrences)
+        if self._after and self._after[1] == 1: # the occurrences of that day up to the cursor's rule were shown
+            occurrences = dropwhile(lambda row: (row['date'], row['rule']) <= (self._after[0], self._after[2]),
+                                    occurrences)
+        task, occurrence = next(tasks, None), next(occurrences, None)
+        try:
+            for _ in range(self._limit):
+                if task is None and occurrence is None:
+                    return
+                if occurrence is None or (task is not None and task['date'] <= occurrence['date']):
+                    row, task = task, next(tasks, None)
+                else:
+                    row, occurrence = occurrence, next(occurrences, None)
+                yield row
+            # the page is full - there is another one when either side has something left
+            if task is not None or occurrence is not None or self._page.next_cursor is not None:
+                self.next_cursor = encode_cursor(row)
+        finally:
+            if hasattr(tasks, 'close'):
+                tasks.close()
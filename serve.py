@@ -0,0 +1,315 @@
+import argparse # command line options
+import functools # binds a connection to its slot release callback
+import gc # keeps the preloaded objects out of the workers' garbage collections
+import logging # master and worker events
+import os # fork, signals and the inherited socket
+import signal # graceful stop and reload
+import socket # the listening socket the workers share
+import subprocess # checks new code imports before a reload
+import sys
+import threading # request threads in each worker
+import time # respawn throttling and shutdown deadlines
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+import db # pools are closed before forking
+
+# production launcher - a pre-forking master with N worker processes, each answering requests on T threads
+#   python serve.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+# the master builds the app once (migrations, templates, asset manifest), opens the listening socket and forks the
+# workers, which all accept from that socket; it replaces workers that die, and
+#   SIGHUP            graceful reload - the master re-executes itself with the new code and config, keeps the socket
+#                     open (no connection is refused), starts new workers, then lets the old ones finish
+#   SIGTERM / SIGINT  graceful stop - workers stop accepting and finish what they are doing (up to the timeout)
+# each worker starts with its own connection pools, write queues, hashing pool, weather, page cache and rate limits
+# (see after_fork), so nothing that holds a connection, thread or process crosses the fork
+# /healthz and /readyz in app.py are the liveness and readiness checks
+# settings can also come from the app config (MOMENTUM_SERVER_WORKERS=4, ...)
+
+log = logging.getLogger('momentum.server')
+
+DEFAULTS = {
+    'SERVER_BIND': '0.0.0.0:8000',
+    'SERVER_WORKERS': os.cpu_count() or 1, # processes
+    'SERVER_THREADS': 8, # request threads per process
+    'SERVER_GRACEFUL_TIMEOUT': 30, # seconds a stopping worker gets to finish before it is killed
+    'SERVER_KEEPALIVE': 5, # seconds an idle keep-alive connection holds a request thread
+    'SERVER_BACKLOG': 2048, # connections the socket queues while every thread is busy
+}
+
+# app.extensions entries a worker must build for itself - connections, threads and process pools don't survive
+# a fork, and the in-memory page cache's version epoch has to be different in every worker
+PER_PROCESS = ('db_pool', 'db_shard_pools', 'write_queue', 'shard_write_queues', 'hasher', 'weather', 'page_cache',
+               'archiver', 'rate_limiter', 'change_streams')
+
+# build the app in the master so every worker starts with it ready - `options` (from the command line) override
+# the SERVER_ settings
+def preload(options=None):
+    from app import create_app
+    app = create_app() # from the defaults and the MOMENTUM_ environment, with migrations applied
+    for name, value in DEFAULTS.items():
+        app.config.setdefault(name, value)
+    app.config.update({name: value for name, value in (options or {}).items() if value is not None})
+    if app.config['STORAGE'] in ('sqlite-memory', 'memory'):
+        raise SystemExit("serve.py needs storage the workers can share (STORAGE = 'sqlite' or 'sqlite-sharded')")
+    # the memory page cache's versions are per worker - a write in one worker would leave the others serving
+    # (and answering 304 to) the page from before it
+    if app.config['SERVER_WORKERS'] > 1 and app.config['PAGE_CACHE_BACKEND'] == 'memory' \
+            and app.config['PAGE_CACHE_ENABLED']:
+        log.warning("page cache turned off - PAGE_CACHE_BACKEND = 'memory' can't be shared by %d workers, "
+                    "use 'redis'", app.config['SERVER_WORKERS'])
+        app.config['PAGE_CACHE_ENABLED'] = False
+    with app.app_context():
+        for name in app.jinja_env.list_templates(): # compile every template once, before the fork
+            app.jinja_env.get_template(name)
+        import assets
+        assets.get_manifest()
+    return app
+
+def after_fork(app):
+    for key in PER_PROCESS:
+        app.extensions.pop(key, None)
+    app.extensions['draining'] = False
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+# the listening socket - inherited from the previous master after a reload (MOMENTUM_SERVER_FD)
+def listen(host, port, backlog):
+    fd = os.environ.pop('MOMENTUM_SERVER_FD', None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        sock = socket.create_server((host, port), family=family, backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+class RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    # a long lived response (the change feed's event stream) calls environ['momentum.release_slot'] to give its
+    # request slot back, so it doesn't keep other requests waiting
+    def make_environ(self):
+        environ = super().make_environ()
+        environ['momentum.release_slot'] = functools.partial(self.server.release_slot, self.request)
+        return environ
+
+# a worker's http server - requests run on a fixed pool of threads, and the next connection is only accepted
+# once a thread is free, so a busy worker leaves new connections in the socket for the others
+# event streams give their request slot back (see RequestHandler) and run on `streams` extra threads, the same
+# number as the change feed's CHANGES_MAX_STREAMS, so open tabs never starve the requests
+class WorkerServer(BaseWSGIServer):
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app, fd, threads, keepalive, streams=0):
+        handler = type('Handler', (RequestHandler,), {'timeout': keepalive})
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self.master_pid = os.getppid()
+        self._pool = ThreadPoolExecutor(threads + streams, thread_name_prefix='momentum-request')
+        self._slots = threading.Semaphore(threads)
+        self._released = set() # connections that gave their slot back early
+        self._active = 0
+        self._idle = threading.Condition()
+
+    def get_request(self):
+        self._slots.acquire()
+        try:
+            return super().get_request()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self._active += 1
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.release_slot(request)
+            with self._idle:
+                self._active -= 1
+                self._released.discard(request)
+                self._idle.notify_all()
+
+    # let the next connection in - once per connection, whether a stream gave it back or the connection ended
+    def release_slot(self, request):
+        with self._idle:
+            if request in self._released:
+                return
+            self._released.add(request)
+        self._slots.release()
+
+    # called between accepts - a worker whose master has gone away stops
+    def service_actions(self):
+        if os.getppid() != self.master_pid:
+            self.stop()
+
+    # stop accepting (safe to call from a signal handler or a request thread)
+    def stop(self):
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    # wait for the requests in flight - returns False when some were still running at the deadline
+    def finish(self, timeout):
+        with self._idle:
+            done = self._idle.wait_for(lambda: self._active == 0, timeout)
+        self._pool.shutdown(wait=done)
+        return done
+
+def run_worker(app, sock, host, port, config):
+    after_fork(app)
+    server = WorkerServer(host, port, app, sock.fileno(), config['SERVER_THREADS'], config['SERVER_KEEPALIVE'],
+                          streams=config['CHANGES_MAX_STREAMS'])
+
+    def drain(signum, frame):
+        app.extensions['draining'] = True # /readyz answers 503 on connections that are still open
+        server.stop()
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN) # reloads are the master's business
+    log.info("worker %d serving on %s:%d", os.getpid(), host, server.port)
+    server.serve_forever()
+    server.server_close()
+    if not server.finish(config['SERVER_GRACEFUL_TIMEOUT']):
+        log.warning("worker %d stopped with requests still running", os.getpid())
+    for pool in db.get_pools(app):
+        pool.close()
+    hasher = app.extensions.get('hasher')
+    if hasher is not None:
+        hasher.shutdown()
+
+class Master:
+    def __init__(self, app, sock, host, port):
+        self.app = app
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.config = app.config
+        self.workers = {} # pid -> start time
+        self.retiring = {} # pid -> time it gets killed (workers of an earlier master, or that are being stopped)
+        self.signals = []
+        self.next_spawn = 0.0
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        log.info("master %d listening on %s:%d with %d workers x %d threads", os.getpid(), self.host, self.port,
+                 self.config['SERVER_WORKERS'], self.config['SERVER_THREADS'])
+        self.spawn_workers()
+        # workers handed over by the master this one replaced finish their requests and go
+        retiring = os.environ.pop('MOMENTUM_SERVER_RETIRING', '')
+        self.retire([int(pid) for pid in retiring.split(',') if pid])
+        while True:
+            self.reap()
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            self.spawn_workers()
+            self.kill_overdue()
+            time.sleep(0.2)
+
+    def spawn_workers(self):
+        while len(self.workers) < self.config['SERVER_WORKERS'] and time.monotonic() >= self.next_spawn:
+            for pool in db.get_pools(self.app): # no open connection is carried into the worker
+                pool.close()
+            gc.freeze() # the preloaded objects are never collected, so their pages stay shared with the master
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    run_worker(self.app, self.sock, self.host, self.port, self.config)
+                    code = 0
+                except BaseException:
+                    log.exception("worker %d failed", os.getpid())
+                finally:
+                    os._exit(code)
+            self.workers[pid] = time.monotonic()
+
+    # collect exited workers - one that dies within a second of starting delays its replacement, so a worker
+    # that can't start doesn't turn into a fork loop
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.retiring.pop(pid, None)
+            started = self.workers.pop(pid, None)
+            if started is not None:
+                log.warning("worker %d exited with status %d", pid, os.waitstatus_to_exitcode(status))
+                if time.monotonic() - started < 1:
+                    self.next_spawn = time.monotonic() + 1
+
+    def retire(self, pids):
+        deadline = time.monotonic() + self.config['SERVER_GRACEFUL_TIMEOUT']
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.retiring[pid] = deadline
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    # re-execute the master with whatever is on disk now - the current workers keep serving until the new master's
+    # workers are up, and the new code is imported in a throwaway process first so a broken deploy doesn't take
+    # the server down
+    def reload(self):
+        check = subprocess.run([sys.executable, '-c', 'import app'], cwd=self.app.root_path)
+        if check.returncode != 0:
+            log.error("reload cancelled - the new code doesn't import")
+            return
+        log.info("reloading")
+        os.environ['MOMENTUM_SERVER_FD'] = str(self.sock.fileno())
+        os.environ['MOMENTUM_SERVER_RETIRING'] = ','.join(str(pid) for pid in [*self.workers, *self.retiring])
+        os.execv(sys.executable, [sys.executable, *sys.argv])
+
+    def stop(self):
+        log.info("stopping")
+        self.retire(list(self.workers))
+        while self.retiring:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        self.sock.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run momentum with several worker processes")
+    parser.add_argument('--bind', help=f"host:port to listen on (default {DEFAULTS['SERVER_BIND']})")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per cpu)")
+    parser.add_argument('--threads', type=int,
+                        help=f"request threads per worker (default {DEFAULTS['SERVER_THREADS']})")
+    parser.add_argument('--graceful-timeout', type=int, help="seconds workers get to finish when stopping")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s')
+
+    app = preload({'SERVER_BIND': args.bind, 'SERVER_WORKERS': args.workers, 'SERVER_THREADS': args.threads,
+                   'SERVER_GRACEFUL_TIMEOUT': args.graceful_timeout})
+    host, port = parse_bind(app.config['SERVER_BIND'])
+    sock = listen(host, port, app.config['SERVER_BACKLOG'])
+    Master(app, sock, host, sock.getsockname()[1]).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import time # pause between moves
+import click # command line options
+from flask import current_app
+import storage # the sharded repository does the moving
+import pagecache # a moved user's cached homepage has the old task ids
+import changefeed # ... and so do their open tabs, until they catch up
+
+# moving users between the shards of the 'sqlite-sharded' storage backend (see storage.ShardedSqliteRepository)
+# while the app is running - other users aren't affected at all, and a user being moved can keep reading
+# (their writes wait for the move)
+#   flask --app app move-user USERNAME SHARD      move one user
+#   flask --app app rebalance-shards [--dry-run]  move users until the shards hold about the same number of tasks
+# to add shards, raise SHARD_COUNT (or add to SHARD_DATABASES) and restart - new users are spread over all of
+# them straight away, and rebalance-shards moves existing users onto the new files
+
+# move one user - returns the rows copied
+def move_user(user_id, shard, app=None):
+    app = app or current_app._get_current_object()
+    with app.app_context():
+        copied = storage.get_repository(app).move_user(user_id, shard,
+                                                       chunk_size=app.config['SHARD_MOVE_CHUNK_SIZE'],
+                                                       pause=app.config['SHARD_MOVE_PAUSE'])
+        pagecache.invalidate_user(user_id)
+    changefeed.notify()
+    return copied
+
+# the moves that even out the shards - `loads` is {user_id: (shard, tasks)}, returns [(user_id, from, to)]
+# greedy: move the biggest user off the fullest shard to the emptiest one, as long as that narrows the gap
+# between them (every move does, so this ends)
+def plan_rebalance(loads, shards):
+    totals = [0] * shards
+    for shard, tasks in loads.values():
+        totals[shard] += tasks
+    placed = dict(loads)
+    moves = []
+    while True:
+        fullest = max(range(shards), key=totals.__getitem__)
+        emptiest = min(range(shards), key=totals.__getitem__)
+        gap = totals[fullest] - totals[emptiest]
+        candidates = [(tasks, user_id) for user_id, (shard, tasks) in placed.items()
+                      if shard == fullest and 0 < tasks < gap]
+        if not candidates:
+            return moves
+        tasks, user_id = max(candidates)
+        moves.append((user_id, fullest, emptiest))
+        placed[user_id] = (emptiest, tasks)
+        totals[fullest] -= tasks
+        totals[emptiest] += tasks
+
+# plan and run a rebalance, one user at a time - returns the moves made
+def rebalance(app=None, dry_run=False):
+    app = app or current_app._get_current_object()
+    with app.app_context():
+        repo = storage.get_repository(app)
+        moves = plan_rebalance(repo.shard_loads(), len(repo.shards))
+    if not dry_run:
+        for user_id, _, shard in moves:
+            move_user(user_id, shard, app)
+            time.sleep(app.config['SHARD_MOVE_PAUSE'])
+    return moves
+
+def _sharded_repository(app):
+    repo = storage.get_repository(app)
+    if not isinstance(repo, storage.ShardedSqliteRepository):
+        raise click.ClickException("Moving users between shards needs STORAGE = 'sqlite-sharded'")
+    return repo
+
+# wire the shard move settings and commands into an app
+def init_app(app):
+    app.config.setdefault('SHARD_MOVE_CHUNK_SIZE', 1000) # rows copied (and deleted) per write transaction
+    app.config.setdefault('SHARD_MOVE_PAUSE', 0.05) # seconds between chunks, so other writes get the lock
+
+    # `flask --app app move-user USERNAME SHARD`
+    @app.cli.command('move-user')
+    @click.argument('username')
+    @click.argument('shard', type=int)
+    def move_user_command(username, shard):
+        repo = _sharded_repository(app)
+        with app.app_context():
+            user = repo.get_user(username)
+        if user is None:
+            raise click.ClickException(f"No user named {username!r}")
+        if not 0 <= shard < len(repo.shards):
+            raise click.ClickException(f"There are only {len(repo.shards)} shards")
+        copied = move_user(user['id'], shard, app)
+        print(f"Moved {username} to shard {shard} ({copied} tasks)")
+
+    # `flask --app app rebalance-shards [--dry-run]`
+    @app.cli.command('rebalance-shards')
+    @click.option('--dry-run', is_flag=True, help="only print the moves")
+    def rebalance_shards_command(dry_run):
+        _sharded_repository(app)
+        moves = rebalance(app, dry_run=dry_run)
+        for user_id, source, target in moves:
+            print(f"user {user_id}: shard {source} -> {target}")
+        print(f"{len(moves)} users {'to move' if dry_run else 'moved'}")
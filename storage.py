@@ -0,0 +1,662 @@
+import bisect # the memory backend keeps each user's tasks sorted by (date, id)
+import hashlib # stable hash that places new users on a shard
+import os # shard file names
+import re # words for the memory backend's search
+import sqlite3
+import threading # guards the memory backend
+import time # change log timestamps in the memory backend, and writes waiting for a shard move
+import uuid # names private in-memory databases
+from collections import Counter # per day task counts in the memory backend
+from flask import current_app
+import db # pooled sqlite connections
+import migrations # schema for the sqlite backends
+import taskstore # the sqlite queries
+import recurrence # occurrences of the memory backend's recurring rules
+import transfer # chunked imports and the export query
+import writequeue # group commit for sqlite writes
+
+# task and user storage behind the routes - the app only talks to the repository returned by
+# get_repository(), so the same routes run on any of these backends (set with the STORAGE config key):
+#   'sqlite'         the DATABASE file, with the pool, migrations and optional group commit (the default)
+#   'sqlite-memory'  a private in-memory sqlite database shared by the app's pooled connections - the same
+#                    schema and queries as the file but nothing on disk, so every app (e.g. every test worker)
+#                    gets its own store
+#   'sqlite-sharded' the sqlite backend with users' tasks spread over several database files, so users on
+#                    different shards don't wait for each other's write lock
+#   'memory'         plain python structures, no sqlite at all
+# rows come back as mappings with the same keys as the sqlite rows ('id', 'task', 'date', 'display_date', ...)
+
+class UserExists(Exception):
+    pass
+
+# raised inside a sharded task write when the shard has fenced the user off (see ShardedSqliteRepository)
+class UserMoving(Exception):
+    pass
+
+class SqliteRepository:
+    def __init__(self, app):
+        self.app = app
+
+    # the database file holding a user's tasks (None is DATABASE, which also holds the users)
+    def _database(self, user_id=None):
+        return None
+
+    # the request's pooled connection to a user's database, or to DATABASE (see db.get_connection)
+    def _conn(self, user_id=None):
+        return db.get_connection(self.app, self._database(user_id))
+
+    def migrate(self):
+        return migrations.migrate(self._conn())
+
+    # true when the database answers and its schema is current (for /readyz)
+    def ping(self):
+        return migrations.get_version(self._conn()) >= migrations.LATEST_VERSION
+
+    def close(self):
+        db.get_pool(self.app).close()
+
+    # the database files behind the repository, the one holding the users first (what backup.py copies)
+    def databases(self):
+        return [self.app.config['DATABASE']]
+
+    # users
+
+    def create_user(self, username, password_hash):
+        try:
+            with self._conn() as conn:
+                return conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                                    (username, password_hash)).lastrowid
+        except sqlite3.IntegrityError:
+            raise UserExists(username)
+
+    def get_user(self, username):
+        return self._conn().execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+
+    def update_password(self, user_id, password_hash):
+        with self._conn() as conn:
+            conn.execute('UPDATE users SET password = ? WHERE id = ?', (password_hash, user_id))
+
+    def get_retention(self, user_id):
+        return taskstore.get_retention(self._conn(), user_id)
+
+    def set_retention(self, user_id, days):
+        with self._conn() as conn:
+            taskstore.set_retention(conn, user_id, days)
+
+    def list_retention(self, default_days):
+        return taskstore.list_retention(self._conn(), default_days)
+
+    # task writes - with WRITE_BATCHING on they go through the group commit queue and wait for their batch
+
+    def _write(self, func, user_id, *args):
+        if self.app.config['WRITE_BATCHING']:
+            future = writequeue.get_queue(self.app, self._database(user_id)).submit(func, user_id, *args)
+            return future.result(self.app.config['WRITE_BATCH_TIMEOUT'])
+        with self._conn(user_id) as conn:
+            return func(conn, user_id, *args)
+
+    def insert_tasks(self, user_id, tasks):
+        return self._write(taskstore.insert_tasks, user_id, tasks)
+
+    def delete_tasks(self, user_id, task_ids):
+        return self._write(taskstore.delete_tasks, user_id, task_ids)
+
+    def clear_tasks(self, user_id):
+        return self._write(taskstore.clear_tasks, user_id)
+
+    def import_rows(self, user_id, rows, chunk_size=5000):
+        conn = self._conn(user_id)
+        def insert(pairs):
+            with conn:
+                return taskstore.insert_tasks(conn, user_id, pairs)
+        return transfer.import_rows(insert, rows, chunk_size)
+
+    # task reads
+
+    def count_tasks(self, user_id, date_from=None, date_to=None, archived=False):
+        return taskstore.count_tasks(self._conn(user_id), user_id, date_from=date_from, date_to=date_to,
+                                     table='tasks_archive' if archived else 'tasks')
+
+    def iter_tasks(self, user_id, after=None, limit=50, date_from=None, date_to=None, archived=False):
+        return taskstore.iter_tasks(self._conn(user_id), user_id, after=after, limit=limit, date_from=date_from,
+                                    date_to=date_to, table='tasks_archive' if archived else 'tasks')
+
+    def list_tasks(self, user_id, after=None, limit=50, date_from=None, date_to=None):
+        return taskstore.list_tasks(self._conn(user_id), user_id, after=after, limit=limit,
+                                    date_from=date_from, date_to=date_to)
+
+    def iter_user_tasks(self, user_id):
+        return transfer.iter_user_tasks(self._conn(user_id), user_id)
+
+    def search_tasks(self, user_id, text, page=1, limit=50):
+        return taskstore.search_tasks(self._conn(user_id), user_id, text, page=page, limit=limit)
+
+    def get_stats(self, user_id, today, days=14):
+        return taskstore.get_stats(self._conn(user_id), user_id, today, days=days)
+
+    def rebuild_stats(self):
+        with self._conn() as conn:
+            return taskstore.rebuild_stats(conn)
+
+    # recurring rules (see recurrence.py) - written like tasks, so a sharded user's rules move with them
+
+    def create_rule(self, user_id, task, freq, every, start, until=None):
+        return self._write(taskstore.insert_rule, user_id, task, freq, every, start, until)
+
+    def delete_rule(self, user_id, rule_id):
+        return self._write(taskstore.delete_rule, user_id, rule_id)
+
+    def skip_occurrence(self, user_id, rule_id, occurrence_date):
+        return self._write(taskstore.skip_occurrence, user_id, rule_id, occurrence_date)
+
+    def list_rules(self, user_id, date_from=None, date_to=None):
+        return taskstore.list_rules(self._conn(user_id), user_id, date_from=date_from, date_to=date_to)
+
+    # change log and archive
+
+    # the newest seq in the change log `user_id`'s changes are written to
+    def latest_seq(self, user_id=None):
+        return taskstore.latest_seq(self._conn(user_id))
+
+    def user_seq(self, user_id):
+        return taskstore.user_seq(self._conn(user_id), user_id)
+
+    def get_changes(self, user_id, since, limit=500):
+        return taskstore.get_changes(self._conn(user_id), user_id, since, limit=limit)
+
+    def prune_changes(self, days):
+        with self._conn() as conn:
+            return taskstore.prune_changes(conn, days)
+
+    def archive_chunk(self, user_id, cutoff, chunk_size):
+        return taskstore.archive_chunk(self._conn(user_id), user_id, cutoff, chunk_size)
+
+# the sqlite backend on a private in-memory database - the name is unique to this repository, and one
+# connection is held open for its lifetime since sqlite drops an in-memory database with its last connection
+# it uses the memdb vfs rather than a shared cache: shared cache connections fail at once with "table is
+# locked" instead of waiting out busy_timeout, which the pool's concurrent readers and writer would hit
+class SqliteMemoryRepository(SqliteRepository):
+    def __init__(self, app):
+        app.config['DATABASE'] = f'file:/momentum-{uuid.uuid4().hex}?vfs=memdb'
+        super().__init__(app)
+        self._anchor = sqlite3.connect(app.config['DATABASE'], uri=True, check_same_thread=False)
+
+    def close(self):
+        super().close()
+        self._anchor.close()
+
+# the shard database files for an app - SHARD_DATABASES, or DATABASE followed by SHARD_COUNT - 1 files named
+# after it (tasks.db, tasks.shard1.db, tasks.shard2.db, ...)
+def shard_databases(config):
+    if config['SHARD_DATABASES']:
+        return list(config['SHARD_DATABASES'])
+    stem, ext = os.path.splitext(config['DATABASE'])
+    return [config['DATABASE']] + [f'{stem}.shard{n}{ext}' for n in range(1, config['SHARD_COUNT'])]
+
+# the shard a new user starts on - a digest rather than hash() so every process agrees
+def place_user(user_id, shards):
+    return int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), 'big') % shards
+
+# wraps a task write so it fails with UserMoving for a user the shard has fenced off - the write lock is
+# taken before the check, so a move can't fence the user between the check and the write
+def _fenced(func):
+    def write(conn, user_id, *args):
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        if taskstore.is_fenced(conn, user_id):
+            raise UserMoving(user_id)
+        return func(conn, user_id, *args)
+    return write
+
+# the sqlite backend with every user's tasks (and their change log, counts and archive) on one of several shard
+# files - each file has its own write lock, pool and write queue, so users on different shards write in parallel
+# DATABASE keeps the users and the directory of which shard each user is on (user_shards, migration 8); a new
+# user is placed by place_user() and recorded there, and users with no entry (everyone created before sharding
+# was turned on) are on shard 0, which is DATABASE itself unless SHARD_DATABASES says otherwise
+# move_user() moves a user to another shard while the app is running (see shards.py): the old shard fences the
+# user off first, and their task writes retry for up to SHARD_MOVE_WAIT seconds until the directory points at
+# the new shard - reads carry on from the old shard until then
+class ShardedSqliteRepository(SqliteRepository):
+    def __init__(self, app):
+        super().__init__(app)
+        self.shards = shard_databases(app.config)
+
+    def _database(self, user_id=None):
+        return None if user_id is None else self.shards[self.shard_of(user_id)]
+
+    # the shard a user's tasks are on, from the directory
+    def shard_of(self, user_id):
+        shard = taskstore.get_shard(self._conn(), user_id)
+        return 0 if shard is None else shard
+
+    # a connection to every shard, in order
+    def _shard_conns(self):
+        return [db.get_connection(self.app, database) for database in self.shards]
+
+    def migrate(self):
+        applied = migrations.migrate(self._conn())
+        for conn in self._shard_conns():
+            migrations.migrate(conn)
+        return applied
+
+    def ping(self):
+        return all(migrations.get_version(conn) >= migrations.LATEST_VERSION
+                   for conn in [self._conn(), *self._shard_conns()])
+
+    def close(self):
+        for pool in db.get_pools(self.app):
+            pool.close()
+
+    def databases(self):
+        return list(dict.fromkeys([self.app.config['DATABASE'], *self.shards]))
+
+    def create_user(self, username, password_hash):
+        try:
+            with self._conn() as conn:
+                user_id = conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                                       (username, password_hash)).lastrowid
+                taskstore.set_shard(conn, user_id, place_user(user_id, len(self.shards)))
+                return user_id
+        except sqlite3.IntegrityError:
+            raise UserExists(username)
+
+    # writes look the user's shard up again on every try, so they follow a move once it is done
+    def _write(self, func, user_id, *args):
+        deadline = time.monotonic() + self.app.config['SHARD_MOVE_WAIT']
+        while True:
+            try:
+                return super()._write(_fenced(func), user_id, *args)
+            except UserMoving:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"user {user_id} is still being moved to another shard")
+                time.sleep(0.05)
+
+    def import_rows(self, user_id, rows, chunk_size=5000):
+        return transfer.import_rows(lambda pairs: self._write(taskstore.insert_tasks, user_id, pairs),
+                                    rows, chunk_size)
+
+    def rebuild_stats(self):
+        users = 0
+        for conn in self._shard_conns():
+            with conn:
+                users += taskstore.rebuild_stats(conn)
+        return users
+
+    def prune_changes(self, days):
+        removed = 0
+        for conn in self._shard_conns():
+            with conn:
+                removed += taskstore.prune_changes(conn, days)
+        return removed
+
+    # {user_id: (shard, live tasks)} for every user with tasks, from each shard's task_totals
+    def shard_loads(self):
+        directory = taskstore.list_shards(self._conn())
+        loads = {}
+        for shard, conn in enumerate(self._shard_conns()):
+            for user_id, tasks in taskstore.count_user_tasks(conn):
+                if directory.get(user_id, 0) == shard: # rows an interrupted move left behind don't count
+                    loads[user_id] = (shard, tasks)
+        return loads
+
+    # move a user's tasks, archive, recurring rules, change log position and counts to another shard - returns the rows copied
+    # the copies get new ids from the new shard, and its id and seq counters are first raised past the old
+    # shard's, so the new ids are higher than any id a page has shown for this user, and open tabs see a
+    # 'clear' followed by every task
+    # running it again after an interruption starts over; a move interrupted after the directory was updated
+    # leaves rows on the old shard that nothing reads
+    def move_user(self, user_id, target, chunk_size=1000, pause=0.0):
+        source = self.shard_of(user_id)
+        if source == target:
+            return 0
+        src = db.get_connection(self.app, self.shards[source])
+        dst = db.get_connection(self.app, self.shards[target])
+
+        # 1 - fence the user off on the old shard - taking the write lock means any write of theirs that is
+        # under way has committed, and none can start after this
+        with src:
+            src.execute('BEGIN IMMEDIATE')
+            taskstore.fence_user(src, user_id)
+            last_seq = taskstore.latest_seq(src)
+            last_id = taskstore.get_sequence(src, 'tasks')
+            last_rule = taskstore.get_sequence(src, 'task_rules')
+            rules = taskstore.list_rules(src, user_id)
+
+        # 2 - copy to the new shard in chunks, each in its own short write transaction (nothing reads the user
+        # from there until step 3); the first also drops whatever an interrupted move left there
+        with dst:
+            dst.execute('BEGIN IMMEDIATE')
+            taskstore.unfence_user(dst, user_id)
+            taskstore.bump_sequence(dst, 'tasks', last_id)
+            taskstore.bump_sequence(dst, 'task_changes', last_seq)
+            taskstore.bump_sequence(dst, 'task_rules', last_rule) # a stale page can't hit one of the new rules
+            taskstore.clear_tasks(dst, user_id)
+            dst.execute('DELETE FROM tasks_archive WHERE user_id = ?', (user_id,))
+            taskstore.insert_rules(dst, user_id, rules)
+        copied = 0
+        for table in ('tasks', 'tasks_archive'):
+            after = None
+            while rows := taskstore.read_user_chunk(src, table, user_id, after, chunk_size):
+                with dst:
+                    dst.execute('BEGIN IMMEDIATE')
+                    if table == 'tasks':
+                        taskstore.insert_tasks(dst, user_id, [(row['task'], row['date']) for row in rows])
+                    else:
+                        taskstore.insert_archived(dst, user_id, rows)
+                copied += len(rows)
+                after = rows[-1]['date'], rows[-1]['id']
+                time.sleep(pause) # let the new shard's other writers in
+
+        # 3 - point the directory at the new shard - reads and the waiting writes go there from now on
+        with self._conn() as conn:
+            taskstore.set_shard(conn, user_id, target)
+
+        # 4 - delete the user from the old shard in chunks (the fence stays, for requests that looked the user up
+        # before step 3); after the 'clear' entry the delete trigger doesn't log each task
+        with src:
+            taskstore.log_clear(src, user_id)
+            src.execute('DELETE FROM task_rules WHERE user_id = ?', (user_id,))
+        for table in ('tasks', 'tasks_archive'):
+            while True:
+                with src:
+                    deleted = taskstore.delete_user_chunk(src, table, user_id, chunk_size)
+                if deleted < chunk_size:
+                    break
+                time.sleep(pause)
+        return copied
+
+def _display_date(value):
+    return f'{value[5:7]}/{value[8:10]}/{value[:4]}'
+
+def _words(text):
+    return re.findall(r'\w+', text.lower())
+
+# everything in python dicts and lists behind one lock - nothing persists past the process
+# each user's tasks are kept sorted by (date, id), so listing pages is a bisect plus a slice like the
+# sqlite index range scan, and the summary counts are kept per day as tasks come and go
+class MemoryRepository:
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.RLock()
+        self._users = {} # id -> user dict
+        self._user_ids = {} # username -> id
+        self._tasks = {} # user id -> {task id: row}
+        self._order = {} # user id -> sorted [(date, id)]
+        self._days = {} # user id -> Counter of tasks per date
+        self._archive = {} # user id -> {task id: row}
+        self._rules = {} # user id -> {rule id: rule dict}
+        self._changes = [] # change dicts (plus user id and time) in seq order
+        self._user_seqs = {} # user id -> seq of their newest change
+        self._last_task = self._last_seq = self._last_rule = 0
+
+    # cookie values arrive as strings - anything that isn't a user id matches nobody
+    @staticmethod
+    def _user(user_id):
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+    def migrate(self):
+        return []
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+    def databases(self):
+        return []
+
+    # users
+
+    def create_user(self, username, password_hash):
+        with self._lock:
+            if username in self._user_ids:
+                raise UserExists(username)
+            user_id = len(self._users) + 1
+            self._users[user_id] = {'id': user_id, 'username': username, 'password': password_hash,
+                                    'archive_after_days': None}
+            self._user_ids[username] = user_id
+            return user_id
+
+    def get_user(self, username):
+        with self._lock:
+            user = self._users.get(self._user_ids.get(username))
+            return dict(user) if user else None
+
+    def update_password(self, user_id, password_hash):
+        with self._lock:
+            self._users[self._user(user_id)]['password'] = password_hash
+
+    def get_retention(self, user_id):
+        with self._lock:
+            user = self._users.get(self._user(user_id))
+            return user['archive_after_days'] if user else None
+
+    def set_retention(self, user_id, days):
+        with self._lock:
+            self._users[self._user(user_id)]['archive_after_days'] = days
+
+    def list_retention(self, default_days):
+        with self._lock:
+            return [(user['id'], default_days if user['archive_after_days'] is None else user['archive_after_days'])
+                    for user in self._users.values()]
+
+    # task writes
+
+    def _log(self, user_id, op, row=None):
+        self._last_seq += 1
+        change = {'seq': self._last_seq, 'op': op}
+        if row:
+            change.update(id=row['id'], date=row['date'])
+            if op == 'add':
+                change.update(task=row['task'], display_date=row['display_date'])
+        self._changes.append((user_id, time.time(), change))
+        self._user_seqs[user_id] = self._last_seq
+
+    def _remove(self, user_id, task_id):
+        row = self._tasks[user_id].pop(task_id)
+        order = self._order[user_id]
+        del order[bisect.bisect_left(order, (row['date'], task_id))]
+        self._days[user_id][row['date']] -= 1
+        if not self._days[user_id][row['date']]:
+            del self._days[user_id][row['date']]
+        return row
+
+    def insert_tasks(self, user_id, tasks):
+        user_id = self._user(user_id)
+        tasks = list(tasks)
+        for task, task_date in tasks:
+            if not isinstance(task, str) or not isinstance(task_date, str):
+                raise ValueError("task and date are required")
+        with self._lock:
+            for task, task_date in tasks:
+                self._last_task += 1
+                row = {'id': self._last_task, 'task': task, 'date': task_date, 'user_id': user_id,
+                       'display_date': _display_date(task_date)}
+                self._tasks.setdefault(user_id, {})[row['id']] = row
+                bisect.insort(self._order.setdefault(user_id, []), (task_date, row['id']))
+                self._days.setdefault(user_id, Counter())[task_date] += 1
+                self._log(user_id, 'add', row)
+        return len(tasks)
+
+    def delete_tasks(self, user_id, task_ids):
+        user_id = self._user(user_id)
+        deleted = 0
+        with self._lock:
+            for task_id in task_ids:
+                if task_id in self._tasks.get(user_id, {}):
+                    self._log(user_id, 'delete', self._remove(user_id, task_id))
+                    deleted += 1
+        return deleted
+
+    def clear_tasks(self, user_id):
+        user_id = self._user(user_id)
+        with self._lock:
+            deleted = len(self._tasks.pop(user_id, {}))
+            self._order.pop(user_id, None)
+            self._days.pop(user_id, None)
+            self._rules.pop(user_id, None)
+            self._log(user_id, 'clear')
+        return deleted
+
+    def import_rows(self, user_id, rows, chunk_size=5000):
+        return transfer.import_rows(lambda pairs: self.insert_tasks(user_id, pairs), rows, chunk_size)
+
+    # recurring rules
+
+    def create_rule(self, user_id, task, freq, every, start, until=None):
+        with self._lock:
+            self._last_rule += 1
+            self._rules.setdefault(self._user(user_id), {})[self._last_rule] = {
+                'id': self._last_rule, 'task': task, 'freq': freq, 'every': every, 'start': start, 'until': until,
+                'exdates': []}
+            return self._last_rule
+
+    def delete_rule(self, user_id, rule_id):
+        with self._lock:
+            return 1 if self._rules.get(self._user(user_id), {}).pop(rule_id, None) else 0
+
+    def skip_occurrence(self, user_id, rule_id, occurrence_date):
+        with self._lock:
+            rule = self._rules.get(self._user(user_id), {}).get(rule_id)
+            if rule is None or not recurrence.is_occurrence(rule, occurrence_date):
+                return 0
+            rule['exdates'].append(occurrence_date)
+            return 1
+
+    def list_rules(self, user_id, date_from=None, date_to=None):
+        with self._lock:
+            return [dict(rule, exdates=list(rule['exdates']))
+                    for rule in self._rules.get(self._user(user_id), {}).values()
+                    if (not date_to or rule['start'] <= date_to)
+                    and (not date_from or not rule['until'] or rule['until'] >= date_from)]
+
+    # task reads
+
+    def _source(self, user_id, archived):
+        if archived:
+            rows = self._archive.get(user_id, {})
+            return rows, sorted((row['date'], row['id']) for row in rows.values())
+        return self._tasks.get(user_id, {}), self._order.get(user_id, [])
+
+    # (date, id) keys of the user's tasks in the window, after the cursor
+    def _keys(self, user_id, after, date_from, date_to, archived):
+        rows, order = self._source(user_id, archived)
+        start = bisect.bisect_right(order, tuple(after)) if after else 0
+        if date_from:
+            start = max(start, bisect.bisect_left(order, (date_from,)))
+        end = bisect.bisect_right(order, (date_to, float('inf'))) if date_to else len(order)
+        return rows, order[start:end]
+
+    def count_tasks(self, user_id, date_from=None, date_to=None, archived=False):
+        with self._lock:
+            return len(self._keys(self._user(user_id), None, date_from, date_to, archived)[1])
+
+    def iter_tasks(self, user_id, after=None, limit=50, date_from=None, date_to=None, archived=False):
+        with self._lock:
+            rows, keys = self._keys(self._user(user_id), after, date_from, date_to, archived)
+            page = [dict(rows[task_id]) for _, task_id in keys[:limit + 1]]
+        return taskstore.TaskPage((row for row in page), limit)
+
+    def list_tasks(self, user_id, after=None, limit=50, date_from=None, date_to=None):
+        page = self.iter_tasks(user_id, after=after, limit=limit, date_from=date_from, date_to=date_to)
+        rows = list(page)
+        return rows, page.next_cursor
+
+    def iter_user_tasks(self, user_id):
+        with self._lock:
+            rows, keys = self._keys(self._user(user_id), None, None, None, False)
+            return [dict(rows[task_id]) for _, task_id in keys]
+
+    # every word has to appear in the task (the last one as a prefix), like the sqlite search -
+    # results come in (date, id) order since there is no ranking here
+    def search_tasks(self, user_id, text, page=1, limit=50):
+        words = _words(text)
+        if not words:
+            return [], False
+        with self._lock:
+            rows, keys = self._keys(self._user(user_id), None, None, None, False)
+            matches = []
+            for _, task_id in keys:
+                task_words = _words(rows[task_id]['task'])
+                if (all(word in task_words for word in words[:-1])
+                        and any(word.startswith(words[-1]) for word in task_words)):
+                    matches.append(dict(rows[task_id]))
+        found = matches[(page - 1) * limit:page * limit + 1]
+        return found[:limit], len(found) > limit
+
+    def get_stats(self, user_id, today, days=14):
+        user_id = self._user(user_id)
+        with self._lock:
+            counts = dict(self._days.get(user_id, {}))
+        return {'total': sum(counts.values()), 'today': counts.get(today, 0),
+                'overdue': sum(count for day, count in counts.items() if day < today),
+                'days': [{'date': day, 'tasks': counts.get(day, 0)} for day in taskstore.upcoming_days(today, days)]}
+
+    def rebuild_stats(self):
+        with self._lock:
+            self._days = {user_id: Counter(row['date'] for row in rows.values())
+                          for user_id, rows in self._tasks.items()}
+            return len(self._days)
+
+    # change log and archive
+
+    def latest_seq(self, user_id=None):
+        return self._last_seq
+
+    def user_seq(self, user_id):
+        with self._lock:
+            return self._user_seqs.get(self._user(user_id), 0)
+
+    def get_changes(self, user_id, since, limit=500):
+        user_id = self._user(user_id)
+        with self._lock:
+            first = self._changes[0][2]['seq'] if self._changes else self._last_seq + 1
+            if self._changes and since + 1 < first:
+                return [], True
+            # seqs are consecutive (pruning only ever drops the oldest entries), so `since` gives the position
+            start = max(since + 1 - first, 0)
+            found = [dict(change) for owner, _, change in self._changes[start:] if owner == user_id]
+        return found[:limit], False
+
+    def prune_changes(self, days):
+        cutoff = time.time() - days * 86400
+        with self._lock:
+            keep = [entry for entry in self._changes[:-1] if entry[1] >= cutoff] + self._changes[-1:]
+            removed = len(self._changes) - len(keep)
+            self._changes = keep
+        return removed
+
+    def archive_chunk(self, user_id, cutoff, chunk_size):
+        user_id = self._user(user_id)
+        with self._lock:
+            order = self._order.get(user_id, [])
+            old = order[:bisect.bisect_left(order, (cutoff,))]
+            for _, task_id in old[:chunk_size]:
+                row = self._remove(user_id, task_id)
+                self._archive.setdefault(user_id, {})[task_id] = row
+                self._log(user_id, 'delete', row)
+        return min(len(old), chunk_size), len(old) <= chunk_size
+
+BACKENDS = {
+    'sqlite': SqliteRepository,
+    'sqlite-memory': SqliteMemoryRepository,
+    'sqlite-sharded': ShardedSqliteRepository,
+    'memory': MemoryRepository,
+}
+
+# returns the repository for the current app
+def get_repository(app=None):
+    app = app or current_app
+    return app.extensions['repository']
+
+# pick the storage backend for an app - call after the app's config is final
+def init_app(app):
+    app.config.setdefault('STORAGE', 'sqlite') # 'sqlite', 'sqlite-memory', 'sqlite-sharded' or 'memory'
+    app.config.setdefault('SHARD_COUNT', 4) # shards for 'sqlite-sharded' when SHARD_DATABASES isn't set
+    app.config.setdefault('SHARD_DATABASES', []) # the shard files, in order (see shard_databases)
+    app.config.setdefault('SHARD_MOVE_WAIT', 10) # seconds a write waits for its user's move to another shard
+    app.extensions['repository'] = BACKENDS[app.config['STORAGE']](app)
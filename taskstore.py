@@ -0,0 +1,375 @@
+import json # the deleted occurrences of a recurring rule
+import sqlite3
+from datetime import date, timedelta # used to validate the date window filters and lay out the stats days
+import recurrence # checks a deleted occurrence belongs to its rule
+
+# task listing queries shared by the home page (and anything else that lists a user's tasks)
+# tasks are always ordered by (date, id), which is exactly the order of idx_tasks_user_listing,
+# so every page is an index range scan no matter how deep into the list it is
+# the listing functions take table='tasks_archive' to read archived tasks instead (see archive.py), which
+# have the same columns and the same index
+
+# turn a YYYY-MM-DD string from the query string into a date string, or None when missing/invalid
+# (anything that isn't a string, e.g. a number in a json body, is invalid too)
+def parse_date(value):
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        return None
+
+# the position of a row in the (date, id) ordering, used as the "after" cursor for the next page
+def encode_cursor(task_date, task_id):
+    return f"{task_date}:{task_id}"
+
+# inverse of encode_cursor - returns (date, id) or None when the cursor is missing or malformed
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    task_date, _, task_id = cursor.rpartition(':')
+    if not parse_date(task_date) or not task_id.isdigit():
+        return None
+    return task_date, int(task_id)
+
+# WHERE clause (and its parameters) for one user's tasks inside an optional date window
+def _window(user_id, date_from=None, date_to=None):
+    clauses = ['user_id = ?']
+    params = [user_id]
+    if date_from:
+        clauses.append('date >= ?')
+        params.append(date_from)
+    if date_to:
+        clauses.append('date <= ?')
+        params.append(date_to)
+    return ' AND '.join(clauses), params
+
+# how many tasks the user has in the window - answered from the index, no rows are read
+def count_tasks(conn, user_id, date_from=None, date_to=None, table='tasks'):
+    where, params = _window(user_id, date_from, date_to)
+    return conn.execute(f'SELECT COUNT(*) FROM {table} WHERE {where}', params).fetchone()[0]
+
+# the task date reformatted from YYYY-MM-DD to MM/DD/YYYY by sqlite, so rows can go straight to the template
+DISPLAY_DATE = "substr(date, 6, 2) || '/' || substr(date, 9, 2) || '/' || substr(date, 1, 4)"
+
+# a page of tasks that is read lazily from the cursor while it is iterated
+# once iteration finishes, next_cursor holds the cursor for the following page (None on the last page)
+class TaskPage:
+    def __init__(self, cursor, limit):
+        self._cursor = cursor
+        self._limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        try:
+            for count, row in enumerate(self._cursor):
+                # the query asks for one row more than the page size - seeing it means there is another page
+                if count == self._limit:
+                    self.next_cursor = encode_cursor(last['date'], last['id'])
+                    break
+                last = row
+                yield row
+        finally:
+            self._cursor.close()
+
+# one page of the user's tasks starting after the (date, id) cursor, as a lazily read TaskPage
+def iter_tasks(conn, user_id, after=None, limit=50, date_from=None, date_to=None, table='tasks'):
+    where, params = _window(user_id, date_from, date_to)
+    if after:
+        # row value comparison - sqlite turns this into a seek on the index instead of an OFFSET scan
+        where += ' AND (date, id) > (?, ?)'
+        params.extend(after)
+
+    # fetch one extra row to find out whether there is another page without a second query
+    cursor = conn.execute(f'SELECT id, task, date, {DISPLAY_DATE} AS display_date FROM {table} '
+                          f'WHERE {where} ORDER BY date, id LIMIT ?', params + [limit + 1])
+    return TaskPage(cursor, limit)
+
+# same as iter_tasks but reads the whole page up front - returns (rows, next_cursor)
+def list_tasks(conn, user_id, after=None, limit=50, date_from=None, date_to=None, table='tasks'):
+    page = iter_tasks(conn, user_id, after=after, limit=limit, date_from=date_from, date_to=date_to, table=table)
+    rows = list(page)
+    return rows, page.next_cursor
+
+# turn what the user typed into an FTS5 query for their own tasks - every word must match (the last one
+# as a prefix, so results show up while typing); words are quoted so FTS syntax in the input is just text
+# returns None when there is nothing to search for, or the user id (it comes from a cookie) isn't a number -
+# only then can it go into the query unescaped
+def build_match_query(user_id, text):
+    words = [word.replace('"', '""') for word in (text or '').split()]
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    if not words:
+        return None
+    terms = ' '.join(f'"{word}"' for word in words) + '*'
+    return f'user_id : "{user_id}" AND task : ({terms})'
+
+# one page of the user's tasks matching the search text, best match first - returns (rows, has_more)
+# bm25 weights ignore the user_id column, which only scopes the search
+def search_tasks(conn, user_id, text, page=1, limit=50):
+    match = build_match_query(user_id, text)
+    if match is None:
+        return [], False
+    rows = conn.execute(f'''
+        SELECT tasks.id, tasks.task, tasks.date, {DISPLAY_DATE} AS display_date
+        FROM tasks_fts JOIN tasks ON tasks.id = tasks_fts.rowid
+        WHERE tasks_fts MATCH ? AND tasks.user_id = ?
+        ORDER BY bm25(tasks_fts, 1.0, 0.0), tasks.id
+        LIMIT ? OFFSET ?
+    ''', (match, user_id, limit + 1, (page - 1) * limit)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+# the homepage summary, read from the trigger maintained counts (migration 6) instead of the tasks:
+# {'total', 'today', 'overdue', 'days': [{'date', 'tasks'}, ...]} with `days` entries starting today
+# total and today are single row reads and the days one short range; overdue sums one row per earlier day that
+# still has tasks, however many tasks those days hold - so it is O(past days with tasks), not O(1), and grows
+# with the user's history unless archiving (archive.py) moves old tasks out of task_stats
+def get_stats(conn, user_id, today, days=14):
+    total = conn.execute('SELECT tasks FROM task_totals WHERE user_id = ?', (user_id,)).fetchone()
+    overdue = conn.execute('SELECT COALESCE(SUM(tasks), 0) FROM task_stats WHERE user_id = ? AND date < ?',
+                           (user_id, today)).fetchone()[0]
+    upcoming = upcoming_days(today, days)
+    counts = dict(conn.execute('SELECT date, tasks FROM task_stats WHERE user_id = ? AND date BETWEEN ? AND ?',
+                               (user_id, upcoming[0], upcoming[-1])).fetchall())
+    return {'total': total[0] if total else 0, 'today': counts.get(today, 0), 'overdue': overdue,
+            'days': [{'date': day, 'tasks': counts.get(day, 0)} for day in upcoming]}
+
+# `days` consecutive YYYY-MM-DD dates starting at `today`
+def upcoming_days(today, days):
+    start = date.fromisoformat(today)
+    return [(start + timedelta(days=n)).isoformat() for n in range(days)]
+
+# recount task_totals and task_stats from the tasks table (for databases whose counts have drifted, e.g. after
+# rows were changed with the triggers dropped) - returns the number of users counted
+def rebuild_stats(conn):
+    conn.execute('DELETE FROM task_totals')
+    conn.execute('DELETE FROM task_stats')
+    conn.execute('INSERT INTO task_stats (user_id, date, tasks) '
+                 'SELECT user_id, date, COUNT(*) FROM tasks WHERE user_id IS NOT NULL GROUP BY user_id, date')
+    return conn.execute('INSERT INTO task_totals (user_id, tasks) '
+                        'SELECT user_id, COUNT(*) FROM tasks WHERE user_id IS NOT NULL GROUP BY user_id').rowcount
+
+# insert many (task, date) pairs for a user in one executemany - returns the number of rows added
+# the caller's `with conn:` block makes the whole batch one transaction
+def insert_tasks(conn, user_id, tasks):
+    cursor = conn.executemany('INSERT INTO tasks (task, date, user_id) VALUES (?, ?, ?)',
+                              ((task, task_date, user_id) for task, task_date in tasks))
+    return cursor.rowcount
+
+# delete tasks by id - the user_id check makes sure a user can only delete their own tasks
+def delete_tasks(conn, user_id, task_ids):
+    cursor = conn.executemany('DELETE FROM tasks WHERE id = ? AND user_id = ?',
+                              ((task_id, user_id) for task_id in task_ids))
+    return cursor.rowcount
+
+# delete every task (and recurring rule) the user has - returns how many tasks were removed
+# the change log gets one 'clear' entry instead of one 'delete' per task (see migration 5)
+def clear_tasks(conn, user_id):
+    log_clear(conn, user_id)
+    conn.execute('DELETE FROM task_rules WHERE user_id = ?', (user_id,))
+    return conn.execute('DELETE FROM tasks WHERE user_id = ?', (user_id,)).rowcount
+
+# change log (migration 5, see changefeed.py)
+
+# the 'clear' entry - the delete trigger doesn't log the user's deletes that come straight after it
+def log_clear(conn, user_id):
+    conn.execute("INSERT INTO task_changes (user_id, op) VALUES (?, 'clear')", (user_id,))
+
+CHANGE_COLUMNS = f'seq, op, task_id, task, date, {DISPLAY_DATE} AS display_date'
+
+# the newest seq in the log (0 when it is empty)
+def latest_seq(conn):
+    return conn.execute('SELECT MAX(seq) FROM task_changes').fetchone()[0] or 0
+
+# the newest seq of one user's changes (0 when they have none) - read from idx_task_changes_user
+def user_seq(conn, user_id):
+    return conn.execute('SELECT MAX(seq) FROM task_changes WHERE user_id = ?', (user_id,)).fetchone()[0] or 0
+
+# a change log row as the dict the api and the page's script use
+def change_dict(row):
+    change = {'seq': row['seq'], 'op': row['op']}
+    if row['op'] not in ('clear', 'reset'):
+        change.update(id=row['task_id'], date=row['date'])
+    if row['op'] == 'add':
+        change.update(task=row['task'], display_date=row['display_date'])
+    return change
+
+# the user's changes after `since`, oldest first - returns (changes, reset)
+# reset is True when entries after `since` have already been pruned, so the client has to reload the list
+def get_changes(conn, user_id, since, limit=500):
+    oldest = conn.execute('SELECT MIN(seq) FROM task_changes').fetchone()[0]
+    if oldest is not None and since + 1 < oldest:
+        return [], True
+    rows = conn.execute(f'SELECT {CHANGE_COLUMNS} FROM task_changes WHERE user_id = ? AND seq > ? '
+                        'ORDER BY seq LIMIT ?', (user_id, since, limit)).fetchall()
+    return [change_dict(row) for row in rows], False
+
+# drop entries older than `days` - the newest entry is always kept, so get_changes can still tell a client
+# that missed pruned entries apart from one that is up to date
+def prune_changes(conn, days):
+    return conn.execute("DELETE FROM task_changes WHERE created_at < datetime('now', ?) "
+                        'AND seq < (SELECT MAX(seq) FROM task_changes)', (f'-{days} days',)).rowcount
+
+# start the log over after a restore - `seq` is the newest seq handed out before it; every user gets a 'reset'
+# numbered past it, so open tabs reload the list, and no seq (or homepage ETag) from before the restore is reused
+# (it isn't a 'clear', which would stop the delete trigger logging the user's next deletes)
+def restart_changes(conn, seq):
+    users = [row[0] for row in conn.execute('SELECT user_id FROM task_changes UNION SELECT user_id FROM tasks')]
+    conn.execute('DELETE FROM task_changes')
+    bump_sequence(conn, 'task_changes', seq + 1)
+    conn.executemany("INSERT INTO task_changes (user_id, op) VALUES (?, 'reset')", [(user_id,) for user_id in users])
+
+# archive (migration 7, see archive.py)
+
+# (user_id, retention days) for every user - users.archive_after_days, or `default_days` when unset
+def list_retention(conn, default_days):
+    return [tuple(row) for row in
+            conn.execute('SELECT id, COALESCE(archive_after_days, ?) FROM users', (default_days,)).fetchall()]
+
+# a user's retention in days (None means the default)
+def get_retention(conn, user_id):
+    row = conn.execute('SELECT archive_after_days FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+def set_retention(conn, user_id, days):
+    conn.execute('UPDATE users SET archive_after_days = ? WHERE id = ?', (days, user_id))
+
+# move one chunk of the user's tasks dated before `cutoff` to tasks_archive in its own write transaction
+# returns (moved, done) - done is True once nothing older than the cutoff is left
+def archive_chunk(conn, user_id, cutoff, chunk_size):
+    conn.commit() # make sure we aren't inside someone else's transaction
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # a user who is being moved to another shard is left alone until the move is done
+        if is_fenced(conn, user_id):
+            conn.commit()
+            return 0, True
+        # the last (date, id) of this chunk - None when everything left fits in it
+        last = conn.execute('SELECT date, id FROM tasks WHERE user_id = ? AND date < ? ORDER BY date, id '
+                            'LIMIT 1 OFFSET ?', (user_id, cutoff, chunk_size - 1)).fetchone()
+        where, params = 'user_id = ? AND date < ?', [user_id, cutoff]
+        if last:
+            where += ' AND (date, id) <= (?, ?)'
+            params.extend(last)
+        conn.execute(f'INSERT INTO tasks_archive (id, task, date, user_id) '
+                     f'SELECT id, task, date, user_id FROM tasks WHERE {where}', params)
+        moved = conn.execute(f'DELETE FROM tasks WHERE {where}', params).rowcount
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return moved, last is None
+
+# shards (migration 8, see storage.ShardedSqliteRepository)
+
+# the shard recorded for a user in the directory, or None
+def get_shard(conn, user_id):
+    row = conn.execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+def set_shard(conn, user_id, shard):
+    conn.execute('INSERT INTO user_shards (user_id, shard) VALUES (?, ?) '
+                 'ON CONFLICT (user_id) DO UPDATE SET shard = excluded.shard', (user_id, shard))
+
+# {user_id: shard} for every user in the directory
+def list_shards(conn):
+    return dict(conn.execute('SELECT user_id, shard FROM user_shards').fetchall())
+
+# (user_id, live task count) for every user with tasks in this database
+def count_user_tasks(conn):
+    return [tuple(row) for row in conn.execute('SELECT user_id, tasks FROM task_totals WHERE tasks > 0').fetchall()]
+
+def is_fenced(conn, user_id):
+    return conn.execute('SELECT 1 FROM shard_fences WHERE user_id = ?', (user_id,)).fetchone() is not None
+
+def fence_user(conn, user_id):
+    conn.execute('INSERT OR IGNORE INTO shard_fences (user_id) VALUES (?)', (user_id,))
+
+def unfence_user(conn, user_id):
+    conn.execute('DELETE FROM shard_fences WHERE user_id = ?', (user_id,))
+
+# the highest value a table's AUTOINCREMENT has handed out (0 when it hasn't been used)
+def get_sequence(conn, table):
+    row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    return row[0] if row else 0
+
+# make a table's AUTOINCREMENT carry on from at least `value`
+def bump_sequence(conn, table, value):
+    if not conn.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (value, table)).rowcount:
+        conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, value))
+
+# one chunk of the user's rows from `table` (tasks or tasks_archive) after the (date, id) key `after`
+def read_user_chunk(conn, table, user_id, after, chunk_size):
+    columns = 'id, task, date, archived_at' if table == 'tasks_archive' else 'id, task, date'
+    where, params = 'user_id = ?', [user_id]
+    if after:
+        where += ' AND (date, id) > (?, ?)'
+        params.extend(after)
+    return conn.execute(f'SELECT {columns} FROM {table} WHERE {where} ORDER BY date, id LIMIT ?',
+                        params + [chunk_size]).fetchall()
+
+# add archived rows for a user (inside a write transaction) - they get new ids, taken from the tasks
+# AUTOINCREMENT so they can never collide with tasks archived later
+def insert_archived(conn, user_id, rows):
+    start = get_sequence(conn, 'tasks')
+    bump_sequence(conn, 'tasks', start + len(rows))
+    conn.executemany('INSERT INTO tasks_archive (id, task, date, user_id, archived_at) VALUES (?, ?, ?, ?, ?)',
+                     ((start + n, row['task'], row['date'], user_id, row['archived_at'])
+                      for n, row in enumerate(rows, 1)))
+    return len(rows)
+
+# delete up to `chunk_size` of the user's rows from `table` - returns how many went
+def delete_user_chunk(conn, table, user_id, chunk_size):
+    return conn.execute(f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE user_id = ? LIMIT ?)',
+                        (user_id, chunk_size)).rowcount
+
+# recurring rules (migration 9, see recurrence.py)
+
+RULE_COLUMNS = 'id, task, freq, every, start, until, exdates'
+
+# a rule row as the dict recurrence.py works with
+def rule_dict(row):
+    return {'id': row['id'], 'task': row['task'], 'freq': row['freq'], 'every': row['every'],
+            'start': row['start'], 'until': row['until'], 'exdates': json.loads(row['exdates'])}
+
+def insert_rule(conn, user_id, task, freq, every, start, until=None):
+    return conn.execute('INSERT INTO task_rules (user_id, task, freq, every, start, until) VALUES (?, ?, ?, ?, ?, ?)',
+                        (user_id, task, freq, every, start, until)).lastrowid
+
+def delete_rule(conn, user_id, rule_id):
+    return conn.execute('DELETE FROM task_rules WHERE id = ? AND user_id = ?', (rule_id, user_id)).rowcount
+
+# the user's rules that can have occurrences from `date_from` to `date_to` (all of them without a window)
+def list_rules(conn, user_id, date_from=None, date_to=None):
+    where, params = 'user_id = ?', [user_id]
+    if date_to:
+        where += ' AND start <= ?'
+        params.append(date_to)
+    if date_from:
+        where += ' AND (until IS NULL OR until >= ?)'
+        params.append(date_from)
+    rows = conn.execute(f'SELECT {RULE_COLUMNS} FROM task_rules WHERE {where} ORDER BY id', params)
+    return [rule_dict(row) for row in rows]
+
+# delete one occurrence of a rule by adding its date to the rule's exdates - returns 1, or 0 when the rule isn't
+# the user's or the date isn't one of its (remaining) occurrences
+def skip_occurrence(conn, user_id, rule_id, occurrence_date):
+    row = conn.execute(f'SELECT {RULE_COLUMNS} FROM task_rules WHERE id = ? AND user_id = ?',
+                       (rule_id, user_id)).fetchone()
+    if row is None or not recurrence.is_occurrence(rule_dict(row), occurrence_date):
+        return 0
+    # the json check makes a second delete of the same date (from another request) a no-op
+    return conn.execute("UPDATE task_rules SET exdates = json_insert(exdates, '$[#]', ?) WHERE id = ? "
+                        'AND NOT EXISTS (SELECT 1 FROM json_each(exdates) WHERE value = ?)',
+                        (occurrence_date, rule_id, occurrence_date)).rowcount
+
+# copy rules (from list_rules) to a user - they get new ids
+def insert_rules(conn, user_id, rules):
+    conn.executemany('INSERT INTO task_rules (user_id, task, freq, every, start, until, exdates) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     ((user_id, rule['task'], rule['freq'], rule['every'], rule['start'], rule['until'],
+                       json.dumps(rule['exdates'])) for rule in rules))
+    return len(rules)
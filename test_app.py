@@ -1,19 +1,28 @@
 import pytest
 import sqlite3
 import random
-from app import app as flask_app
+import json
+import io
+import time
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import migrations
 from app import *
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def app():
     """
-    Fixture to provide the Flask app for testing.
+    Fixture to provide the Flask app for testing - one per test session (so one per pytest worker),
+    with its own in-memory database instead of tasks.db
     :return: Flask app instance
     """
-    flask_app.config["TESTING"] = True
-    return flask_app
+    return create_app({"TESTING": True,
+                       "STORAGE": "sqlite-memory",
+                       "WEATHER_PROVIDER": "fake", # no network calls from the tests
+                       "RATE_LIMIT_ENABLED": False}) # the tests log in and register far more often than a person
 
     
 @pytest.fixture
@@ -25,12 +34,13 @@ def client(app):
     """
     return app.test_client()
 
-def test_get_db_connection():
+def test_get_db_connection(app):
     """
     Test if get_db_connection() returns a valid SQLite connection
+    :param app: Flask app instance
     """
     # Use 'with' to automatically close the connection when done
-    with get_db_connection() as conn:
+    with app.app_context(), get_db_connection() as conn:
         # Check if it's a valid sqlite3.Connection object
         assert isinstance(conn, sqlite3.Connection)
 
@@ -43,17 +53,41 @@ def test_get_db_connection():
         result = cursor.fetchone()
         assert result[0] == 1
 
-def test_init_db():
+def test_get_db_connection_shared_per_request(tmp_path):
+    """
+    Test that every get_db_connection() call during a request shares one pooled connection,
+    and that the connection goes back to the pool once the request ends
+    :param tmp_path: scratch directory provided by pytest (the WAL pragmas need a database file)
+    """
+    app = create_app({"TESTING": True, "DATABASE": str(tmp_path / "pool.db")})
+    with app.test_request_context():
+        first = get_db_connection()
+        assert get_db_connection() is first
+
+        # the tuning pragmas should be applied to pooled connections
+        assert first.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert first.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+    # the next request should reuse the connection instead of opening a new one
+    with app.test_request_context():
+        assert get_db_connection() is first
+
+    stats = db.get_pool(app).stats()
+    assert stats['reused'] >= 1
+    assert stats['idle'] >= 1
+
+def test_init_db(app):
     """
     Test the init_db function to ensure that the database tables are created correctly
     and that the database is initialized properly.
+    :param app: Flask app instance
     """
 
     # Call the init_db function
-    init_db()
+    init_db(app)
 
     # Check if the tables exist by querying the sqlite_master table
-    with get_db_connection() as conn:
+    with app.app_context(), get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         tables = [table[0] for table in cursor.fetchall()]
@@ -63,6 +97,233 @@ def test_init_db():
         assert 'tasks' in tables
 
 
+def test_migrations(tmp_path):
+    """
+    Test that migrations bring a new database up to the latest version with the task indexes,
+    and that a database that is already current is left alone (no DDL, only the version read)
+    :param tmp_path: scratch directory provided by pytest
+    """
+    conn = sqlite3.connect(tmp_path / "scratch.db")
+    assert migrations.migrate(conn) == [version for version, _ in migrations.MIGRATIONS]
+    assert migrations.get_version(conn) == migrations.LATEST_VERSION
+
+    indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+    assert 'idx_tasks_user_listing' in indexes
+
+    # the home listing query should be answered from the covering index
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT id, task, date FROM tasks WHERE user_id = ? ORDER BY date, id',
+                        (1,)).fetchall()
+    assert 'COVERING INDEX idx_tasks_user_listing' in plan[0][-1]
+
+    # running again on a current database should only read the version
+    statements = []
+    conn.set_trace_callback(statements.append)
+    assert migrations.migrate(conn) == []
+    assert statements == ['PRAGMA user_version']
+    conn.close()
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite-memory"])
+def test_storage_backends(backend):
+    """
+    Test that the routes behave the same on the in-memory storage backends - each app gets its own store
+    :param backend: STORAGE setting for the app under test
+    """
+    app = create_app({"TESTING": True, "STORAGE": backend, "WEATHER_PROVIDER": "fake"})
+    client = app.test_client()
+    register_test_user(client, "testuser", "testpassword")
+    assert client.post('/register', data={"username": "testuser", "password": "x"}).data == b"Username already exists!"
+    assert client.post("/login", data={"username": "testuser", "password": "testpassword"}).status_code == 302
+
+    client.post('/api/tasks', json={"tasks": [{"task": "Water plants", "date": "2025-03-02"},
+                                              {"task": "Buy milk", "date": "2025-03-01"},
+                                              {"task": "Buy bread", "date": "2025-03-03"}]})
+    first = client.get('/api/tasks?limit=2').get_json()
+    assert [task['task'] for task in first['tasks']] == ["Buy milk", "Water plants"]
+    assert first['total'] == 3
+    second = client.get(f"/api/tasks?limit=2&after={first['next']}").get_json()
+    assert [task['task'] for task in second['tasks']] == ["Buy bread"]
+    assert b"03/01/2025" in client.get('/home').data
+
+    assert {task['task'] for task in client.get('/api/search?q=buy').get_json()['tasks']} == {"Buy milk", "Buy bread"}
+    assert client.get('/api/stats').get_json()['total'] == 3
+
+    client.delete('/api/tasks', json={"ids": [first['tasks'][0]['id']]})
+    changes = client.get('/api/tasks/changes?since=0').get_json()['changes']
+    assert [change['op'] for change in changes] == ['add', 'add', 'add', 'delete']
+
+    # another app's store is separate
+    other = create_app({"TESTING": True, "STORAGE": backend}).test_client()
+    other.set_cookie('user_id', '1')
+    assert other.get('/api/tasks').get_json()['total'] == 0
+
+def test_sharded_storage(tmp_path):
+    """
+    Test the sharded sqlite backend - users on different shards write in parallel, and a user can be moved
+    to another shard with their tasks, archive and counts while their writes wait for the move
+    :param tmp_path: directory for the shard files
+    """
+    app = create_app({"TESTING": True, "STORAGE": "sqlite-sharded", "SHARD_COUNT": 2, "WEATHER_PROVIDER": "fake",
+                      "DATABASE": str(tmp_path / "tasks.db"), "SHARD_MOVE_PAUSE": 0, "SHARD_MOVE_CHUNK_SIZE": 2,
+                      "SHARD_MOVE_WAIT": 0.2})
+    repo = storage.get_repository(app)
+    assert repo.shards == [str(tmp_path / "tasks.db"), str(tmp_path / "tasks.shard1.db")]
+    with app.app_context():
+        first = repo.create_user("first", "hash")
+        second = next(user_id for user_id in (repo.create_user(f"user{n}", "hash") for n in range(20))
+                      if repo.shard_of(user_id) != repo.shard_of(first))
+    source = repo.shard_of(first)
+    client = app.test_client()
+    client.set_cookie('user_id', str(first))
+    client.post('/api/tasks', json={"tasks": [{"task": f"Task {n}", "date": f"2025-01-0{n}"} for n in range(1, 6)]})
+    with app.app_context():
+        assert repo.archive_chunk(first, "2025-01-03", 10) == (2, True)
+    old_ids = [task['id'] for task in client.get('/api/tasks').get_json()['tasks']]
+
+    # holding the write lock on the first user's shard doesn't hold up the other shard
+    lock = sqlite3.connect(repo.shards[source])
+    lock.execute('BEGIN IMMEDIATE')
+    other = app.test_client()
+    other.set_cookie('user_id', str(second))
+    assert other.post('/api/tasks', json={"tasks": [{"task": "Elsewhere"}]}).status_code == 201
+    lock.rollback()
+    lock.close()
+
+    # a fenced user's writes wait, then give up
+    with app.app_context():
+        with db.get_connection(app, repo.shards[source]) as conn:
+            taskstore.fence_user(conn, first)
+        assert add_task("Blocked", first, "2025-02-01") is False
+        with db.get_connection(app, repo.shards[source]) as conn:
+            taskstore.unfence_user(conn, first)
+
+    # the move runs in another process (flask move-user), whose page cache isn't this app's - the homepage
+    # still has to stop answering 304 to the page with the old ids
+    etag = client.get('/home').headers['ETag']
+    assert client.get('/home', headers={'If-None-Match': etag}).status_code == 304
+    cli = create_app(dict(app.config))
+    assert shards.move_user(first, 1 - source, cli) == 5
+    assert client.get('/home', headers={'If-None-Match': etag}).status_code == 200
+    storage.get_repository(cli).close()
+    assert repo.shard_of(first) == 1 - source
+    assert repo.shard_of(first) == 1 - source
+    tasks = client.get('/api/tasks').get_json()
+    assert [task['task'] for task in tasks['tasks']] == ["Task 3", "Task 4", "Task 5"]
+    assert min(task['id'] for task in tasks['tasks']) > max(old_ids)
+    assert client.get('/api/stats').get_json()['total'] == 3
+    assert client.get('/api/search?q=task').get_json()['tasks']
+    with app.app_context():
+        assert repo.count_tasks(first, archived=True) == 2
+        assert client.post('/home', data={"task": "After the move", "date": "2025-03-01"}).status_code == 302
+        assert repo.count_tasks(first) == 4
+        # nothing is left on the old shard, and it refuses the user's writes from now on
+        conn = db.get_connection(app, repo.shards[source])
+        assert conn.execute('SELECT COUNT(*) FROM tasks WHERE user_id = ?', (first,)).fetchone()[0] == 0
+        assert conn.execute('SELECT COUNT(*) FROM tasks_archive WHERE user_id = ?', (first,)).fetchone()[0] == 0
+        assert taskstore.is_fenced(conn, first)
+
+    assert shards.plan_rebalance({1: (0, 4), 2: (0, 4), 3: (0, 4)}, 3) == [(3, 0, 1), (2, 0, 2)]
+    repo.close()
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite-memory", "sqlite-sharded"])
+def test_recurring_tasks(backend, tmp_path):
+    """
+    Test recurring tasks - a rule is listed once per occurrence in the requested window, merged into the task
+    pages in date order, and deleting one occurrence only records it on the rule
+    :param backend: STORAGE setting for the app under test
+    :param tmp_path: directory for the shard files
+    """
+    import recurrence
+    app = create_app({"TESTING": True, "STORAGE": backend, "SHARD_COUNT": 2, "WEATHER_PROVIDER": "fake",
+                      "DATABASE": str(tmp_path / "tasks.db"), "SHARD_MOVE_PAUSE": 0})
+    repo = storage.get_repository(app)
+    with app.app_context():
+        user_id = repo.create_user("repeats", "hash")
+    client = app.test_client()
+    client.set_cookie('user_id', str(user_id))
+
+    standup = client.post('/api/rules', json={"task": "Standup", "freq": "weekly", "start": "2025-03-03",
+                                              "until": "2025-03-31"}).get_json()['id']
+    client.post('/api/rules', json={"task": "Rent", "freq": "monthly", "start": "2025-01-31"}) # skips february
+    assert client.post('/api/rules', json={"task": "Bad", "freq": "hourly"}).status_code == 400
+    assert client.post('/api/rules', json={"task": "Bad", "freq": "daily", "start": 5}).status_code == 400
+    client.post('/api/tasks', json={"tasks": [{"task": "Dentist", "date": "2025-03-10"},
+                                              {"task": "Taxes", "date": "2025-03-20"}]})
+
+    window = '/api/tasks?from=2025-03-01&to=2025-03-31'
+    listing = client.get(window).get_json()
+    assert listing['total'] == 8
+    assert [(task['task'], task['date']) for task in listing['tasks']] == [
+        ("Standup", "2025-03-03"), ("Dentist", "2025-03-10"), ("Standup", "2025-03-10"), ("Standup", "2025-03-17"),
+        ("Taxes", "2025-03-20"), ("Standup", "2025-03-24"), ("Standup", "2025-03-31"), ("Rent", "2025-03-31")]
+    # every page size pages through the same rows, whether a page ends on a task or on an occurrence
+    for limit in (1, 2, 3):
+        pages, cursor = [], ''
+        while cursor is not None:
+            page = client.get(f"{window}&limit={limit}&after={cursor}").get_json()
+            assert len(page['tasks']) <= limit
+            pages += page['tasks']
+            cursor = page['next']
+        assert pages == listing['tasks']
+
+    # deleting one occurrence records it on the rule - the same date again, or a date that isn't one, does nothing
+    occurrence = f'/api/rules/{standup}/occurrences/2025-03-17'
+    assert client.delete(occurrence).get_json() == {"deleted": 1}
+    assert client.delete(occurrence).get_json() == {"deleted": 0}
+    assert client.delete(f'/api/rules/{standup}/occurrences/2025-03-18').get_json() == {"deleted": 0}
+    assert client.get(window).get_json()['total'] == 7
+    page = client.get('/home?from=2025-03-01&to=2025-03-31').get_data(as_text=True)
+    assert page.count('data-rule=') == 5 and "2025-03-17" not in page
+
+    # the homepage form adds a rule, and a rule can be stopped as a whole
+    client.post('/home', data={"task": "Water plants", "date": "2025-03-01", "repeat": "daily",
+                               "until": "2025-03-05"})
+    assert client.get(window).get_json()['total'] == 12
+    # one that ends before it starts is refused with a message shown once, on a page that isn't cached
+    assert client.post('/home', data={"task": "Backwards", "date": "2025-03-10", "repeat": "daily",
+                                      "until": "2025-03-01"}).status_code == 302
+    response = client.get('/home')
+    assert "can&#39;t be before the task&#39;s date" in response.get_data(as_text=True) and response.get_etag() == (None, None)
+    assert "before the task" not in client.get('/home').get_data(as_text=True)
+    assert client.get(window).get_json()['total'] == 12
+    assert client.post(f'/delete_rule/{standup}').status_code == 302
+    assert [rule['task'] for rule in client.get('/api/rules').get_json()['rules']] == ["Rent", "Water plants"]
+
+    if backend == "sqlite-sharded":
+        shards.move_user(user_id, 1 - repo.shard_of(user_id), app)
+        assert client.get(window).get_json()['total'] == 8
+    client.post('/api/tasks/clear')
+    assert client.get('/api/rules').get_json()['rules'] == []
+
+    # counting doesn't expand the occurrences, but agrees with them
+    rule = {"id": 1, "task": "x", "freq": "daily", "every": 3, "start": "2025-01-02", "until": None,
+            "exdates": ["2025-01-08"]}
+    lo, hi = date(2025, 1, 5), date(2025, 2, 20)
+    assert recurrence.count([rule], lo, hi) == len(list(recurrence.expand([rule], lo, hi))) == 15
+
+def test_recurring_pages():
+    """
+    Test that the page size limits occurrences too - a user with only a daily rule over a century gets pages
+    of `limit` rows with a cursor to the next one, on /api/tasks and on the homepage
+    """
+    app = create_app({"TESTING": True, "STORAGE": "sqlite-memory", "WEATHER_PROVIDER": "fake"})
+    client = app.test_client()
+    with app.app_context():
+        user_id = get_repository().create_user("rules", "hash")
+    client.set_cookie('user_id', str(user_id))
+    client.post('/api/rules', json={"task": "Stretch", "freq": "daily", "start": "2000-01-01"})
+
+    window = '/api/tasks?from=2000-01-01&to=2100-12-31&limit=5'
+    first = client.get(window).get_json()
+    assert first['total'] == 36890
+    assert [task['date'] for task in first['tasks']] == [f"2000-01-0{day}" for day in range(1, 6)]
+    assert first['next'] == "2000-01-05:r1"
+    second = client.get(f"{window}&after={first['next']}").get_json()
+    assert [task['date'] for task in second['tasks']] == [f"2000-01-{day:02}" for day in range(6, 11)]
+
+    page = client.get('/home?from=2000-01-01&to=2100-12-31&limit=5').get_data(as_text=True)
+    assert page.count('data-rule=') == 5 and "after=2000-01-05:r1" in page
+
 def register_test_user(client, test_username, test_password):
     """
     Reusable function to register a test user in the database
@@ -171,6 +432,43 @@ def test_login_failure(client):
     assert response.status_code == 200
     assert b"Invalid username or password." in response.data
 
+def test_login_rehashes_outdated_password(app, client):
+    """
+    Test that logging in with a password stored using outdated hash parameters upgrades the stored hash
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    with app.app_context():
+        with get_db_connection() as conn:
+            conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                         ("testuser", generate_password_hash("testpassword", "pbkdf2:sha256:1000")))
+            conn.commit()
+
+    response = client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    assert response.status_code == 302
+
+    with app.app_context():
+        with get_db_connection() as conn:
+            stored = conn.execute('SELECT password FROM users WHERE username = ?', ("testuser",)).fetchone()['password']
+        assert stored.startswith(app.config['PASSWORD_HASH_METHOD'] + '$')
+        assert check_password_hash(stored, "testpassword")
+
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_hashing_sheds_load():
+    """
+    Test that the hasher refuses new work with HashingOverloaded once its queue is full
+    """
+    hasher = hashing.Hasher('pbkdf2:sha256:1000', workers=0, queue_limit=1)
+    assert hasher.check(hasher.hash("secret"), "secret")
+
+    # take the only slot, as if another hash were still running
+    hasher._slots.acquire()
+    with pytest.raises(hashing.HashingOverloaded):
+        hasher.hash("secret")
+    hasher._slots.release()
+
 def test_add_task_success(app, client):
     """
     Test the add_task function to ensure that valid tasks are successful and are added
@@ -231,6 +529,724 @@ def test_add_task_failure(app, client):
         removed = remove_test_user(client, app, "testuser")
         assert removed is True
 
+def test_home_pagination(app, client):
+    """
+    Test that the homepage pages through tasks with the (date, id) cursor, shows the total
+    in the badge and honours the from/to date window
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+
+    with app.app_context():
+        with get_db_connection() as conn:
+            user_id = conn.execute('SELECT id FROM users WHERE username = ?', ('testuser',)).fetchone()['id']
+        for day in range(1, 6):
+            add_task(f"Paged Task {day}", user_id, f"2025-05-0{day}")
+
+    # first page - two oldest tasks, total of all five in the badge
+    response = client.get('/home?limit=2')
+    assert b"Paged Task 1" in response.data and b"Paged Task 2" in response.data
+    assert b"Paged Task 3" not in response.data
+    assert b'rounded-pill">5<' in response.data
+
+    # the next page starts right after the last task of the first page
+    with app.app_context():
+        with get_db_connection() as conn:
+            rows, cursor = taskstore.list_tasks(conn, user_id, limit=2)
+    response = client.get(f'/home?limit=2&after={cursor}')
+    assert b"Paged Task 3" in response.data and b"Paged Task 4" in response.data
+    assert b"Paged Task 2" not in response.data
+
+    # date window
+    response = client.get('/home?from=2025-05-02&to=2025-05-03')
+    assert b"Paged Task 1" not in response.data
+    assert b"Paged Task 2" in response.data and b"Paged Task 3" in response.data
+    assert b'rounded-pill">2<' in response.data
+
+    client.post("/clear")
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_home_streaming(app, client):
+    """
+    Test that the streaming homepage renders the same task list, with dates formatted as MM/DD/YYYY
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    client.post("/home", data={"task": "Streamed Task", "date": "2025-06-07"})
+
+    response = client.get('/home?stream=1')
+    assert response.is_streamed
+    body = response.get_data()
+    assert b"Streamed Task" in body
+    assert b"06/07/2025" in body
+
+    client.post("/clear")
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_home_etag(app, client):
+    """
+    Test that the homepage sends a strong ETag, answers a matching If-None-Match with 304,
+    and that adding a task changes the ETag
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+
+    response = client.get('/home')
+    etag = response.headers['ETag']
+    assert not etag.startswith('W/')
+
+    # same version of the task list - not modified
+    response = client.get('/home', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    # a new task bumps the user's version, so the old ETag no longer matches
+    client.post("/home", data={"task": "Cached Task", "date": "2025-06-07"})
+    response = client.get('/home', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert b"Cached Task" in response.data
+
+    client.post("/clear")
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_api_tasks(app, client):
+    """
+    Test the JSON task api - batch create, paginated list, batch delete (only the user's own tasks) and clear
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    # the api needs the login cookie
+    assert client.get('/api/tasks').status_code == 401
+
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+
+    response = client.post('/api/tasks', json={"tasks": [
+        {"task": "Api Task 1", "date": "2025-07-01"},
+        {"task": "Api Task 2", "date": "2025-07-02"},
+        {"task": "Api Task 3", "date": "2025-07-03"},
+    ]})
+    assert response.status_code == 201
+    assert response.get_json()['created'] == 3
+
+    # a bad item rejects the whole batch
+    response = client.post('/api/tasks', json={"tasks": [{"task": "Ok"}, {"task": "Bad", "date": "tomorrow"}]})
+    assert response.status_code == 400
+    response = client.post('/api/tasks', json={"tasks": [{"task": "Bad", "date": 20250101}]})
+    assert response.status_code == 400
+
+    first = client.get('/api/tasks?limit=2').get_json()
+    assert [task['task'] for task in first['tasks']] == ["Api Task 1", "Api Task 2"]
+    assert first['total'] == 3
+    second = client.get(f"/api/tasks?limit=2&after={first['next']}").get_json()
+    assert [task['task'] for task in second['tasks']] == ["Api Task 3"]
+    assert second['next'] is None
+
+    # delete two by id, plus an id that doesn't belong to this user
+    ids = [task['id'] for task in first['tasks']]
+    assert client.delete('/api/tasks', json={"ids": [True]}).status_code == 400 # not task id 1
+    response = client.delete('/api/tasks', json={"ids": ids + [-1]})
+    assert response.get_json()['deleted'] == 2
+
+    response = client.post('/api/tasks/clear')
+    assert response.get_json()['deleted'] == 1
+    assert client.get('/api/tasks').get_json()['total'] == 0
+
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_import_export(app, client):
+    """
+    Test importing tasks from NDJSON and CSV uploads (invalid rows are skipped) and streaming them back out
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+
+    ndjson = '{"task": "Imported 1", "date": "2025-08-01"}\n\nnot json\n{"task": "Imported 2", "date": "2025-08-02"}\n'
+    response = client.post('/import?format=ndjson', data=ndjson)
+    assert response.get_json() == {'imported': 2, 'skipped': 1}
+
+    csv_file = (io.BytesIO(b"task,date\nImported 3,2025-08-03\n,2025-08-04\n"), 'tasks.csv')
+    response = client.post('/import', data={'file': csv_file}, content_type='multipart/form-data')
+    assert response.get_json() == {'imported': 1, 'skipped': 1}
+
+    # a field of the wrong type is just an invalid row, and bytes that aren't utf-8 are a bad request
+    response = client.post('/import?format=ndjson', data='{"task": "x", "date": 5}\n{"task": 5, "date": "2025-08-05"}\n')
+    assert response.get_json() == {'imported': 0, 'skipped': 2}
+    assert client.post('/import?format=ndjson', data=b'{"task": "\xff", "date": "2025-08-05"}\n').status_code == 400
+
+    response = client.get('/export')
+    assert response.is_streamed
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['task'] for line in lines] == ["Imported 1", "Imported 2", "Imported 3"]
+
+    response = client.get('/export?format=csv')
+    assert response.get_data(as_text=True).splitlines()[0] == "task,date"
+    assert "Imported 3,2025-08-03" in response.get_data(as_text=True)
+
+    client.post("/clear")
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_health_checks(app, client):
+    """
+    Test the liveness and readiness endpoints - readiness fails while a worker drains
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    assert client.get('/healthz').get_json() == {"status": "ok"}
+    assert client.get('/readyz').status_code == 200
+    app.extensions['draining'] = True
+    try:
+        assert client.get('/readyz').status_code == 503
+        assert client.get('/healthz').status_code == 200
+    finally:
+        app.extensions['draining'] = False
+
+def test_serve_page_cache(tmp_path, monkeypatch):
+    """
+    Test that serve.py turns the in-memory page cache off when there are several workers - each would have its
+    own versions, so a write in one worker would leave the others answering 304 to the old page
+    :param tmp_path: directory for the server's database
+    :param monkeypatch: sets the MOMENTUM_ environment the server reads its config from
+    """
+    import serve
+    monkeypatch.setenv('MOMENTUM_DATABASE', str(tmp_path / "serve.db"))
+    monkeypatch.setenv('MOMENTUM_WEATHER_PROVIDER', 'fake')
+    assert serve.preload({'SERVER_WORKERS': 1}).config['PAGE_CACHE_ENABLED'] is True
+    app = serve.preload({'SERVER_WORKERS': 2})
+    assert app.config['PAGE_CACHE_ENABLED'] is False
+
+    client = app.test_client()
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    response = client.get('/home')
+    assert response.status_code == 200 and 'ETag' not in response.headers
+
+def test_worker_server(tmp_path):
+    """
+    Test a serve.py worker on its own - requests are answered from a shared listening socket by the thread
+    pool, the worker starts with fresh per process state, and stopping it lets the requests in flight finish
+    :param tmp_path: directory for the worker's database
+    """
+    import http.client
+    import threading
+    import serve
+    app = create_app({"TESTING": True, "DATABASE": str(tmp_path / "serve.db"), "WEATHER_PROVIDER": "fake"})
+    with app.app_context():
+        get_db_connection()
+    serve.after_fork(app)
+    assert 'db_pool' not in app.extensions and app.extensions['draining'] is False
+
+    sock = serve.listen('127.0.0.1', 0, 16)
+    server = serve.WorkerServer('127.0.0.1', 0, app, sock.fileno(), threads=2, keepalive=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection('127.0.0.1', sock.getsockname()[1], timeout=5)
+        for path in ('/healthz', '/readyz'): # two requests on one keep-alive connection
+            connection.request('GET', path)
+            response = connection.getresponse()
+            assert response.status == 200 and json.loads(response.read()) == {"status": "ok"}
+        connection.close()
+    finally:
+        server.stop()
+        thread.join(5)
+        server.server_close()
+    assert server.finish(5) is True
+    sock.close()
+
+def test_worker_server_streams(tmp_path):
+    """
+    Test that event streams don't take a worker's request threads - with 2 threads, two open streams leave
+    /healthz answering, and a stream past CHANGES_MAX_STREAMS is refused with a 503 so the page polls instead
+    :param tmp_path: directory for the worker's database
+    """
+    import http.client
+    import threading
+    import serve
+    app = create_app({"TESTING": True, "DATABASE": str(tmp_path / "serve.db"), "WEATHER_PROVIDER": "fake",
+                      "CHANGES_MAX_STREAMS": 2, "CHANGES_POLL_SECONDS": 0.1, "CHANGES_STREAM_SECONDS": 2})
+    serve.after_fork(app)
+    sock = serve.listen('127.0.0.1', 0, 16)
+    server = serve.WorkerServer('127.0.0.1', 0, app, sock.fileno(), threads=2, keepalive=1,
+                                streams=app.config['CHANGES_MAX_STREAMS'])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def get(path):
+        connection = http.client.HTTPConnection('127.0.0.1', sock.getsockname()[1], timeout=5)
+        connection.request('GET', path, headers={'Cookie': 'user_id=1'})
+        return connection, connection.getresponse()
+
+    try:
+        streams = [get('/api/tasks/events?since=0') for _ in range(2)]
+        for _, response in streams:
+            assert response.status == 200 and response.readline() == b'retry: 2000\n'
+        connection, response = get('/healthz')
+        assert response.status == 200
+        connection.close()
+        connection, response = get('/api/tasks/events?since=0')
+        assert response.status == 503 and 'Retry-After' in response.headers
+        connection.close()
+        for connection, _ in streams:
+            connection.close()
+    finally:
+        server.stop()
+        thread.join(5)
+        server.server_close()
+    assert server.finish(5) is True
+    sock.close()
+
+def test_rate_limits():
+    """
+    Test the login and register rate limits - an address or a username that runs out of tokens gets a 429 with
+    Retry-After, other addresses and usernames are unaffected, and the in-memory buckets stay bounded
+    """
+    import ratelimit
+    app = create_app({"TESTING": True, "STORAGE": "sqlite-memory", "WEATHER_PROVIDER": "fake",
+                      "RATE_LIMIT_PROXIES": 1,
+                      "RATE_LIMITS": {'login_ip': [3, 60], 'login_user': [4, 600], 'register_ip': [1, 3600]}})
+    client = app.test_client()
+
+    def login(username, address):
+        return client.post('/login', data={"username": username, "password": "wrong"},
+                           headers={"X-Forwarded-For": address})
+
+    for _ in range(3):
+        assert login("nobody", "10.0.0.1").status_code == 200
+    response = login("somebody", "10.0.0.1") # this address is out of tokens, whatever the username
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 20
+    assert login("nobody", "10.0.0.2").status_code == 200 # the fourth try on this username
+    assert login("nobody", "10.0.0.3").status_code == 429 # ... and the username is out of tokens too
+
+    assert client.post('/register', data={"username": "limited", "password": "pw"},
+                       headers={"X-Forwarded-For": "10.0.0.4"}).status_code == 302
+    response = client.post('/register', data={"username": "limited2", "password": "pw"},
+                           headers={"X-Forwarded-For": "10.0.0.4"})
+    assert response.status_code == 429 and int(response.headers['Retry-After']) == 3600
+    with app.app_context():
+        assert get_repository().get_user("limited2") is None
+
+    backend = ratelimit.MemoryBackend(max_keys=2)
+    assert backend.take('a', 1, 1.0) == 0 and backend.take('a', 1, 1.0) > 0
+    backend.take('b', 1, 1.0)
+    backend.take('c', 1, 1.0) # evicts 'a', the least recently used
+    assert len(backend._buckets) == 2 and 'a' not in backend._buckets
+
+def test_backups(tmp_path):
+    """
+    Test snapshots of the sharded databases - a snapshot has every shard file, one user can be exported from
+    it, a restore brings the tasks back and tells open tabs to reload, a damaged snapshot is refused before
+    anything is written, and retention keeps the newest snapshot of each period
+    :param tmp_path: directory for the databases and the backups
+    """
+    import backup
+    from datetime import datetime
+    app = create_app({"TESTING": True, "STORAGE": "sqlite-sharded", "SHARD_COUNT": 2, "WEATHER_PROVIDER": "fake",
+                      "DATABASE": str(tmp_path / "tasks.db"), "BACKUP_DIR": str(tmp_path / "backups"),
+                      "BACKUP_PAGES": 1, "BACKUP_PAUSE": 0})
+    repo = storage.get_repository(app)
+    with app.app_context():
+        users = [repo.create_user(f"user{n}", "hash") for n in range(4)]
+        for user_id in users:
+            repo.insert_tasks(user_id, [(f"Task {n}", "2025-01-01") for n in range(3)])
+    name, removed = backup.run(app)
+    manifest = backup.read_manifest(app.config['BACKUP_DIR'], name)
+    assert removed == [] and [entry['shard'] for entry in manifest['files']] == [0, 1]
+
+    # BACKUP_PAUSE is slept between the copy steps
+    source = sqlite3.connect(tmp_path / "tasks.db")
+    pages = source.execute('PRAGMA page_count').fetchone()[0]
+    started = time.monotonic()
+    backup._copy(source, str(tmp_path / "copy.db"), 1, 0.01)
+    assert time.monotonic() - started >= (pages - 1) * 0.01
+    source.close()
+    exported = ''.join(backup.export_user(app.config['BACKUP_DIR'], name, "user3"))
+    assert [json.loads(line)['task'] for line in exported.splitlines()] == ["Task 0", "Task 1", "Task 2"]
+
+    with app.app_context():
+        repo.clear_tasks(users[3])
+        seen = repo.latest_seq(users[3])
+    backup.restore(app, app.config['BACKUP_DIR'], name)
+    with app.app_context():
+        assert repo.count_tasks(users[3]) == 3
+        assert repo.latest_seq(users[3]) > seen and repo.get_changes(users[3], seen) == ([], True)
+        # the restart doesn't stop the next deletes reaching the change feed
+        restarted = repo.latest_seq(users[3])
+        task_id = repo.list_tasks(users[3])[0][0]['id']
+        repo.delete_tasks(users[3], [task_id])
+        assert [(change['op'], change['id']) for change in repo.get_changes(users[3], restarted)[0]] == \
+            [('delete', task_id)]
+
+    damaged = tmp_path / "backups" / name / manifest['files'][1]['file']
+    damaged.write_bytes(damaged.read_bytes()[:-20])
+    with app.app_context():
+        repo.clear_tasks(users[3])
+    with pytest.raises(backup.CorruptBackup):
+        backup.restore(app, app.config['BACKUP_DIR'], name)
+    with app.app_context():
+        assert repo.count_tasks(users[3]) == 0
+
+    now = datetime(2025, 3, 31, 12)
+    created = {f"h{n}": now - timedelta(hours=n) for n in range(0, 24 * 60, 6)}
+    kept = backup.plan_retention(created, {'last': 2, 'daily': 3, 'weekly': 0, 'monthly': 2})
+    assert kept == {"h0", "h6", "h18", "h42", "h738"} # two newest, the last of 3 days, the last of february
+
+def test_metrics(client):
+    """
+    Test that /metrics exposes request latency, sql statement counts and pool stats in prometheus format
+    :param client: Test client that was created for testing the app
+    """
+    client.get('/login')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE momentum_request_seconds histogram' in body
+    assert 'momentum_request_seconds_count{endpoint="login",method="GET",status="200"}' in body
+    assert 'momentum_sql_statements_total{statement="SELECT"}' in body
+    assert 'momentum_db_pool_idle ' in body
+
+def test_write_batching(app, client):
+    """
+    Test the group commit write queue - concurrent add_task calls are committed together,
+    and a failing write only fails its own caller
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    app.config['WRITE_BATCHING'] = True
+    app.config['WRITE_BATCH_MAX_DELAY'] = 0.05
+    app.extensions.pop('write_queue', None)
+    try:
+        with app.app_context():
+            with get_db_connection() as conn:
+                user_id = conn.execute('SELECT id FROM users WHERE username = ?', ('testuser',)).fetchone()['id']
+
+        def add(task_date):
+            with app.app_context():
+                return add_task("Batched Task", user_id, task_date)
+
+        # the None date violates NOT NULL - only that write should fail
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(add, ["2025-09-01"] * 7 + [None]))
+        assert results == [True] * 7 + [False]
+
+        with app.app_context():
+            with get_db_connection() as conn:
+                assert taskstore.count_tasks(conn, user_id) == 7
+            assert write_tasks(get_repository().clear_tasks, user_id) == 7
+    finally:
+        app.extensions.pop('write_queue').stop()
+        app.config['WRITE_BATCHING'] = False
+
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_search(app, client):
+    """
+    Test full text search - prefix matches, results scoped to the logged in user, and deleted tasks drop out
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    client.post('/api/tasks', json={"tasks": [{"task": "Buy oat milk"}, {"task": "Walk the dog"}]})
+
+    # another user's task with the same word must not show up
+    with app.app_context():
+        add_task("Buy milk for someone else", -1, "2025-01-01")
+
+    found = client.get('/api/search?q=mil').get_json()['tasks']
+    assert [task['task'] for task in found] == ["Buy oat milk"]
+    assert b"Buy oat milk" in client.get('/search?q=oat').data
+
+    # fts syntax in the search box is treated as plain text
+    assert client.get('/api/search?q=" OR NEAR(').get_json()['tasks'] == []
+    # ... and so is a user id cookie that isn't a number
+    other = app.test_client()
+    other.set_cookie('user_id', '1"')
+    response = other.get('/api/search?q=milk')
+    assert response.status_code == 200 and response.get_json()['tasks'] == []
+
+    client.delete('/api/tasks', json={"ids": [found[0]['id']]})
+    assert client.get('/api/search?q=milk').get_json()['tasks'] == []
+
+    client.post("/clear")
+    with app.app_context():
+        write_tasks(get_repository().clear_tasks, -1)
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_weather_cache():
+    """
+    Test the weather cache - nearby locations share one report, concurrent misses share one upstream fetch,
+    a stale report is served while it is refreshed in the background, and the cache stays bounded
+    """
+    provider = weather.FakeWeatherProvider()
+    cache = weather.WeatherCache(provider, ttl=60, stale_ttl=60, precision=1)
+
+    with ThreadPoolExecutor(8) as pool:
+        reports = list(pool.map(lambda n: cache.get(40.71 + n / 1000, -74.01), range(8)))
+    assert provider.fetches == 1
+    assert all(report is reports[0] for report in reports)
+
+    # make the report stale - the old one is returned right away and a refresh happens behind it
+    reports[0]['fetched_at'] -= 90
+    assert cache.get(40.71, -74.01) is reports[0]
+    cache._refresher.shutdown(wait=True)
+    assert provider.fetches == 2
+    assert cache.get(40.71, -74.01) is not reports[0]
+
+    # locations from cookies can't grow the cache without bound, and wait=False never calls the provider
+    cache = weather.WeatherCache(provider, ttl=60, stale_ttl=60, max_locations=3)
+    fetches = provider.fetches
+    assert cache.get(10, 10, wait=False) is None and provider.fetches == fetches
+    for n in range(10):
+        cache.get(n, n)
+    assert len(cache._entries) == 3 and list(cache._entries) == [(7, 7), (8, 8), (9, 9)]
+    cache._entries[(9, 9)]['fetched_at'] -= 200 # too old to serve stale
+    assert cache.get(9, 9, wait=False) is None and (9, 9) not in cache._entries
+
+def test_home_weather_card(app, client):
+    """
+    Test that the homepage renders the weather card from the server side provider instead of an iframe
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    client.set_cookie('lat', '51.5')
+    client.set_cookie('lon', '-0.12')
+
+    response = client.get('/home')
+    assert b"<iframe" not in response.data
+    assert b"weather-card" in response.data
+    assert b"51.5, -0.1" in response.data
+
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_assets(app, client, tmp_path):
+    """
+    Test the asset pipeline - files are fingerprinted and gzipped at build time, unused font awesome icons
+    are dropped, and /assets/ serves the pre-compressed copy with an immutable cache header
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    :param tmp_path: scratch directory provided by pytest
+    """
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "momentum.css").write_text(".task-column { height: 600px; }\n" * 50)
+    (source / "fontawesome.min.css").write_text(".fa-trash:before{content:'a'}.fa-ghost:before{content:'b'}")
+
+    manifest = assets.build([str(source)], str(tmp_path / "dist"), icons={'fa-trash'})
+    assert manifest['momentum.css'].startswith('momentum.') and manifest['momentum.css'].endswith('.css')
+    assert (tmp_path / "dist" / (manifest['momentum.css'] + '.gz')).exists()
+    subset = (tmp_path / "dist" / manifest['fontawesome.min.css']).read_text()
+    assert 'fa-trash' in subset and 'fa-ghost' not in subset
+
+    # nothing built and bootstrap not vendored - the CDN copy is used (and logged), and build-assets won't run
+    old_dist, old_sources = app.config['ASSETS_DIST'], app.config['ASSETS_SOURCES']
+    app.config['ASSETS_DIST'] = str(tmp_path / "missing")
+    app.config['ASSETS_SOURCES'] = [str(source)]
+    app.extensions.pop('assets_manifest', None)
+    try:
+        with app.test_request_context():
+            assert assets.asset_url('bootstrap.min.css') == assets.VENDOR['bootstrap.min.css']
+            assert 'bootstrap.min.css' in app.extensions['assets_missing']
+        assert 'bootstrap.min.css' in assets.missing_vendor([str(source)])
+        result = app.test_cli_runner().invoke(args=['build-assets'])
+        assert result.exit_code != 0 and 'vendor-assets' in result.output
+    finally:
+        app.config['ASSETS_SOURCES'] = old_sources
+
+    app.config['ASSETS_DIST'] = str(tmp_path / "dist")
+    app.extensions.pop('assets_manifest', None)
+    try:
+        with app.test_request_context():
+            url = assets.asset_url('momentum.css')
+        assert url == f"/assets/{manifest['momentum.css']}"
+
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.mimetype == 'text/css'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert gzip.decompress(response.data).startswith(b".task-column")
+    finally:
+        app.config['ASSETS_DIST'] = old_dist
+        app.extensions.pop('assets_manifest', None)
+
+def test_asset_urls_resolve(app, client):
+    """
+    Test that every asset the templates ask for resolves - local urls answer 200, and anything that isn't
+    vendored yet points at its CDN copy
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    import os
+    import re
+    templates = os.path.join(app.root_path, app.template_folder)
+    names = set()
+    for name in os.listdir(templates):
+        with open(os.path.join(templates, name), encoding='utf-8') as template:
+            names.update(re.findall(r"asset_url\('([^']+)'\)", template.read()))
+    assert names
+    for name in names:
+        with app.test_request_context():
+            url = assets.asset_url(name)
+        if url.startswith('https://'):
+            assert url == assets.VENDOR[name]
+        else:
+            response = client.get(url)
+            assert response.status_code == 200, url
+            response.close()
+
+def test_task_changes(app, client):
+    """
+    Test the change feed - adds, deletes and a clear show up in order after the page's seq, both from
+    /api/tasks/changes and from the event stream
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    client.post("/clear")
+
+    # the homepage remembers where the change log was when it was rendered
+    page = client.get('/home').get_data(as_text=True)
+    seq = int(page.split('data-seq="')[1].split('"')[0])
+
+    client.post('/api/tasks', json={"tasks": [{"task": "Change 1", "date": "2025-08-01"},
+                                              {"task": "Change 2", "date": "2025-08-02"}]})
+    first = client.get('/api/tasks?limit=1').get_json()['tasks'][0]
+    client.delete('/api/tasks', json={"ids": [first['id']]})
+    client.post('/api/tasks/clear')
+
+    feed = client.get(f'/api/tasks/changes?since={seq}').get_json()
+    assert feed['reset'] is False
+    assert [change['op'] for change in feed['changes']] == ['add', 'add', 'delete', 'clear']
+    assert feed['changes'][0]['task'] == "Change 1" and feed['changes'][0]['display_date'] == "08/01/2025"
+    assert feed['changes'][2]['id'] == first['id']
+    assert feed['seq'] == feed['changes'][-1]['seq']
+    # nothing new after the last one
+    assert client.get(f"/api/tasks/changes?since={feed['seq']}").get_json()['changes'] == []
+
+    # the event stream sends the same changes (a short lifetime so the response ends)
+    app.config['CHANGES_STREAM_SECONDS'] = 0
+    events = client.get(f'/api/tasks/events?since={seq}').get_data(as_text=True)
+    assert events.count('event: change') == 4
+    assert f"id: {feed['seq']}" in events
+
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_task_stats(app, client):
+    """
+    Test the summary counts - kept up to date by the triggers on add, delete and clear, and the same as a
+    full recount by rebuild_stats
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    client.post("/clear")
+
+    today = date.today()
+    days = [(today + timedelta(days=offset)).isoformat() for offset in (-2, -1, 0, 0, 3, 30)]
+    client.post('/api/tasks', json={"tasks": [{"task": f"Stats {n}", "date": day} for n, day in enumerate(days)]})
+
+    stats = client.get('/api/stats').get_json()
+    assert (stats['total'], stats['today'], stats['overdue']) == (6, 2, 2)
+    assert len(stats['days']) == app.config['STATS_DAYS']
+    assert [day['tasks'] for day in stats['days'][:4]] == [2, 0, 0, 1]
+
+    # the homepage shows the same numbers
+    assert b'data-stat="today">2<' in client.get('/home').data
+
+    # deleting the last task of a day removes that day
+    overdue = client.get("/api/tasks?limit=1").get_json()['tasks'][0]
+    client.delete('/api/tasks', json={"ids": [overdue['id']]})
+    stats = client.get('/api/stats').get_json()
+    assert (stats['total'], stats['overdue']) == (5, 1)
+
+    # a full recount agrees with the incremental counts
+    with app.app_context():
+        conn = get_db_connection()
+        before = conn.execute('SELECT * FROM task_stats ORDER BY user_id, date').fetchall()
+        with conn:
+            taskstore.rebuild_stats(conn)
+        assert conn.execute('SELECT * FROM task_stats ORDER BY user_id, date').fetchall() == before
+
+    client.post('/api/tasks/clear')
+    stats = client.get('/api/stats').get_json()
+    assert (stats['total'], stats['today'], stats['overdue']) == (0, 0, 0)
+
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
+def test_archive(app, client):
+    """
+    Test archiving - old tasks move to the archive in chunks (keeping their ids), drop out of the homepage and
+    show up on /archive; a user's retention overrides the default and 0 turns archiving off
+    :param app: Flask app instance
+    :param client: Test client that was created for testing the app
+    """
+    register_test_user(client, "testuser", "testpassword")
+    client.post("/login", data={"username": "testuser", "password": "testpassword"})
+    client.post("/clear")
+
+    today = date.today()
+    days = [(today - timedelta(days=offset)).isoformat() for offset in (400, 300, 200, 100, 10, 0)]
+    client.post('/api/tasks', json={"tasks": [{"task": f"Archive {n}", "date": day} for n, day in enumerate(days)]})
+    ids = [task['id'] for task in client.get('/api/tasks').get_json()['tasks']]
+
+    # retention of 0 means never
+    client.post('/archive', data={"days": "0"})
+    app.config['ARCHIVE_CHUNK_SIZE'] = 2
+    app.config['ARCHIVE_PAUSE'] = 0
+    with app.app_context():
+        user_id = get_db_connection().execute('SELECT id FROM users WHERE username = ?', ("testuser",)).fetchone()[0]
+        assert user_id not in archive.run(app)
+
+        # 50 days - everything but the last two moves, two per transaction
+        # the pass is made straight on the repository, as the archive-tasks command does from its own process
+        # (where this app's page cache isn't invalidated) - the homepage still goes stale
+        client.post('/archive', data={"days": "50"})
+        etag = client.get('/home').headers['ETag']
+        assert archive.archive_all(get_repository(), app.config['ARCHIVE_AFTER_DAYS'], chunk_size=2)[user_id] == 4
+    assert client.get('/home', headers={'If-None-Match': etag}).status_code == 200
+
+    home = client.get('/api/tasks').get_json()
+    assert [task['task'] for task in home['tasks']] == ["Archive 4", "Archive 5"]
+    assert client.get('/api/stats').get_json()['total'] == 2
+
+    page = client.get('/archive?limit=3').data
+    assert b"Archive 0" in page and b"Archive 2" in page and b"Archive 3" not in page
+    assert b'rounded-pill">4<' in page
+
+    with app.app_context():
+        conn = get_db_connection()
+        archived = [row[0] for row in conn.execute('SELECT id FROM tasks_archive WHERE user_id = ? ORDER BY id', (user_id,))]
+        assert archived == ids[:4]
+        with conn:
+            conn.execute('DELETE FROM tasks_archive WHERE user_id = ?', (user_id,))
+
+    client.post("/clear")
+    removed = remove_test_user(client, app, "testuser")
+    assert removed is True
+
 def test_delete_task_success(app, client):
     """
     Test the delete_task function to ensure that valid tasks are deleted successfully
@@ -0,0 +1,89 @@
+import csv # csv import/export
+import io # text buffer for the csv writer
+import json # ndjson import/export
+from itertools import islice # splits the import into chunks
+import taskstore # parse_date
+
+# streaming import/export of a user's tasks as NDJSON (one json object per line) or CSV (task,date)
+# everything here works on iterators, so memory use is the same for ten tasks or ten million
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# every task the user has, in (date, id) order, read lazily from the cursor
+def iter_user_tasks(conn, user_id):
+    cursor = conn.execute('SELECT id, task, date FROM tasks WHERE user_id = ? ORDER BY date, id', (user_id,))
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+# rows -> ndjson lines
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps({'id': row['id'], 'task': row['task'], 'date': row['date']}) + '\n'
+
+# rows -> csv lines, batched so each yielded chunk is a reasonable size
+def to_csv(rows, batch=500):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['task', 'date'])
+    for count, row in enumerate(rows, 1):
+        writer.writerow([row['task'], row['date']])
+        if count % batch == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# serialise rows in the requested format
+def export_rows(rows, fmt):
+    return to_csv(rows) if fmt == 'csv' else to_ndjson(rows)
+
+# ndjson lines -> dicts (blank lines are skipped, lines that aren't json objects come out as None)
+def _parse_ndjson(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        yield item if isinstance(item, dict) else None
+
+# turn text lines into (task, date) pairs - invalid rows come out as None so the caller can count them
+def parse_rows(lines, fmt):
+    items = csv.DictReader(lines) if fmt == 'csv' else _parse_ndjson(lines)
+    for item in items:
+        task = item.get('task') if item else None
+        task_date = taskstore.parse_date(item.get('date')) if item else None
+        if isinstance(task, str) and task.strip() and task_date:
+            yield task, task_date
+        else:
+            yield None
+
+# hand parsed rows to `insert` in chunks - insert(pairs) stores (and commits) one chunk and returns how many
+# it added, e.g. one transaction and one executemany per chunk for sqlite (see storage.py)
+# returns (imported, skipped) - chunks already committed stay committed if a later one fails
+def import_rows(insert, rows, chunk_size=5000):
+    imported = skipped = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        valid = [row for row in chunk if row is not None]
+        skipped += len(chunk) - len(valid)
+        if valid:
+            imported += insert(valid)
+    return imported, skipped
+
+# pick the format from an explicit value or a file name, defaulting to ndjson
+def detect_format(fmt=None, filename=None):
+    if fmt in FORMATS:
+        return fmt
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return 'ndjson'
@@ -0,0 +1,187 @@
+import json # open-meteo responses
+import threading # guards the cache and the in-flight fetches
+import time # TTL bookkeeping
+import urllib.request # talks to the upstream weather api
+from collections import OrderedDict # LRU ordering for the cached locations
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlencode
+from flask import current_app
+
+# server side weather for the homepage card
+# reports are cached per rounded location: fresh for WEATHER_TTL seconds, then served stale for up to
+# WEATHER_STALE_TTL more while one background refresh runs - and concurrent requests for a location that
+# isn't cached share a single upstream fetch, so N users in one area cost one call to the provider
+# the locations come from cookies, so the cache is a bounded LRU (WEATHER_MAX_LOCATIONS) and drops reports
+# once they are too old to serve
+
+# weather codes (WMO) -> (summary, font awesome icon)
+CONDITIONS = [
+    (0, 'Clear', 'fa-sun'),
+    (3, 'Partly cloudy', 'fa-cloud-sun'),
+    (48, 'Fog', 'fa-smog'),
+    (57, 'Drizzle', 'fa-cloud-rain'),
+    (67, 'Rain', 'fa-cloud-showers-heavy'),
+    (77, 'Snow', 'fa-snowflake'),
+    (82, 'Rain showers', 'fa-cloud-sun-rain'),
+    (86, 'Snow showers', 'fa-snowflake'),
+    (99, 'Thunderstorm', 'fa-bolt'),
+]
+
+def describe(code):
+    for highest, summary, icon in CONDITIONS:
+        if code <= highest:
+            return summary, icon
+    return 'Unknown', 'fa-cloud'
+
+# providers take a (latitude, longitude) and return a report dict:
+# {'temperature', 'high', 'low', 'unit', 'summary', 'icon'}
+class WeatherProvider:
+    def fetch(self, latitude, longitude):
+        raise NotImplementedError
+
+# open-meteo.com - free, no api key
+class OpenMeteoProvider(WeatherProvider):
+    URL = 'https://api.open-meteo.com/v1/forecast'
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+
+    def fetch(self, latitude, longitude):
+        query = urlencode({'latitude': latitude, 'longitude': longitude, 'current': 'temperature_2m,weather_code',
+                           'daily': 'temperature_2m_max,temperature_2m_min', 'forecast_days': 1,
+                           'temperature_unit': 'fahrenheit', 'timezone': 'auto'})
+        with urllib.request.urlopen(f'{self.URL}?{query}', timeout=self.timeout) as response:
+            data = json.load(response)
+        summary, icon = describe(data['current']['weather_code'])
+        return {'temperature': round(data['current']['temperature_2m']),
+                'high': round(data['daily']['temperature_2m_max'][0]),
+                'low': round(data['daily']['temperature_2m_min'][0]),
+                'unit': '°F', 'summary': summary, 'icon': icon}
+
+# made up but stable weather for tests and offline development - counts its fetches
+class FakeWeatherProvider(WeatherProvider):
+    def __init__(self):
+        self.fetches = 0
+
+    def fetch(self, latitude, longitude):
+        self.fetches += 1
+        temperature = 50 + int(abs(latitude * 7 + longitude * 3)) % 40
+        summary, icon = describe(int(abs(latitude + longitude)) % 100)
+        return {'temperature': temperature, 'high': temperature + 6, 'low': temperature - 8,
+                'unit': '°F', 'summary': summary, 'icon': icon}
+
+PROVIDERS = {
+    'open-meteo': OpenMeteoProvider,
+    'fake': FakeWeatherProvider,
+}
+
+class WeatherCache:
+    def __init__(self, provider, ttl=600, stale_ttl=3600, precision=1, retry_after=30, max_locations=4096):
+        self.provider = provider
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.precision = precision # decimal places kept from the coordinates (1 = roughly 10km)
+        self.retry_after = retry_after # seconds before a location whose fetch failed is tried again
+        self.max_locations = max_locations # reports (and failures) kept, least recently used go first
+        self._entries = OrderedDict() # key -> report (with 'fetched_at')
+        self._failures = OrderedDict() # key -> time of the last failed fetch, oldest first
+        self._inflight = {} # key -> Future for a fetch that is running
+        self._lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(2, thread_name_prefix='momentum-weather')
+
+    def key(self, latitude, longitude):
+        return round(latitude, self.precision), round(longitude, self.precision)
+
+    # the report for a location, or None when there is no data at all (provider down and nothing cached)
+    # with wait=False only a cached report is returned - nothing is fetched while the caller waits
+    def get(self, latitude, longitude, wait=True):
+        key = self.key(latitude, longitude)
+        now = time.time()
+        with self._lock:
+            report = self._entries.get(key)
+            age = now - report['fetched_at'] if report else None
+            if report and age < self.ttl:
+                self._entries.move_to_end(key)
+                return report
+            if report and age < self.ttl + self.stale_ttl:
+                # stale but usable - answer now and refresh in the background (once)
+                self._entries.move_to_end(key)
+                if key not in self._inflight:
+                    self._inflight[key] = future = Future()
+                    self._refresher.submit(self._fetch, key, future)
+                return report
+            if report:
+                del self._entries[key] # too old to serve
+            if not wait:
+                return None
+            # the provider just failed for this location - don't send every request upstream while it is down
+            if now - self._failures.get(key, 0) < self.retry_after:
+                return None
+            # nothing usable - join the fetch that is already running for this location, or start one
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if owner:
+            self._fetch(key, future)
+        return future.result()
+
+    # fetch from the provider and resolve everyone waiting - on errors the old report (if any) is kept
+    def _fetch(self, key, future):
+        try:
+            report = dict(self.provider.fetch(*key), fetched_at=time.time(), location=key)
+        except Exception:
+            report = None
+        now = time.time()
+        with self._lock:
+            if report is not None:
+                self._entries[key] = report
+                self._entries.move_to_end(key)
+                self._failures.pop(key, None)
+                while len(self._entries) > self.max_locations:
+                    self._entries.popitem(last=False) # evict the least recently used location
+            else:
+                self._failures.pop(key, None)
+                self._failures[key] = now
+                report = self._entries.get(key)
+            # failures only matter for retry_after seconds, and the oldest are first
+            while self._failures and (len(self._failures) > self.max_locations or
+                                      now - next(iter(self._failures.values())) >= self.retry_after):
+                self._failures.popitem(last=False)
+            self._inflight.pop(key, None)
+        future.set_result(report)
+
+# returns the weather cache for the current app, creating it from the config on first use
+def get_cache(app=None):
+    app = app or current_app
+    cache = app.extensions.get('weather')
+    if cache is None:
+        cache = WeatherCache(PROVIDERS[app.config['WEATHER_PROVIDER']](),
+                             ttl=app.config['WEATHER_TTL'],
+                             stale_ttl=app.config['WEATHER_STALE_TTL'],
+                             precision=app.config['WEATHER_PRECISION'],
+                             retry_after=app.config['WEATHER_RETRY_AFTER'],
+                             max_locations=app.config['WEATHER_MAX_LOCATIONS'])
+        app.extensions['weather'] = cache
+    return cache
+
+# weather for a location from the browser (lat/lon cookies), falling back to WEATHER_DEFAULT_LOCATION
+# wait=False only returns what is already cached (see WeatherCache.get)
+def get_report(cookies, wait=True):
+    try:
+        latitude, longitude = float(cookies['lat']), float(cookies['lon'])
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError
+    except (KeyError, ValueError):
+        latitude, longitude = current_app.config['WEATHER_DEFAULT_LOCATION']
+    return get_cache().get(latitude, longitude, wait=wait)
+
+# wire weather settings into an app
+def init_app(app):
+    app.config.setdefault('WEATHER_PROVIDER', 'open-meteo') # 'open-meteo' or 'fake' (tests and offline use)
+    app.config.setdefault('WEATHER_TTL', 600) # seconds a report is fresh
+    app.config.setdefault('WEATHER_STALE_TTL', 3600) # seconds a report may be served stale while it refreshes
+    app.config.setdefault('WEATHER_RETRY_AFTER', 30) # seconds before retrying a location whose fetch failed
+    app.config.setdefault('WEATHER_PRECISION', 1) # coordinates are rounded to this many decimals for the cache key
+    app.config.setdefault('WEATHER_MAX_LOCATIONS', 4096) # locations the cache keeps reports for
+    app.config.setdefault('WEATHER_DEFAULT_LOCATION', (40.71, -74.01)) # used until the browser shares its location
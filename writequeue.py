@@ -0,0 +1,119 @@
+import os # a queue belongs to the process that started its thread
+import queue # hands writes to the writer thread
+import sqlite3
+import threading # the background writer
+import time # batch window
+from concurrent.futures import Future # per write result for the caller
+from flask import current_app
+import db # the writer's connection comes from the pool
+
+# group commit for task writes - instead of every request taking the write lock and paying for its own
+# commit, requests hand their write to one background thread that runs everything that arrives within a
+# short window in a single transaction
+# each write runs inside its own SAVEPOINT, so one failing write is rolled back on its own and only its
+# caller sees the error; the callers' futures are resolved only after the batch has committed
+
+class WriteQueue:
+    def __init__(self, pool, max_batch=100, max_delay=0.005):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay # seconds to wait for more writes after the first one arrives
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='momentum-writer', daemon=True)
+        self._thread.start()
+
+    # queue func(conn, *args) - returns a Future with func's return value (or its sqlite3.Error)
+    def submit(self, func, *args):
+        future = Future()
+        self._queue.put((func, args, future))
+        return future
+
+    # ask the writer to finish what is queued and exit
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    # wait for the first write, then collect more until the batch is full or the window has passed
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None) # finish this batch, then stop
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = self.pool.acquire()
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._write(conn, batch)
+        finally:
+            self.pool.release(conn)
+
+    def _write(self, conn, batch):
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for func, args, _ in batch:
+                conn.execute('SAVEPOINT write')
+                try:
+                    results.append((True, func(conn, *args)))
+                    conn.execute('RELEASE write')
+                except Exception as error:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    results.append((False, error))
+            conn.commit()
+        except sqlite3.Error as error:
+            # the batch as a whole failed (e.g. the write lock couldn't be taken) - every caller gets the error
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(False, error)] * len(batch)
+
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+_start_lock = threading.Lock()
+
+# returns the write queue for the current app and process, starting it on first use
+# each database file has its own queue and writer (see the shards in storage.py) - DATABASE by default
+def get_queue(app=None, database=None):
+    app = app or current_app
+    if database is None or database == app.config['DATABASE']:
+        queues, key = app.extensions, 'write_queue'
+    else:
+        queues, key = app.extensions.setdefault('shard_write_queues', {}), database
+    with _start_lock:
+        write_queue = queues.get(key)
+        if write_queue is None or write_queue.pid != os.getpid():
+            write_queue = WriteQueue(db.get_pool(app, database),
+                                     max_batch=app.config['WRITE_BATCH_MAX_SIZE'],
+                                     max_delay=app.config['WRITE_BATCH_MAX_DELAY'])
+            queues[key] = write_queue
+    return write_queue
+
+# wire the write queue settings into an app (the queue itself starts on the first batched write)
+def init_app(app):
+    app.config.setdefault('WRITE_BATCHING', False) # send task writes through the group commit queue
+    app.config.setdefault('WRITE_BATCH_MAX_SIZE', 100) # most writes committed together
+    app.config.setdefault('WRITE_BATCH_MAX_DELAY', 0.005) # seconds a write may wait for others to join it
+    app.config.setdefault('WRITE_BATCH_TIMEOUT', 10) # seconds a request waits for its write before giving up